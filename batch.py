@@ -0,0 +1,148 @@
+'''
+Runs many programs on a pool of worker processes that stay loaded between programs
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from dataclasses import dataclass
+from typing import Iterable, Iterator, IO
+from time import perf_counter
+from itertools import repeat
+from symbol_table import Snapshot, new_symbol_table
+import io
+import os
+import interpret
+import parallel
+import vm
+
+# the prelude loaded by this worker process, or the error it failed with
+_prelude: Snapshot | str | None = None
+
+@dataclass(slots=True)
+class ScriptResult:
+    path: str
+    output: str
+    error: str | None
+    seconds: float
+
+@dataclass(slots=True)
+class BatchSummary:
+    scripts: int = 0
+    failures: int = 0
+    seconds: float = 0.0
+
+    def __str__(self) -> str:
+        rate = self.scripts / self.seconds if self.seconds else 0.0
+        return f'{self.scripts} scripts, {self.failures} failed in {self.seconds:.3f}s ({rate:.1f} scripts/s)'
+
+def script_paths(paths: Iterable[str]) -> list[str]:
+    '''
+    get the programs to run, a directory means every file in it
+    :paths: files and directories
+    '''
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if os.path.isfile(os.path.join(path, name))
+            ))
+        else:
+            result.append(path)
+    return result
+
+def load_prelude(path: str | None, use_vm: bool = False):
+    '''
+    run the program every script of this process starts from and keep a snapshot of its symbol table
+    an error is kept to be reported as the error of each script
+    :path: file of the prelude, no prelude if None
+    :use_vm: run on the bytecode machine
+    '''
+    global _prelude
+    if path is None:
+        _prelude = None
+        return
+    backend = vm if use_vm else interpret
+    symbol_table = new_symbol_table()
+    try:
+        with open(path, 'r') as file:
+            backend.evaluate(file.read(), symbol_table, path=path)
+        _prelude = symbol_table.snapshot()
+    except (*interpret.ERRORS, OSError) as e:
+        _prelude = f'prelude failed: {e}'
+
+def _start_worker(prelude: str | None, use_vm: bool):
+    '''
+    set up a worker process of the batch
+    pmap runs its calls in the worker, a pool started there would keep it from exiting
+    :prelude: file of the prelude, no prelude if None
+    :use_vm: run on the bytecode machine
+    '''
+    parallel.mark_worker()
+    load_prelude(prelude, use_vm)
+
+def run_script(path: str, use_vm: bool = False, limits: interpret.Limits | None = None) -> ScriptResult:
+    '''
+    run one program in a new symbol table, or a fork of the prelude, capturing what it prints
+    :path: file of the program
+    :use_vm: run on the bytecode machine
+    :limits: steps, call depth and seconds the program may use
+    '''
+    if isinstance(_prelude, str):
+        return ScriptResult(path, '', _prelude, 0.0)
+    backend = vm if use_vm else interpret
+    symbol_table = None if _prelude is None else _prelude.fork()
+    output = io.StringIO()
+    error = None
+    start = perf_counter()
+    try:
+        with open(path, 'r') as file, redirect_stdout(output):
+            backend.evaluate(file.read(), symbol_table, limits=limits, path=path)
+    except interpret.ERRORS as e:
+        error = str(e)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    return ScriptResult(path, output.getvalue(), error, perf_counter() - start)
+
+def run_batch(paths: Iterable[str], workers: int | None = None, use_vm: bool = False, limits: interpret.Limits | None = None, prelude: str | None = None) -> Iterator[ScriptResult]:
+    '''
+    run programs on a pool of worker processes
+    :paths: files of the programs
+    :workers: number of processes, the number of cpus if None
+    :use_vm: run on the bytecode machine
+    :limits: steps, call depth and seconds each program may use
+    :prelude: file of a program each worker runs once, every program starts from a fork of its globals
+    :returns: the results in the same order as the paths
+    '''
+    paths = list(paths)
+    chunksize = max(1, len(paths) // ((workers or os.cpu_count() or 1) * 8))
+    with ProcessPoolExecutor(workers, initializer=_start_worker, initargs=(prelude, use_vm)) as executor:
+        yield from executor.map(run_script, paths, repeat(use_vm), repeat(limits), chunksize=chunksize)
+
+def run_all(paths: Iterable[str], workers: int | None = None, use_vm: bool = False, limits: interpret.Limits | None = None, out: IO[str] | None = None, report: IO[str] | None = None, prelude: str | None = None) -> BatchSummary:
+    '''
+    run programs and write their output followed by a summary
+    :paths: files and directories of programs
+    :workers: number of processes, the number of cpus if None
+    :use_vm: run on the bytecode machine
+    :limits: steps, call depth and seconds each program may use
+    :out: where the output of each program goes, stdout if None
+    :report: where failures and the summary go, stdout if None
+    :prelude: file of a program every program starts from the globals of
+    '''
+    summary = BatchSummary()
+    failed = []
+    start = perf_counter()
+    for result in run_batch(script_paths(paths), workers, use_vm, limits, prelude):
+        summary.scripts += 1
+        print(f'==> {result.path} <==', file=out)
+        print(result.output, end='', file=out)
+        if result.error is not None:
+            summary.failures += 1
+            failed.append(result)
+            print(result.error, file=out)
+    summary.seconds = perf_counter() - start
+    for result in failed:
+        print(f'failed: {result.path}: {result.error}', file=report)
+    print(summary, file=report)
+    return summary
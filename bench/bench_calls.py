@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark the cost of calling a user defined function as the global symbol table grows
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from timeit import timeit
+from interpret import interpret
+from symbol_table import new_symbol_table
+
+CALLS = 10000
+SIZES = (10, 1000, 100000)
+
+def populated_table(size: int):
+    '''
+    create a symbol table with size globals and one large list
+    :size: number of globals to define
+    '''
+    symbol_table = new_symbol_table()
+    for i in range(size):
+        symbol_table[f'global_{i}'] = i
+    symbol_table['big_list'] = list(range(size))
+    interpret('(def f (n) (+ n 1))', symbol_table)
+    return symbol_table
+
+def main():
+    '''Driver Code'''
+    program = f'(for i ({CALLS}) (f i))'
+    for size in SIZES:
+        symbol_table = populated_table(size)
+        seconds = timeit(lambda: interpret(program, symbol_table), number=1)
+        print(f'{size:>8} globals: {seconds / CALLS * 1e6:8.2f} us per call')
+
+if __name__ == '__main__':
+    main()
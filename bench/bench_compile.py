@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark the tree walking evaluator against the compiled closures and the bytecode machine
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from timeit import timeit
+from interpret import eval_tree, compile_tree
+from symbol_table import new_symbol_table
+import parser as ps
+import vm
+
+PROGRAMS = {
+    'while': '(= i 0) (= total 0) (while (< i 100000) (nop (+= total (* i 2)) (++ i))) total',
+    'for': '(= total 0) (for i (100000) (+= total (mod i 7))) total',
+    'calls': '(def f (a b) (+ a b)) (= total 0) (for i (50000) (= total (f total i))) total',
+}
+
+def main():
+    '''Driver Code'''
+    for name, program in PROGRAMS.items():
+        node = ps.program(program)
+        walked = timeit(lambda: eval_tree(node, new_symbol_table()), number=1)
+        compiled = timeit(lambda: compile_tree(node)(new_symbol_table()), number=1)
+        bytecode = timeit(lambda: vm.run(vm.compile_program(node), new_symbol_table()), number=1)
+        print(f'{name:>8}: eval_tree {walked:.3f}s compile_tree {compiled:.3f}s ({walked / compiled:.1f}x) vm {bytecode:.3f}s ({walked / bytecode:.1f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark starting jobs from a fork of a snapshot of a prelude against running the prelude for every job
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from time import perf_counter
+from interpret import evaluate
+from symbol_table import new_symbol_table
+
+FUNCTIONS = 2000
+JOBS = 2000
+PRELUDE = ' '.join(f'(def f{i} (x) (+ x {i}))' for i in range(FUNCTIONS)) + ' (= base 10)'
+JOB = '(= y (f1 base)) (f2 y)'
+
+def main():
+    '''Driver Code'''
+    start = perf_counter()
+    for _ in range(JOBS // 100):
+        symbol_table = new_symbol_table()
+        evaluate(PRELUDE, symbol_table)
+        evaluate(JOB, symbol_table)
+    rerun = (JOBS // 100) / (perf_counter() - start)
+    start = perf_counter()
+    symbol_table = new_symbol_table()
+    evaluate(PRELUDE, symbol_table)
+    snapshot = symbol_table.snapshot()
+    for _ in range(JOBS):
+        evaluate(JOB, snapshot.fork())
+    forked = JOBS / (perf_counter() - start)
+    print(f'prelude of {FUNCTIONS} functions: run for each job {rerun:.1f} jobs/s, forked {forked:.1f} jobs/s ({forked / rerun:.0f}x)')
+
+if __name__ == '__main__':
+    main()
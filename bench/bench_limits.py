@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark the cost of step, call depth and time limits
+without limits the compiled closures have no checks, so those times should match
+the ones of a revision from before limits existed, given with --before
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from argparse import ArgumentParser
+from timeit import repeat
+import subprocess
+import tempfile
+import tarfile
+import json
+import io
+from interpret import compile_tree, run_limited, Limits, MAX_DEPTH
+from symbol_table import new_symbol_table
+import parser as ps
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PROGRAMS = {
+    'while': '(= i 0) (= total 0) (while (< i 100000) (nop (+= total (* i 2)) (++ i))) total',
+    'for': '(= total 0) (for i (100000) (+= total (mod i 7))) total',
+    'calls': '(def f (a b) (+ a b)) (= total 0) (for i (50000) (= total (f total i))) total',
+}
+
+LIMITS = Limits(steps=10 ** 9, depth=MAX_DEPTH, seconds=3600.0)
+
+# times the programs without limits in the tree it runs in, which only needs
+# compile_tree to take a tree, so it runs on revisions from before limits too
+UNLIMITED = '''
+import json, sys
+from timeit import repeat
+from interpret import compile_tree
+from symbol_table import new_symbol_table
+import parser as ps
+times = {}
+for name, program in json.loads(sys.argv[1]).items():
+    node = ps.program(program)
+    times[name] = min(repeat(lambda: compile_tree(node)(new_symbol_table()), number=1, repeat=int(sys.argv[2])))
+print(json.dumps(times))
+'''
+
+def best(run, repeats: int) -> float:
+    '''
+    get the fastest of several runs
+    :run: function to time
+    :repeats: number of runs
+    '''
+    return min(repeat(run, number=1, repeat=repeats))
+
+def unlimited(tree: str, repeats: int) -> dict[str, float]:
+    '''
+    time the programs without limits in a fresh process
+    :tree: directory of the interpreter to time
+    :repeats: runs of each program, the fastest is kept
+    '''
+    done = subprocess.run([sys.executable, '-c', UNLIMITED, json.dumps(PROGRAMS), str(repeats)], cwd=tree, capture_output=True, text=True, check=True)
+    return json.loads(done.stdout)
+
+def unpack(revision: str, directory: str):
+    '''
+    write the files of a revision of this repository to a directory
+    :revision: anything git can name a commit by
+    :directory: where the files go
+    '''
+    archive = subprocess.run(['git', 'archive', revision], cwd=ROOT, capture_output=True, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory, filter='data')
+
+def main():
+    '''Driver Code'''
+    arg_parser = ArgumentParser(description='Time programs with and without limits')
+    arg_parser.add_argument('--before', metavar='REVISION', help='also time the programs without limits on this revision, like one from before limits existed')
+    arg_parser.add_argument('--repeat', type=int, default=5, help='runs of each program, the fastest is kept')
+    arg_parser.add_argument('--rounds', type=int, default=3, help='times each tree is timed without limits, taking turns')
+    args = arg_parser.parse_args()
+    trees = {'now': ROOT}
+    with tempfile.TemporaryDirectory() as directory:
+        if args.before is not None:
+            unpack(args.before, directory)
+            trees['before'] = directory
+        # the trees take turns so a host getting slower or faster affects both the same
+        times = {tree: dict.fromkeys(PROGRAMS, float('inf')) for tree in trees}
+        for _ in range(args.rounds):
+            for tree, path in trees.items():
+                for name, seconds in unlimited(path, args.repeat).items():
+                    times[tree][name] = min(times[tree][name], seconds)
+    now, before = times['now'], times.get('before')
+    for name, program in PROGRAMS.items():
+        node = ps.program(program)
+        limited = best(lambda: run_limited(lambda: compile_tree(node, limited=True)(new_symbol_table()), LIMITS), args.repeat)
+        line = f'{name:>8}: no limits {now[name]:.4f}s'
+        if before is not None:
+            line += f' ({(now[name] / before[name] - 1) * 100:+.1f}% against {before[name]:.4f}s at {args.before})'
+        print(f'{line} limits {limited:.4f}s ({(limited / now[name] - 1) * 100:+.1f}%)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+'''
+Measure the memory used by the tree of a large generated program
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tracemalloc
+import parser as ps
+
+FORMS = 50000
+
+def generate(forms: int) -> str:
+    '''
+    generate a program with a mix of assignments, calls, conditions and loops
+    :forms: number of top level expressions
+    '''
+    lines = []
+    for i in range(forms):
+        match i % 4:
+            case 0:
+                lines.append(f'(= value_{i % 100} (+ {i} (* counter 2.5)))')
+            case 1:
+                lines.append(f"(if (< value_{i % 100} {i}) (print 'small' value_{i % 100}) (print 'big'))")
+            case 2:
+                lines.append(f'(for i (0 {i % 10}) (+= counter i))')
+            case 3:
+                lines.append(f'(fore item (lst 1 2 3 {i}) (app items item))')
+    return '\n'.join(lines)
+
+def main():
+    '''Driver Code'''
+    source = generate(FORMS)
+    tracemalloc.start()
+    tree = ps.program(source)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    nodes = sum(1 for _ in ps.walk(tree))
+    print(f'source {len(source) / 1e6:.2f}MB, {nodes} nodes')
+    print(f'tree {current / 1e6:.2f}MB ({current / nodes:.0f} bytes per node), peak while parsing {peak / 1e6:.2f}MB')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark running a large generated data script through a memory map against reading it as text,
+comparing the time and the peak memory of each
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from argparse import ArgumentParser
+from time import perf_counter
+import subprocess
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+MEGABYTES = 256
+LINE = "(= record (lst {0} 'name_{0}' 'a string of padding that makes each record longer than its numbers' {0}.5))\n"
+
+def write_script(file, megabytes: int):
+    '''
+    write a data script of about the size given
+    :file: where to write
+    :megabytes: size of the script
+    '''
+    size, i = 0, 0
+    while size < megabytes * 1024 * 1024:
+        lines = ''.join(LINE.format(i + j) for j in range(1000))
+        file.write(lines)
+        size += len(lines)
+        i += 1000
+    file.write('(print record)\n')
+
+def run(args: list[str]) -> tuple[float, float]:
+    '''
+    run main.py and measure it
+    :args: arguments of main.py
+    :returns: the seconds it took and its peak resident memory in megabytes
+    '''
+    start = perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py'), *args], stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = perf_counter() - start
+    assert status == 0, status
+    return seconds, usage.ru_maxrss / 1024
+
+def main():
+    '''Driver Code'''
+    arg_parser = ArgumentParser(description='Run a generated data script with and without --mmap')
+    arg_parser.add_argument('megabytes', nargs='?', type=int, default=MEGABYTES, help='size of the script')
+    megabytes = arg_parser.parse_args().megabytes
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file:
+        write_script(file, megabytes)
+    try:
+        results = {}
+        for name, args in (('text', []), ('mmap', ['--mmap']), ('text, cached', ['--cache-dir', tempfile.gettempdir()])):
+            results[name] = seconds, peak = run([*args, file.name])
+            print(f'{name:>12} ({megabytes}MB): {seconds:.2f}s, peak memory {peak:.1f}MB')
+    finally:
+        os.remove(file.name)
+    (text_seconds, text_peak), (mmap_seconds, mmap_peak) = results['text'], results['mmap']
+    # the text path streams the file too, so the map only saves decoding what is not a name or a string
+    print(f'mmap against streamed text: {mmap_seconds / text_seconds:.2f}x the time, {mmap_peak - text_peak:+.1f}MB peak memory')
+
+if __name__ == '__main__':
+    main()
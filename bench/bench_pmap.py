@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark pmap against fore for an expensive user defined function as the number of workers grows
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from timeit import timeit
+from interpret import interpret
+from symbol_table import new_symbol_table
+import parallel
+
+ITEMS = 64
+WORK = 20000
+
+DEFINITIONS = f'''
+(def work (n) (nop
+    (= total 0)
+    (for i ({WORK}) (+= total (% (* i n) 7)))
+    total))
+(= items (lst))
+(for i ({ITEMS}) (append items i))
+'''
+
+def main():
+    '''Driver Code'''
+    symbol_table = new_symbol_table()
+    interpret(DEFINITIONS, symbol_table)
+    expected = interpret('(= results (lst)) (fore x items (append results (work x))) results', symbol_table)
+    serial = timeit(lambda: interpret('(fore x items (work x))', symbol_table), number=1)
+    print(f'{ITEMS} calls, fore: {serial:.3f}s')
+    cpus = os.cpu_count() or 1
+    if cpus < 2:
+        print(f'only {cpus} cpu, pmap needs more than one to run faster than fore')
+    workers = 1
+    while True:
+        parallel.set_max_workers(workers)
+        assert interpret('(pmap work items)', symbol_table) == expected
+        seconds = timeit(lambda: interpret('(pmap work items)', symbol_table), number=1)
+        print(f'{workers:>3} workers, pmap: {seconds:.3f}s ({serial / seconds:.2f}x)')
+        if workers >= cpus:
+            break
+        workers = min(workers * 2, cpus)
+    parallel.set_max_workers(None)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark a loop printing millions of lines through python's print and through
+the buffered output with each flush policy, writing to an unbuffered and to a
+buffered file the way stdout is with and without PYTHONUNBUFFERED
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from argparse import ArgumentParser
+from time import perf_counter
+from contextlib import redirect_stdout
+import io
+from interpret import evaluate
+from output import Output, LINE, SIZE, EXIT
+from symbol_table import new_symbol_table
+
+LINES = 10_000_000
+
+def open_null(buffered: bool) -> io.TextIOWrapper:
+    '''
+    open the null device as text
+    :buffered: keep writes in a buffer instead of making a system call for each one
+    '''
+    if buffered:
+        return open(os.devnull, 'w')
+    return io.TextIOWrapper(open(os.devnull, 'wb', buffering=0), write_through=True)
+
+def run(lines: int, buffered: bool, policy: str | None) -> float:
+    '''
+    time the loop
+    :lines: lines printed
+    :buffered: if the file is buffered
+    :policy: flush policy of the output, python's print if None
+    :returns: seconds it took
+    '''
+    symbol_table = new_symbol_table()
+    with open_null(buffered) as file, redirect_stdout(file):
+        if policy is None:
+            symbol_table['print'] = print
+        else:
+            Output(file, policy).install(symbol_table)
+        start = perf_counter()
+        evaluate(f'(for i ({lines}) (print i))', symbol_table)
+        if policy is not None:
+            symbol_table['flush']()
+        file.flush()
+        return perf_counter() - start
+
+def main():
+    '''Driver Code'''
+    arg_parser = ArgumentParser(description='Time printing lines with python\'s print and each flush policy')
+    arg_parser.add_argument('lines', nargs='?', type=int, default=LINES, help='lines printed by each run')
+    lines = arg_parser.parse_args().lines
+    for buffered in (False, True):
+        kind = 'buffered' if buffered else 'unbuffered'
+        for policy in (None, LINE, SIZE, EXIT):
+            seconds = run(lines, buffered, policy)
+            print(f'{kind:>10} file, {policy or "print":>5}: {seconds:.2f}s, {lines / seconds / 1e6:.2f}M lines/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark the character scanner against the pattern based scanner on large inputs
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from timeit import timeit
+import scanner as sc
+
+LINE = "(print (add (mul 2.5 8) counter) 'a string with \\'escapes\\'' some_identifier True)\n"
+LONG_STRING = "(print '" + 'x' * 1_000_000 + "')\n"
+
+def count(tokens) -> int:
+    total = 0
+    for _ in tokens:
+        total += 1
+    return total
+
+def main():
+    '''Driver Code'''
+    inputs = {
+        'mixed': LINE * (4_000_000 // len(LINE)),
+        'long string': LONG_STRING * 4,
+    }
+    for name, string in inputs.items():
+        size = len(string) / 1e6
+        slow = timeit(lambda: count(sc.scanner_gen(string)), number=1)
+        fast = timeit(lambda: count(sc.fast_scanner_gen(string)), number=1)
+        print(f'{name:>12} ({size:.1f}MB): scanner_gen {slow:.2f}s fast_scanner_gen {fast:.2f}s ({slow / fast:.1f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+'''
+Load test the interpreter server with many concurrent clients and compare it to starting a process per program
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from time import perf_counter, sleep
+import subprocess
+import tempfile
+import asyncio
+import json
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+CLIENTS = 50
+REQUESTS = 40
+SPAWNS = 20
+PROGRAM = '(def f (n) (* n n)) (= total 0) (for i (100) (+= total (f i))) (print total) total'
+
+async def client(path: str, latencies: list[float]):
+    '''
+    send requests one after another on one connection
+    :path: file of the server socket
+    :latencies: list to add the seconds of each request to
+    '''
+    reader, writer = await asyncio.open_unix_connection(path)
+    for i in range(REQUESTS):
+        start = perf_counter()
+        writer.write(json.dumps({'id': i, 'program': PROGRAM}).encode() + b'\n')
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        assert response['error'] is None, response['error']
+        latencies.append(perf_counter() - start)
+    writer.close()
+    await writer.wait_closed()
+
+async def load(path: str) -> tuple[list[float], float]:
+    '''
+    run every client at once
+    :path: file of the server socket
+    :returns: the latency of every request and the total seconds
+    '''
+    latencies = []
+    start = perf_counter()
+    await asyncio.gather(*(client(path, latencies) for _ in range(CLIENTS)))
+    return latencies, perf_counter() - start
+
+def spawn_seconds() -> float:
+    '''get the average seconds to run the program by starting main.py'''
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file:
+        file.write(PROGRAM)
+    try:
+        start = perf_counter()
+        for _ in range(SPAWNS):
+            subprocess.run([sys.executable, os.path.join(ROOT, 'main.py'), file.name], check=True, stdout=subprocess.DEVNULL)
+        return (perf_counter() - start) / SPAWNS
+    finally:
+        os.remove(file.name)
+
+def main():
+    '''Driver Code'''
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py'), '--socket', path])
+    try:
+        while not os.path.exists(path):
+            sleep(0.05)
+        latencies, seconds = asyncio.run(load(path))
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    count = len(latencies)
+    print(f'{CLIENTS} clients x {REQUESTS} requests: {count / seconds:.0f} requests/s')
+    print(f'latency p50 {latencies[count // 2] * 1e3:.2f}ms p99 {latencies[count * 99 // 100] * 1e3:.2f}ms')
+    print(f'process per program: {spawn_seconds() * 1e3:.2f}ms')
+
+if __name__ == '__main__':
+    main()
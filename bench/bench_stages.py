@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+'''
+Time the preprocessor, scanner, parser, compiler and compiled evaluation that
+evaluate runs on their own for each generated workload, write the times as json
+and compare them to a baseline
+the run fails if a stage got slower than the baseline by more than the threshold
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from argparse import ArgumentParser
+from timeit import repeat
+from typing import Callable
+import platform
+import json
+from preprocess import preprocess
+from interpret import compile_tree, shadowed_names
+from symbol_table import new_symbol_table
+from workloads import WORKLOADS
+import scanner as sc
+import parser as ps
+import optimize as opt
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+STAGES = ('preprocess', 'scan', 'parse', 'compile', 'eval')
+# a stage this much slower than the baseline is a regression
+THRESHOLD = 0.25
+# stages faster than this in the baseline are too quick to compare
+MIN_SECONDS = 0.001
+
+def count(tokens) -> int:
+    total = 0
+    for _ in tokens:
+        total += 1
+    return total
+
+def best(run: Callable[[], any], repeats: int) -> float:
+    '''
+    get the fastest of several runs, the others were slowed down by something else
+    :run: the code to time
+    :repeats: number of runs
+    '''
+    return min(repeat(run, number=1, repeat=repeats))
+
+def time_stages(source: str, repeats: int) -> dict[str, float]:
+    '''
+    time each stage of running a program the way evaluate does, every stage gets the
+    output of the one before it
+    parse includes scanning with the pattern scanner, compile includes optimizing the
+    tree and eval runs the compiled program in a new symbol table
+    :source: the program
+    :repeats: runs of each stage, the fastest is kept
+    '''
+    preprocessed = preprocess(source)
+    node = ps.program(preprocessed, preprocessed=True)
+    def compile_program():
+        optimized = opt.optimize(node, shadowed_names(node), complete=True)
+        return compile_tree(optimized, new_symbol_table())
+    compiled = compile_program()
+    return {
+        'preprocess': best(lambda: preprocess(source), repeats),
+        'scan': best(lambda: count(sc.scan_offsets((preprocessed,))), repeats),
+        'parse': best(lambda: ps.program(preprocessed, preprocessed=True), repeats),
+        'compile': best(compile_program, repeats),
+        'eval': best(lambda: compiled(new_symbol_table()), repeats),
+    }
+
+def compare(results: dict[str, any], baseline: dict[str, any], threshold: float) -> list[str]:
+    '''
+    find the stages that got slower than the baseline by more than the threshold
+    workloads and stages missing from the baseline or too quick to compare are skipped
+    :results: times of this run
+    :baseline: times of an earlier run
+    :threshold: fraction a stage may get slower by
+    :returns: a description of each regression
+    '''
+    if results['scale'] != baseline['scale']:
+        raise ValueError(f'the baseline was run at scale {baseline["scale"]}, not {results["scale"]}')
+    regressions = []
+    for name, stages in results['workloads'].items():
+        before = baseline['workloads'].get(name, {})
+        for stage, seconds in stages.items():
+            if before.get(stage, 0.0) < MIN_SECONDS:
+                continue
+            change = seconds / before[stage] - 1
+            if change > threshold:
+                regressions.append(f'{name} {stage}: {before[stage]:.4f}s -> {seconds:.4f}s ({change:+.0%})')
+    return regressions
+
+def main():
+    '''Driver Code'''
+    arg_parser = ArgumentParser(description='Time each stage of running generated programs')
+    arg_parser.add_argument('workloads', nargs='*', help=f'workloads to run out of {", ".join(WORKLOADS)}, all of them if none are given')
+    arg_parser.add_argument('--scale', type=float, default=1.0, help='size of the generated programs')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='runs of each stage, the fastest is kept')
+    arg_parser.add_argument('--output', help='file to write the times to as json')
+    arg_parser.add_argument('--baseline', default=BASELINE, help='json times of an earlier run to compare to')
+    arg_parser.add_argument('--threshold', type=float, default=THRESHOLD, help='fraction a stage may get slower than the baseline by')
+    args = arg_parser.parse_args()
+    unknown = set(args.workloads) - WORKLOADS.keys()
+    if unknown:
+        arg_parser.error(f'unknown workloads: {" ".join(sorted(unknown))}')
+    results = {'python': platform.python_version(), 'scale': args.scale, 'workloads': {}}
+    print(f'{"workload":>10} {"size":>10}', *(f'{stage:>10}' for stage in STAGES))
+    for name in args.workloads or WORKLOADS:
+        source = WORKLOADS[name](args.scale)
+        stages = results['workloads'][name] = time_stages(source, args.repeat)
+        print(f'{name:>10} {len(source):>10}', *(f'{seconds:>9.4f}s' for seconds in stages.values()))
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+            file.write('\n')
+    if not os.path.exists(args.baseline) or os.path.abspath(args.baseline) == os.path.abspath(args.output or ''):
+        return
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    try:
+        regressions = compare(results, baseline, args.threshold)
+    except ValueError as e:
+        sys.exit(f'cannot compare: {e}')
+    for regression in regressions:
+        print(f'regression: {regression}')
+    if regressions:
+        sys.exit(1)
+    print(f'no stage is more than {args.threshold:.0%} slower than {args.baseline}')
+
+if __name__ == '__main__':
+    main()
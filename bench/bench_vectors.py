@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark summing and scaling a list built one item at a time against the vector builtins
+'''
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from timeit import timeit
+from interpret import interpret
+
+SIZE = 1000000
+
+LIST_PROGRAM = f'''
+(= items (lst))
+(for i ({SIZE}) (append items i))
+(= total 0)
+(fore x items (+= total (* x 2)))
+total
+'''
+
+VECTOR_PROGRAM = f'''
+(= items (range_vec {SIZE}))
+(sum (mul items 2))
+'''
+
+def main():
+    '''Driver Code'''
+    assert interpret(LIST_PROGRAM) == interpret(VECTOR_PROGRAM)
+    lists = timeit(lambda: interpret(LIST_PROGRAM), number=1)
+    vectors = timeit(lambda: interpret(VECTOR_PROGRAM), number=1)
+    print(f'{SIZE} items: lists {lists:.3f}s vectors {vectors:.3f}s ({lists / vectors:.0f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+'''
+Generate programs for the benchmarks to run
+every workload takes a scale, the size of the program or the work it does grows
+with it, and the same scale always gives the same program
+'''
+
+from typing import Callable
+import random
+
+def large_program(scale: float = 1.0) -> str:
+    '''
+    many small commented functions each called once, like a big generated program
+    :scale: size of the program
+    '''
+    rng = random.Random(0)
+    lines = ['(= total 0)']
+    for i in range(int(2000 * scale)):
+        a, b = rng.randrange(1, 100), rng.randrange(1, 100)
+        lines.append(f'// function {i} of the generated program')
+        lines.append(f'(def f{i} (x y) (if (< x y) (+ (* x {a}) y) (nop (= z (- x y)) (mod z {b}))))')
+        lines.append(f"(+= total (f{i} {rng.randrange(100)} {rng.randrange(100)})) (= name{i} 'value {i}')")
+    lines.append('total')
+    return '\n'.join(lines)
+
+def macro_program(scale: float = 1.0) -> str:
+    '''
+    a program that is mostly uses of macros
+    :scale: number of macros and of lines using them
+    '''
+    count = max(1, int(200 * scale))
+    lines = [f'#def m{i} (+ x {i})' for i in range(count)]
+    lines.append('(= x 1) (= total 0)')
+    for j in range(int(2000 * scale)):
+        lines.append(' '.join(f'(+= total m{(j * 7 + k) % count})' for k in range(4)))
+    lines.append('total')
+    return '\n'.join(lines)
+
+def recursion_program(scale: float = 1.0) -> str:
+    '''
+    deep tail recursion and a tree of recursive calls
+    :scale: depth of the tail recursion
+    '''
+    return f'''(def count (n acc) (if (== n 0) acc (count (- n 1) (+ acc 1))))
+(def fib (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+(+ (count {int(50000 * scale)} 0) (fib 16))'''
+
+def loop_program(scale: float = 1.0) -> str:
+    '''
+    tight while and for loops
+    :scale: iterations of each loop
+    '''
+    count = int(50000 * scale)
+    return f'''(= i 0) (= total 0)
+(while (< i {count}) (nop (+= total (* i 2)) (++ i)))
+(for j ({count}) (+= total (mod j 7)))
+total'''
+
+def list_program(scale: float = 1.0) -> str:
+    '''
+    lists built by appending, adding and from a long literal
+    :scale: number of items
+    '''
+    count = int(50000 * scale)
+    literal = ' '.join(map(str, range(int(5000 * scale))))
+    return f'''(= items (lst))
+(for i ({count}) (append items i))
+(= more (lst))
+(for i ({count // 100}) (+= more (lst i i i)))
+(= literal (lst {literal}))
+(+ (len items) (len more) (len literal))'''
+
+WORKLOADS: dict[str, Callable[[float], str]] = {
+    'large': large_program,
+    'macros': macro_program,
+    'recursion': recursion_program,
+    'loops': loop_program,
+    'lists': list_program,
+}
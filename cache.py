@@ -0,0 +1,103 @@
+'''
+Cache parsed programs by the hash of their preprocessed source
+'''
+
+from collections import OrderedDict
+from preprocess import preprocess
+from hashlib import sha256
+import parser as ps
+import pickle
+import os
+
+# change when the shape of the tree changes so old files on disk are ignored
+CACHE_VERSION = 4
+
+class ProgramCache:
+    '''
+    A least recently used cache of parsed programs with an optional directory on disk
+    programs are keyed on their preprocessed source so a change to any included file
+    gives a new key
+    '''
+    def __init__(self, maxsize: int = 128, directory: str | None = None):
+        '''
+        :maxsize: most programs kept in memory
+        :directory: where to keep pickled programs between runs, not kept on disk if None
+        '''
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.directory = directory
+        self.entries: OrderedDict[str, ps.Node] = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(source: str) -> str:
+        '''
+        get the key of preprocessed source
+        :source: preprocessed source
+        '''
+        return sha256(f'{CACHE_VERSION}\0{source}'.encode()).hexdigest()
+
+    def program(self, string: str) -> ps.Node:
+        '''
+        preprocess and parse a program, reusing the tree if the source was seen before
+        :string: source of the program
+        '''
+        source = preprocess(string)
+        key = self.key(source)
+        node = self.entries.get(key)
+        if node is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return node
+        node = self._load(key)
+        if node is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            node = ps.program(source, preprocessed=True)
+            self._store(key, node)
+        self.entries[key] = node
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return node
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def _load(self, key: str) -> ps.Node | None:
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+
+    def _store(self, key: str, node: ps.Node):
+        if self.directory is None:
+            return
+        path = self._path(key)
+        temp = f'{path}.{os.getpid()}.tmp'
+        with open(temp, 'wb') as f:
+            pickle.dump(node, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)
+
+    def info(self) -> dict[str, int]:
+        '''get the hit and miss counts of the cache'''
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+        }
+
+    def clear(self):
+        '''empty the cache in memory, leaving files on disk'''
+        self.entries.clear()
+        self.hits = self.disk_hits = self.misses = 0
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+'''
+Sends a program to a running interpreter server and prints what it returns
+'''
+
+from argparse import ArgumentParser
+from server import DEFAULT_SOCKET
+import socket
+import json
+import sys
+
+def send(program: str, path: str = DEFAULT_SOCKET, session: str | None = None, timeout: float | None = None) -> dict[str, any]:
+    '''
+    run a program on the server
+    :program: source of the program
+    :path: file of the server's socket
+    :session: name of the symbol table to run in, a new one is used if None
+    :timeout: seconds the program may run, the server's default if None
+    :returns: the response with the result, output and error of the program
+    '''
+    request = {'id': 0, 'program': program, 'session': session, 'timeout': timeout}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        connection.sendall(json.dumps(request).encode() + b'\n')
+        with connection.makefile('rb') as responses:
+            return json.loads(responses.readline())
+
+def main():
+    '''Driver Code'''
+    arg_parser = ArgumentParser(description='Run a program on an interpreter server')
+    arg_parser.add_argument('file', nargs='?', help='program to run, read from stdin if not given')
+    arg_parser.add_argument('--socket', default=DEFAULT_SOCKET, help='file of the server socket')
+    arg_parser.add_argument('--session', help='keep variables between runs that use the same session')
+    arg_parser.add_argument('--timeout', type=float, help='seconds the program may run')
+    args = arg_parser.parse_args()
+    if args.file is None:
+        program = sys.stdin.read()
+    else:
+        with open(args.file, 'r') as file:
+            program = file.read()
+    response = send(program, args.socket, args.session, args.timeout)
+    print(response['output'], end='')
+    if response['error'] is not None:
+        print(response['error'], file=sys.stderr)
+        sys.exit(1)
+    if response['result'] is not None:
+        print(response['result'])
+
+if __name__ == '__main__':
+    main()
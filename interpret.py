@@ -2,42 +2,289 @@
 Evaluate and execute an abstract syntax program
 '''
 
+from typing import Callable, Iterable
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic
+import threading
+import sys
 from preprocess import PreprocesserException
 from scanner import ScannerException
 from parser import ParserException
-from copy import deepcopy
+from cache import ProgramCache
+from profiler import Profiler
+from output import STDOUT
+from source_map import SourceMap, SourceError
+import operator as op
+import mmap
 import parser as ps
-from symbol_table import new_symbol_table, copy_table, KEYWORDS
-class InterpretException(Exception): pass
+import scanner as sc
+import optimize as opt
+from symbol_table import Env, BUILTINS, new_symbol_table, KEYWORDS
+class InterpretException(SourceError): pass
 
-def interpret(string: str, symbol_table: dict[str, any] | None = None) -> any:
+# errors a program can fail with
+ERRORS = (ScannerException, ParserException, InterpretException, PreprocesserException)
+
+class LimitExceeded(InterpretException):
+    '''A program ran more steps, deeper calls or for longer than it was allowed'''
+    def __init__(self, reason: str, steps: int, depth: int, seconds: float):
+        super().__init__(f'{reason} after {steps} steps, {seconds:.3f}s and a call depth of {depth}')
+        self.steps = steps
+        self.depth = depth
+        self.seconds = seconds
+
+@dataclass(slots=True)
+class Limits:
+    steps: int | None = None     # most loop iterations and function calls
+    depth: int | None = None     # most calls running at once
+    seconds: float | None = None # most seconds to run for
+
+# steps between reading the clock when there is a deadline
+CLOCK_INTERVAL = 1024
+# python frames one call of a user function can take, with the cache and profiler around it
+FRAMES_PER_CALL = 8
+# python frames kept for what runs the program and for the builtins it calls
+FRAMES_SPARE = 1000
+# deepest call depth a limit can allow
+MAX_DEPTH = 100_000
+
+class Budget:
+    '''
+    What a running program has used of its limits
+    a step only adds one and compares, the limits are checked once the count
+    reaches stop
+    '''
+    __slots__ = ('limits', 'steps', 'depth', 'max_depth', 'start', 'stop')
+
+    def __init__(self, limits: Limits):
+        self.limits = limits
+        self.steps = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.start = monotonic()
+        self.stop = 0
+
+    def tick(self):
+        '''count a step'''
+        self.steps += 1
+        if self.steps >= self.stop:
+            self.check()
+
+    def enter(self):
+        '''count a call'''
+        self.depth += 1
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+            if self.limits.depth is not None and self.depth > self.limits.depth:
+                self.exceeded(f'call depth of {self.limits.depth} exceeded')
+        self.tick()
+
+    def check(self):
+        '''raise if a limit is exceeded and work out the step to check again at'''
+        limits = self.limits
+        stop = float('inf')
+        if limits.steps is not None:
+            if self.steps > limits.steps:
+                self.exceeded(f'step budget of {limits.steps} exceeded')
+            stop = limits.steps + 1
+        if limits.seconds is not None:
+            if monotonic() - self.start > limits.seconds:
+                self.exceeded(f'time limit of {limits.seconds}s exceeded')
+            stop = min(stop, self.steps + CLOCK_INTERVAL)
+        self.stop = stop
+
+    def exceeded(self, reason: str):
+        raise LimitExceeded(reason, self.steps, self.max_depth, monotonic() - self.start)
+
+class _Running(threading.local):
+    # budget of the program running on this thread, functions defined under limits
+    # that are called later without them count against one that is never checked
+    budget = Budget(Limits())
+
+_running = _Running()
+
+def run_limited(run: Callable[[], any], limits: Limits) -> any:
+    '''
+    call a function with a budget for the programs it runs on this thread
+    :run: runs the program
+    :limits: what the program may use
+    '''
+    if limits.depth is not None:
+        if not 0 <= limits.depth <= MAX_DEPTH:
+            raise InterpretException(f'Expected a call depth limit from 0 to {MAX_DEPTH} but found {limits.depth}')
+        # the depth limit has to be reached before python's, which is only ever
+        # raised since programs on other threads may need it
+        frames = limits.depth * FRAMES_PER_CALL + FRAMES_SPARE
+        if sys.getrecursionlimit() < frames:
+            sys.setrecursionlimit(frames)
+    budget = Budget(limits)
+    budget.check()
+    previous, _running.budget = _running.budget, budget
+    try:
+        return run()
+    except RecursionError:
+        budget.exceeded('python recursion limit reached')
+    finally:
+        _running.budget = previous
+
+def run_with(run: Callable[[], any], limits: Limits | None, profile: Profiler | None) -> any:
+    '''
+    call a function that runs a program under the limits and profiler given
+    :run: runs the program
+    :limits: what the program may use
+    :profile: records where the program spends its time
+    '''
+    if profile is not None:
+        run = lambda run=run: profile.run(run)
+    return run() if limits is None else run_limited(run, limits)
+
+def interpret(string: str, symbol_table: Env | None = None, cache: ProgramCache | None = None, optimize: bool = True, limits: Limits | None = None, profile: Profiler | None = None, path: str | None = None) -> any:
+    '''
+    interpret and execute a string, printing any error with the line it happened on
+    :string: str to execute
+    :symbol_table: global frame to execute in, a new one is made if not given
+    :cache: cache to get the parsed program from
+    :optimize: simplify the tree before running it
+    :limits: steps, call depth and seconds the program may use
+    :profile: records where the program spends its time
+    :path: file the program came from, used to say where errors happened
+    '''
+    try:
+        return evaluate(string, symbol_table, cache, optimize, limits, profile, path)
+    except ERRORS as e:
+        print(e.report())
+
+def evaluate(string: str, symbol_table: Env | None = None, cache: ProgramCache | None = None, optimize: bool = True, limits: Limits | None = None, profile: Profiler | None = None, path: str | None = None) -> any:
     '''
-    interpret and execute a string
+    interpret and execute a string, raising any error
     :string: str to execute
+    :symbol_table: global frame to execute in, a new one is made if not given
+    :cache: cache to get the parsed program from
+    :optimize: simplify the tree before running it
+    :limits: steps, call depth and seconds the program may use
+    :profile: records where the program spends its time
+    :path: file the program came from, used to say where errors happened
+    '''
+    complete = symbol_table is None
+    if symbol_table is None:
+        symbol_table = new_symbol_table()
+    elif not isinstance(symbol_table, Env):
+        symbol_table = Env(symbol_table, BUILTINS)
+    # only built if an error or the profiler needs it
+    source = SourceMap(path, string)
+    try:
+        node = ps.program(string) if cache is None else cache.program(string)
+        if optimize:
+            node = opt.optimize(node, shadowed_names(node, symbol_table), complete)
+        run = lambda: compile_tree(node, symbol_table, limits is not None, profile, source)(symbol_table)
+        return run_with(run, limits, profile)
+    except SourceError as e:
+        e.at(None, source)
+        raise
+    finally:
+        STDOUT.flush()
+
+def interpret_stream(lines: Iterable[str], symbol_table: Env | None = None, optimize: bool = True, limits: Limits | None = None, profile: Profiler | None = None, path: str | None = None) -> any:
+    '''
+    interpret and execute a program as it is read
+    each top level expression runs as soon as it is parsed
+    :lines: the lines of the program
+    :symbol_table: global frame to execute in, a new one is made if not given
+    :optimize: simplify each expression before running it
+    :limits: steps, call depth and seconds the whole program may use
+    :profile: records where the program spends its time
+    :path: file the program came from, used to say where errors happened
+    '''
+    source = SourceMap(path)
+    return run_stream(ps.program_stream(lines, source), source, symbol_table, optimize, limits, profile)
+
+def interpret_mapped(path: str, symbol_table: Env | None = None, optimize: bool = True, limits: Limits | None = None, profile: Profiler | None = None) -> any:
+    '''
+    interpret and execute a file as it is read through a memory map
+    a file with no directives or comments is scanned as bytes, so a very large file
+    is never decoded or held in memory whole
+    :path: the file
+    :symbol_table: global frame to execute in, a new one is made if not given
+    :optimize: simplify each expression before running it
+    :limits: steps, call depth and seconds the whole program may use
+    :profile: records where the program spends its time
+    '''
+    with open(path, 'rb') as file:
+        data = sc.map_file(file)
+    try:
+        return run_stream(*ps.mapped_program_stream(data, path), symbol_table, optimize, limits, profile)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+def run_stream(nodes: Iterable[ps.Node], source: SourceMap, symbol_table: Env | None = None, optimize: bool = True, limits: Limits | None = None, profile: Profiler | None = None) -> any:
+    '''
+    run each top level expression of a program as soon as it is parsed, printing any error
+    :nodes: the expressions
+    :source: map the offsets of the expressions are in
+    :symbol_table: global frame to execute in, a new one is made if not given
+    :optimize: simplify each expression before running it
+    :limits: steps, call depth and seconds the whole program may use
+    :profile: records where the program spends its time
     '''
     if symbol_table is None:
         symbol_table = new_symbol_table()
+    def run() -> any:
+        result = None
+        try:
+            for node in nodes:
+                if optimize:
+                    node = opt.optimize(node, shadowed_names(node, symbol_table), complete=False)
+                result = compile_tree(node, symbol_table, limits is not None, profile, source)(symbol_table)
+        finally:
+            STDOUT.flush()
+        return result
     try:
-        return eval_tree(ps.program(string), symbol_table)
-    except (ScannerException, ParserException, InterpretException, PreprocesserException) as e:
-        print(e)
+        return run_with(run, limits, profile)
+    except ERRORS as e:
+        print(e.at(None, source).report())
+
+class TailCall:
+    '''
+    A call in tail position of a function body, returned instead of made so the
+    trampoline of the function running it makes the call without the stack growing
+    '''
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function: Callable, args: list):
+        '''
+        :function: runs the body of the function called, may return another TailCall
+        :args: arguments of the call
+        '''
+        self.function = function
+        self.args = args
 
-def eval_tree(node: ps.Node, symbol_table: dict[str, any]) -> any:
+def eval_tree(node: ps.Node, symbol_table: Env, tail: bool = False) -> any:
     '''
     interpret and execute a program
     :node: tree to execute
+    :tail: the tree is in tail position of a function body, calls to user functions
+    there are returned as a TailCall
     '''
     match node:
-        case ps.ExpressionsNode(left, right):
-            ret = eval_tree(left, symbol_table)
-            if right is not None:
-                ret = eval_tree(right, symbol_table)
+        case ps.ExpressionsNode(body):
+            for expr in body:
+                ret = eval_tree(expr, symbol_table)
             return ret
         case ps.ValueNode(value=value):
             return value
         case ps.FunctionNode(name, args):
             check_symbol(name, symbol_table)
             func = symbol_table[name]
+            if tail:
+                if func is BUILTINS['nop'] and args:
+                    for arg in args[:-1]:
+                        eval_tree(arg, symbol_table)
+                    return eval_tree(args[-1], symbol_table, True)
+                bounce = getattr(func, 'bounce', None)
+                if bounce is not None:
+                    return TailCall(bounce, [eval_tree(arg, symbol_table) for arg in args])
             try:
                 return func(*map(lambda x: eval_tree(x, symbol_table), args))
             except TypeError as t:
@@ -79,21 +326,28 @@ def eval_tree(node: ps.Node, symbol_table: dict[str, any]) -> any:
             return symbol_table[name]
         case ps.IfNode(cond, block, else_block):
             if eval_tree(cond, symbol_table):
-                return eval_tree(block, symbol_table)
+                return eval_tree(block, symbol_table, tail)
             elif else_block is not None:
-                return eval_tree(else_block, symbol_table)
+                return eval_tree(else_block, symbol_table, tail)
         case ps.DefNode(name, names, body):
-            def new_function(*args):
-                nonlocal symbol_table
-                old_scope = deepcopy(symbol_table)
+            def bounce(*args):
                 if len(names) != len(args):
                     raise InterpretException(f'{name} expected {len(names)} arguments but got {len(args)}')
-                for key, value in zip(names, args):
-                    symbol_table[key] = value
-                result = eval_tree(body, symbol_table)
-                copy_table(old_scope, symbol_table)
+                # each call gets its own frame on top of the frame the function was defined in
+                return eval_tree(body, Env(dict(zip(names, args)), symbol_table), True)
+            def new_function(*args):
+                result = bounce(*args)
+                while type(result) is TailCall:
+                    result = result.function(*result.args)
                 return result
             new_function.__name__ = name
+            # wrappers below do not get this so calls to them are made as usual
+            new_function.bounce = bounce
+            if isinstance(node, ps.MemoDefNode):
+                check_memo_purity(node, symbol_table.__contains__)
+                new_function = MemoCache(node.maxsize).wrap(new_function)
+            # lets the function be compiled again in another process
+            new_function.definition = (node, symbol_table)
             symbol_table[name] = new_function
             return symbol_table[name]
         case ps.WhileNode(cond, block):
@@ -118,7 +372,666 @@ def check_in_keywords(name: str):
     if name in KEYWORDS:
         raise InterpretException(f'{name} is a keyword and cannot be assigned to')
 
-def check_symbol(name: str, symbol_table: dict[str, any]):
+def check_symbol(name: str, symbol_table: Env):
     check_in_keywords(name)
     if name not in symbol_table:
         raise InterpretException(f'{name} not in symbol table')
+
+class MemoCache:
+    '''
+    A least recently used cache of the results of a function keyed on its arguments
+    calls with unhashable arguments are not cached
+    '''
+    def __init__(self, maxsize: int):
+        '''
+        :maxsize: most results to keep, unbounded if 0
+        '''
+        self.maxsize = maxsize
+        self.entries: OrderedDict[tuple, any] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, args: tuple) -> any:
+        '''
+        get a cached result
+        raises KeyError if it is not cached and TypeError if the arguments are unhashable
+        :args: arguments of the call
+        '''
+        result = self.entries[args]
+        self.hits += 1
+        self.entries.move_to_end(args)
+        return result
+
+    def store(self, args: tuple, result: any):
+        '''
+        cache a result, evicting the least recently used one if the cache is full
+        :args: arguments of the call
+        :result: result of the call
+        '''
+        self.misses += 1
+        self.entries[args] = result
+        if self.maxsize and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def wrap(self, function: Callable) -> Callable:
+        '''
+        make a function that uses this cache
+        :function: function to cache the results of
+        '''
+        def memoized(*args):
+            try:
+                return self.lookup(args)
+            except KeyError:
+                pass
+            except TypeError:
+                return function(*args)
+            result = function(*args)
+            self.store(args, result)
+            return result
+        memoized.__name__ = function.__name__
+        memoized.memo = self
+        return memoized
+
+    def info(self) -> dict[str, int]:
+        '''get the hit and miss counts of the cache'''
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+
+    def clear(self):
+        '''empty the cache'''
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+def check_memo_purity(node: ps.MemoDefNode, visible: Callable[[str], bool]):
+    '''
+    refuse to memoize a function whose body assigns to variables from outside it
+    :node: the memoized function
+    :visible: check if a name is visible where the function is defined
+    '''
+    assigned, updated = set(), set()
+    # what a nested function assigns stays in its own frame, only the name it is bound to is written here
+    for child in ps.walk(node.body, enter_defs=False):
+        match child:
+            case ps.AssignNode(name, _) | ps.DefNode(name):
+                assigned.add(name)
+            case ps._AssignNode(name, _) | ps.IncrementNode(name) | ps.DecrementNode(name):
+                updated.add(name)
+    params = set(node.args)
+    outer = sorted(updated - assigned - params) + sorted(name for name in assigned - params if visible(name))
+    if outer:
+        raise InterpretException(f'{node.name} assigns to outer variable {outer[0]} and cannot be memoized', node.pos)
+
+def bound_names(node: ps.Node, names: set[str] | None = None, enter_defs: bool = True) -> set[str]:
+    '''
+    find every name a tree could assign to
+    :node: tree to search
+    :names: set to add the names to
+    :enter_defs: include the names bound inside nested function definitions
+    :returns: the set of names
+    '''
+    if names is None:
+        names = set()
+    match node:
+        case ps.ExpressionsNode(body):
+            for expr in body:
+                bound_names(expr, names, enter_defs)
+        case ps.FunctionNode(_, args):
+            for arg in args:
+                bound_names(arg, names, enter_defs)
+        case ps._AssignNode(name, value):
+            names.add(name)
+            bound_names(value, names, enter_defs)
+        case ps.IncrementNode(name) | ps.DecrementNode(name):
+            names.add(name)
+        case ps.IfNode(cond, block, else_block):
+            bound_names(cond, names, enter_defs)
+            bound_names(block, names, enter_defs)
+            if else_block is not None:
+                bound_names(else_block, names, enter_defs)
+        case ps.DefNode(name, args, body):
+            names.add(name)
+            if enter_defs:
+                names.update(args)
+                bound_names(body, names, enter_defs)
+        case ps.WhileNode(cond, block):
+            bound_names(cond, names, enter_defs)
+            bound_names(block, names, enter_defs)
+        case ps.ForNode(name, range_args, block):
+            names.add(name)
+            for arg in range_args:
+                bound_names(arg, names, enter_defs)
+            bound_names(block, names, enter_defs)
+        case ps.ForEachNode(name, items, block):
+            names.add(name)
+            bound_names(items, names, enter_defs)
+            bound_names(block, names, enter_defs)
+    return names
+
+Compiled = Callable[[Env], any]
+
+def compile_tree(node: ps.Node, symbol_table: Env | None = None, limited: bool = False, profile: Profiler | None = None, source: SourceMap | None = None) -> Compiled:
+    '''
+    compile a tree into a closure that executes it
+    builtins are resolved ahead of time when nothing in the tree or the
+    symbol table it will run in can shadow them
+    :node: tree to compile
+    :symbol_table: global frame the tree will run in
+    :limited: count loop iterations and calls against the budget of run_limited,
+    without it the closures have no checks at all
+    :profile: record the time of functions and loops, nothing is wrapped without it
+    :source: map of the program the tree was parsed from, errors use it to say where they happened
+    :returns: a function that executes the tree in a symbol table
+    '''
+    scope = Scope(shadowed_names(node, symbol_table), symbol_table, limited=limited, profile=profile, source=source)
+    return _compile(node, scope)
+
+def shadowed_names(node: ps.Node, symbol_table: Env | None = None) -> set[str]:
+    '''
+    find every name that could shadow a builtin while running a tree
+    :node: tree that will run
+    :symbol_table: global frame the tree will run in
+    '''
+    shadowed = bound_names(node)
+    env = symbol_table
+    while env is not None and env is not BUILTINS:
+        # only the names of builtins can shadow one, a large frame like a snapshot
+        # of a prelude is not copied whole
+        shadowed.update(dict.keys(env) & dict.keys(BUILTINS))
+        env = env.parent
+    return shadowed
+
+COMPOUND_ASSIGN_OPERATORS = {
+    ps.AddAssignNode: op.iadd,
+    ps.SubAssignNode: op.isub,
+    ps.MulAssignNode: op.imul,
+    ps.DivAssignNode: op.itruediv,
+    ps.ModAssignNode: op.imod,
+}
+
+# layout of the frame list of a compiled function call
+FRAME_PARENT = 0
+FRAME_GLOBALS = 1
+FRAME_LOCALS = 2
+
+class _Unset:
+    def __repr__(self):
+        return 'UNSET'
+# value of a local that has not been assigned yet
+UNSET = _Unset()
+
+class Scope:
+    '''
+    What the compiler knows about the names visible where a tree runs
+    the body of a function gets its own scope whose locals are stored at fixed
+    indices of a frame list, the global scope stores names in the symbol table
+    '''
+    def __init__(self, shadowed: set[str], symbol_table: Env | None, parent: 'Scope | None' = None, local_names: list[str] | None = None, limited: bool = False, profile: Profiler | None = None, source: SourceMap | None = None):
+        '''
+        :shadowed: names that may not be resolved to builtins ahead of time
+        :symbol_table: global frame the tree runs in
+        :parent: scope the function was defined in
+        :local_names: parameters and then every other name the function assigns to
+        :limited: loops and calls count against the running budget
+        :profile: records the time of functions and loops
+        :source: map of the program the tree was parsed from
+        '''
+        self.limited = limited
+        self.profile = profile
+        self.source = source
+        self.shadowed = shadowed
+        self.symbol_table = symbol_table
+        # a builtin assigned to in the global frame after compiling shadows the resolved one
+        self.shadows = frozenset().__contains__ if symbol_table is None else dict.keys(symbol_table).__contains__
+        self.parent = parent
+        self.slots = None if local_names is None else {name: i for i, name in enumerate(local_names, FRAME_LOCALS)}
+        # calls in tail position of the function body that return a TailCall
+        self.tail_calls = 0
+
+    def function(self, names: tuple[str, ...], body: ps.Node) -> 'Scope':
+        '''
+        create the scope of a function defined in this scope
+        :names: parameters of the function
+        :body: body of the function
+        '''
+        local_names = list(names) + sorted(bound_names(body, enter_defs=False) - set(names))
+        return Scope(self.shadowed, self.symbol_table, self, local_names, self.limited, self.profile, self.source)
+
+    def key(self, name: str) -> str | int:
+        '''
+        get where a name assigned in this scope is stored in the frame or symbol table
+        :name: the name assigned to
+        '''
+        return name if self.slots is None else self.slots[name]
+
+    def outer_locals(self) -> set[str]:
+        '''get every name that is a local of this scope or a scope around it'''
+        names = set()
+        scope = self
+        while scope.slots is not None:
+            names.update(scope.slots)
+            scope = scope.parent
+        return names
+
+def check_assignable(name: str, pos: int | None = None, source: SourceMap | None = None):
+    if name in KEYWORDS:
+        raise InterpretException(f'{name} is a keyword and cannot be assigned to', pos, source)
+
+def _compile_load(name: str, scope: Scope, pos: int | None = None) -> Compiled:
+    '''
+    compile looking up a name
+    a local is loaded from its index in the frame, falling back to the scope
+    around it if it has not been assigned yet
+    :name: the name to look up
+    :scope: where the name is looked up
+    :pos: where the name is in the source
+    '''
+    source = scope.source
+    check_assignable(name, pos, source)
+    if scope.slots is None:
+        def load_global(env: Env) -> any:
+            try:
+                return env[name]
+            except KeyError:
+                raise InterpretException(f'{name} not in symbol table', pos, source) from None
+        return load_global
+    if name in scope.slots:
+        index = scope.slots[name]
+        fallback = _compile_load(name, scope.parent, pos)
+        def load_local(frame: list) -> any:
+            value = frame[index]
+            if value is UNSET:
+                return fallback(frame[FRAME_PARENT])
+            return value
+        return load_local
+    if name not in scope.outer_locals():
+        def load_global(frame: list) -> any:
+            try:
+                return frame[FRAME_GLOBALS][name]
+            except KeyError:
+                raise InterpretException(f'{name} not in symbol table', pos, source) from None
+        return load_global
+    outer = _compile_load(name, scope.parent, pos)
+    def load_outer(frame: list) -> any:
+        return outer(frame[FRAME_PARENT])
+    return load_outer
+
+def _compile(node: ps.Node, scope: Scope, tail: bool = False) -> Compiled:
+    '''
+    compile a tree into a closure
+    the closure takes the symbol table in the global scope and the frame list in a function
+    :node: tree to compile
+    :scope: names visible where the tree runs
+    :tail: the tree is in tail position of a function body
+    '''
+    match node:
+        case ps.ExpressionsNode(body):
+            body = [_compile(expr, scope) for expr in body]
+            if len(body) == 1:
+                return body[0]
+            def expressions(env: Env) -> any:
+                for expr in body:
+                    ret = expr(env)
+                return ret
+            return expressions
+        case ps.ValueNode(value=value):
+            return lambda env: value
+        case ps.FunctionNode(name, args) if tail:
+            return _compile_tail_call(node, scope)
+        case ps.FunctionNode(name, args):
+            return _compile_call(name, [_compile(arg, scope) for arg in args], scope, node.pos)
+        case ps.AssignNode(name, value):
+            check_assignable(name, node.pos, scope.source)
+            key = scope.key(name)
+            value = _compile(value, scope)
+            def assign(env: Env) -> any:
+                env[key] = result = value(env)
+                return result
+            return assign
+        case ps._AssignNode(name, value):
+            load, key = _compile_load(name, scope, node.pos), scope.key(name)
+            operator = COMPOUND_ASSIGN_OPERATORS[type(node)]
+            value = _compile(value, scope)
+            def compound_assign(env: Env) -> any:
+                env[key] = result = operator(load(env), value(env))
+                return result
+            return compound_assign
+        case ps.IncrementNode(name) | ps.DecrementNode(name):
+            load, key = _compile_load(name, scope, node.pos), scope.key(name)
+            step = 1 if isinstance(node, ps.IncrementNode) else -1
+            def increment(env: Env) -> any:
+                env[key] = result = load(env) + step
+                return result
+            return increment
+        case ps.IdentNode(name):
+            return _compile_load(name, scope, node.pos)
+        case ps.IfNode(cond, block, None):
+            cond, block = _compile(cond, scope), _compile(block, scope, tail)
+            def if_(env: Env) -> any:
+                if cond(env):
+                    return block(env)
+            return if_
+        case ps.IfNode(cond, block, else_block):
+            cond, block = _compile(cond, scope), _compile(block, scope, tail)
+            else_block = _compile(else_block, scope, tail)
+            def if_else(env: Env) -> any:
+                if cond(env):
+                    return block(env)
+                return else_block(env)
+            return if_else
+        case ps.DefNode(name, names, body):
+            return _compile_def(node, scope)
+        case ps.WhileNode(cond, block):
+            return _compile_while(node, _compile(cond, scope), _compile(block, scope), scope)
+        case ps.ForNode(name, range_args, block):
+            key = scope.key(name)
+            range_args = [_compile(arg, scope) for arg in range_args]
+            items = lambda env: range(*[arg(env) for arg in range_args])
+            return _compile_loop(node, 'for', key, items, _compile(block, scope), scope)
+        case ps.ForEachNode(name, items, block):
+            return _compile_loop(node, 'fore', scope.key(name), _compile(items, scope), _compile(block, scope), scope)
+    raise InterpretException(f'Cannot compile {node}', node.pos, scope.source)
+
+def _compile_while(node: ps.WhileNode, cond: Compiled, block: Compiled, scope: Scope) -> Compiled:
+    '''
+    compile a while loop
+    :node: the loop
+    :cond: checked before each iteration
+    :block: body of the loop
+    :scope: where the loop runs
+    '''
+    profile = scope.profile
+    if profile is not None:
+        block = profile.count(block, node, 'while', scope.source)
+    if scope.limited:
+        pos, source = node.pos, scope.source
+        def while_(env: Env) -> any:
+            tick = _running.budget.tick
+            last = None
+            try:
+                while cond(env):
+                    tick()
+                    last = block(env)
+            except LimitExceeded as e:
+                e.at(pos, source)
+                raise
+            return last
+    else:
+        def while_(env: Env) -> any:
+            last = None
+            while cond(env):
+                last = block(env)
+            return last
+    return while_ if profile is None else profile.time(while_, node, 'while', scope.source)
+
+def _compile_loop(node: ps.Node, kind: str, key: str | int, items: Compiled, block: Compiled, scope: Scope) -> Compiled:
+    '''
+    compile a loop assigning each item to a name
+    :node: the loop
+    :kind: the name of the loop
+    :key: where the name is stored
+    :items: gets the items to loop over
+    :block: body of the loop
+    :scope: where the loop runs
+    '''
+    profile = scope.profile
+    if profile is not None:
+        block = profile.count(block, node, kind, scope.source)
+    if scope.limited:
+        pos, source = node.pos, scope.source
+        def for_each(env: Env) -> any:
+            tick = _running.budget.tick
+            last = None
+            try:
+                for i in items(env):
+                    tick()
+                    env[key] = i
+                    last = block(env)
+            except LimitExceeded as e:
+                e.at(pos, source)
+                raise
+            return last
+    else:
+        def for_each(env: Env) -> any:
+            last = None
+            for i in items(env):
+                env[key] = i
+                last = block(env)
+            return last
+    return for_each if profile is None else profile.time(for_each, node, kind, scope.source)
+
+def _compile_def(node: ps.DefNode, scope: Scope) -> Compiled:
+    '''
+    compile a function definition
+    each call gets a frame list holding the frame it was defined in, the global
+    symbol table and its locals
+    :node: the function definition
+    :scope: where the function is defined
+    '''
+    name, names = node.name, node.args
+    function_scope = scope.function(names, node.body)
+    body = _compile(node.body, function_scope, True)
+    trampoline = function_scope.tail_calls > 0
+    key = scope.key(name)
+    count = len(names)
+    unset = (UNSET,) * (len(function_scope.slots) - count)
+    in_function = scope.slots is not None
+    outer_locals = scope.outer_locals()
+    memo = node.maxsize if isinstance(node, ps.MemoDefNode) else None
+    limited, profile, source = scope.limited, scope.profile, scope.source
+    def define(env: Env) -> any:
+        symbol_table = env[FRAME_GLOBALS] if in_function else env
+        def bounce(*args):
+            if len(args) != count:
+                raise InterpretException(f'{name} expected {count} arguments but got {len(args)}')
+            return body([env, symbol_table, *args, *unset])
+        if limited and trampoline:
+            # a tail call is a step but does not go deeper
+            def new_function(*args):
+                budget = _running.budget
+                budget.enter()
+                try:
+                    result = bounce(*args)
+                    while type(result) is TailCall:
+                        budget.tick()
+                        result = result.function(*result.args)
+                    return result
+                finally:
+                    budget.depth -= 1
+        elif trampoline:
+            def new_function(*args):
+                if len(args) != count:
+                    raise InterpretException(f'{name} expected {count} arguments but got {len(args)}')
+                result = body([env, symbol_table, *args, *unset])
+                while type(result) is TailCall:
+                    result = result.function(*result.args)
+                return result
+        elif limited:
+            def new_function(*args):
+                if len(args) != count:
+                    raise InterpretException(f'{name} expected {count} arguments but got {len(args)}')
+                budget = _running.budget
+                budget.enter()
+                try:
+                    return body([env, symbol_table, *args, *unset])
+                finally:
+                    budget.depth -= 1
+        else:
+            new_function = bounce
+        new_function.__name__ = name
+        # the cache and profiler wrappers below do not get this so calls to them are made as usual
+        new_function.bounce = bounce
+        if memo is not None:
+            check_memo_purity(node, lambda name: name in outer_locals or name in symbol_table)
+            new_function = MemoCache(memo).wrap(new_function)
+        if profile is not None:
+            new_function = profile.function(new_function, node, source)
+        # lets the function be compiled again in another process, the locals it closes over cannot be sent
+        new_function.definition = None if in_function else (node, symbol_table)
+        env[key] = new_function
+        return new_function
+    return define
+
+def _compile_tail_call(node: ps.FunctionNode, scope: Scope) -> Compiled:
+    '''
+    compile a call in tail position of a function body
+    a call to a user function returns a TailCall for the trampoline of the function
+    running it to make, the last argument of a nop is in tail position too
+    builtins and functions wrapped by a cache or the profiler are called as usual
+    :node: the call
+    :scope: scope of the function body
+    '''
+    name, pos, source = node.ident, node.pos, scope.source
+    args = [_compile(arg, scope) for arg in node.arguments]
+    if name not in scope.shadowed and name in BUILTINS:
+        call = _compile_call(name, args, scope, pos)
+        if name != 'nop' or not args:
+            return call
+        rest, last = args[:-1], _compile(node.arguments[-1], scope, True)
+        shadows = scope.shadows
+        def tail_nop(env: Env) -> any:
+            if shadows(name):
+                return call(env)
+            try:
+                for arg in rest:
+                    arg(env)
+                return last(env)
+            except SourceError as e:
+                e.at(pos, source)
+                raise
+        return tail_nop
+    load = _compile_load(name, scope, pos)
+    scope.tail_calls += 1
+    def tail_call(env: Env) -> any:
+        func = load(env)
+        try:
+            values = [arg(env) for arg in args]
+            bounce = getattr(func, 'bounce', None)
+            if bounce is None:
+                return func(*values)
+        except TypeError as t:
+            raise InterpretException(str(t), pos, source)
+        except SourceError as e:
+            e.at(pos, source)
+            raise
+        return TailCall(bounce, values)
+    return tail_call
+
+def _compile_call(name: str, args: list[Compiled], scope: Scope, pos: int | None = None) -> Compiled:
+    '''
+    compile a function call
+    builtins that cannot be shadowed by the tree are looked up once here instead of on every call
+    calls with up to three arguments get their own closure to avoid building an argument list
+    an error from inside the call that does not say where it happened is given the place of the call
+    :name: name of the function to call
+    :args: compiled arguments
+    :scope: names visible where the call runs
+    :pos: where the call is in the source
+    '''
+    source = scope.source
+    load = _compile_load(name, scope, pos)
+    if name not in scope.shadowed and name in BUILTINS:
+        builtin = BUILTINS[name]
+        shadows = scope.shadows
+        match args:
+            case []:
+                def call(env: Env) -> any:
+                    func = load(env) if shadows(name) else builtin
+                    try:
+                        return func()
+                    except TypeError as t:
+                        raise InterpretException(str(t), pos, source)
+                    except SourceError as e:
+                        e.at(pos, source)
+                        raise
+            case [a]:
+                def call(env: Env) -> any:
+                    func = load(env) if shadows(name) else builtin
+                    try:
+                        return func(a(env))
+                    except TypeError as t:
+                        raise InterpretException(str(t), pos, source)
+                    except SourceError as e:
+                        e.at(pos, source)
+                        raise
+            case [a, b]:
+                def call(env: Env) -> any:
+                    func = load(env) if shadows(name) else builtin
+                    try:
+                        return func(a(env), b(env))
+                    except TypeError as t:
+                        raise InterpretException(str(t), pos, source)
+                    except SourceError as e:
+                        e.at(pos, source)
+                        raise
+            case [a, b, c]:
+                def call(env: Env) -> any:
+                    func = load(env) if shadows(name) else builtin
+                    try:
+                        return func(a(env), b(env), c(env))
+                    except TypeError as t:
+                        raise InterpretException(str(t), pos, source)
+                    except SourceError as e:
+                        e.at(pos, source)
+                        raise
+            case _:
+                def call(env: Env) -> any:
+                    func = load(env) if shadows(name) else builtin
+                    try:
+                        return func(*[arg(env) for arg in args])
+                    except TypeError as t:
+                        raise InterpretException(str(t), pos, source)
+                    except SourceError as e:
+                        e.at(pos, source)
+                        raise
+        return call
+    match args:
+        case []:
+            def call(env: Env) -> any:
+                func = load(env)
+                try:
+                    return func()
+                except TypeError as t:
+                    raise InterpretException(str(t), pos, source)
+                except SourceError as e:
+                    e.at(pos, source)
+                    raise
+        case [a]:
+            def call(env: Env) -> any:
+                func = load(env)
+                try:
+                    return func(a(env))
+                except TypeError as t:
+                    raise InterpretException(str(t), pos, source)
+                except SourceError as e:
+                    e.at(pos, source)
+                    raise
+        case [a, b]:
+            def call(env: Env) -> any:
+                func = load(env)
+                try:
+                    return func(a(env), b(env))
+                except TypeError as t:
+                    raise InterpretException(str(t), pos, source)
+                except SourceError as e:
+                    e.at(pos, source)
+                    raise
+        case [a, b, c]:
+            def call(env: Env) -> any:
+                func = load(env)
+                try:
+                    return func(a(env), b(env), c(env))
+                except TypeError as t:
+                    raise InterpretException(str(t), pos, source)
+                except SourceError as e:
+                    e.at(pos, source)
+                    raise
+        case _:
+            def call(env: Env) -> any:
+                func = load(env)
+                try:
+                    return func(*[arg(env) for arg in args])
+                except TypeError as t:
+                    raise InterpretException(str(t), pos, source)
+                except SourceError as e:
+                    e.at(pos, source)
+                    raise
+    return call
@@ -1,34 +1,120 @@
 #!/usr/bin/env python3
 
 from symbol_table import new_symbol_table
-from interpret import interpret
+from preprocess import PreprocesserException, INCLUDES
+from scanner import ScannerException
+from cache import ProgramCache
+from profiler import Profiler
+from source_map import SourceMap
+from output import STDOUT, POLICIES
+from argparse import ArgumentParser
 from typing import IO
-from sys import argv
+import sys
+import interpret
+import batch
+import parser as ps
+import optimize as opt
+import vm
 
-def interactive():
+def interactive(backend=interpret, cache: ProgramCache | None = None, limits: interpret.Limits | None = None, profile: Profiler | None = None):
     symbol_table = new_symbol_table()
     try:
         while 1:
-            val = interpret(input('interpreter> '), symbol_table)
+            val = backend.interpret(input('interpreter> '), symbol_table, cache, limits=limits, profile=profile)
             if val is not None:
                 print(f'{val!r}')
     except (KeyboardInterrupt, EOFError):
         pass
 
-def from_file(file: IO[str]):
-    interpret(file.read())
+def from_file(file: IO[str], backend=interpret, cache: ProgramCache | None = None, limits: interpret.Limits | None = None, profile: Profiler | None = None, mapped: bool = False):
+    '''
+    run a program from a file
+    without a cache the file is streamed so each expression runs as soon as it is read
+    a mapped file is scanned as bytes through a memory map instead of being read as text
+    '''
+    if mapped:
+        backend.interpret_mapped(file.name, limits=limits, profile=profile)
+    elif cache is None:
+        backend.interpret_stream(file, limits=limits, profile=profile, path=file.name)
+    else:
+        backend.interpret(file.read(), cache=cache, limits=limits, profile=profile, path=file.name)
+
+def disassemble(file: IO[str]):
+    text = file.read()
+    try:
+        print(vm.disassemble(vm.compile_program(ps.program(text))))
+    except (PreprocesserException, ScannerException, ps.ParserException, interpret.InterpretException) as e:
+        print(e.at(None, SourceMap(file.name, text)).report())
+
+def dump_optimized(file: IO[str]):
+    text = file.read()
+    try:
+        node = ps.program(text)
+        print(opt.dump(opt.optimize(node, interpret.shadowed_names(node))))
+    except (PreprocesserException, ScannerException, ps.ParserException) as e:
+        print(e.at(None, SourceMap(file.name, text)).report())
 
 def main():
     '''Driver Code'''
-    _ = argv.pop(0)
-    match len(argv):
-        case 0:
-            interactive()
-        case 1:
-            with open(argv[0], 'r') as file:
-                from_file(file)
-        case _:
-            print('Invalid number of arguments')
+    arg_parser = ArgumentParser(description='Simple s-expression interpreter')
+    arg_parser.add_argument('file', nargs='?', help='program to run, starts an interactive session if not given')
+    arg_parser.add_argument('--vm', action='store_true', help='run on the bytecode machine')
+    arg_parser.add_argument('--dis', action='store_true', help='print the bytecode of the program instead of running it')
+    arg_parser.add_argument('--dump-optimized', action='store_true', help='print the program after optimizing it instead of running it')
+    arg_parser.add_argument('--batch', nargs='+', metavar='PATH', help='run every program in these files and directories, each in its own symbol table')
+    arg_parser.add_argument('--prelude', metavar='FILE', help='program run once by each --batch process, every program starts from a copy of its globals')
+    arg_parser.add_argument('--workers', type=int, help='number of processes running programs with --batch, the number of cpus by default')
+    arg_parser.add_argument('--max-steps', type=int, help='stop a program after this many loop iterations and function calls')
+    arg_parser.add_argument('--max-depth', type=int, help='stop a program that nests more function calls than this')
+    arg_parser.add_argument('--timeout', type=float, help='stop a program that runs for more seconds than this')
+    arg_parser.add_argument('--profile', action='store_true', help='print the time spent in each function and the hits of each loop when the program ends')
+    arg_parser.add_argument('--profile-collapsed', metavar='FILE', help='write the time spent in each stack of function calls to this file in the collapsed format of flame graph tools')
+    arg_parser.add_argument('--flush', choices=POLICIES, help='when printed text is written: every line, when the buffer is full, or only at the end of the program, line for a terminal and size otherwise by default')
+    arg_parser.add_argument('--mmap', action='store_true', help='scan the bytes of the file through a memory map, for very large programs')
+    arg_parser.add_argument('--cache-dir', help='keep parsed programs in this directory between runs')
+    arg_parser.add_argument('--include-report', action='store_true', help='print how long each included file took to preprocess')
+    args = arg_parser.parse_args()
+    backend = vm if args.vm else interpret
+    limits = None
+    if (args.max_steps, args.max_depth, args.timeout) != (None, None, None):
+        if args.vm:
+            arg_parser.error('--max-steps, --max-depth and --timeout cannot be used with --vm')
+        if args.max_depth is not None and not 0 <= args.max_depth <= interpret.MAX_DEPTH:
+            arg_parser.error(f'--max-depth must be from 0 to {interpret.MAX_DEPTH}')
+        limits = interpret.Limits(args.max_steps, args.max_depth, args.timeout)
+    profile = None
+    if args.profile or args.profile_collapsed is not None:
+        if args.vm or args.batch is not None:
+            arg_parser.error('--profile and --profile-collapsed cannot be used with --vm or --batch')
+        profile = Profiler()
+    if args.mmap and (args.cache_dir is not None or args.file is None):
+        arg_parser.error('--mmap needs a file and cannot be used with --cache-dir')
+    if args.prelude is not None and args.batch is None:
+        arg_parser.error('--prelude can only be used with --batch')
+    if args.flush is not None:
+        STDOUT.set_policy(args.flush)
+    cache = None if args.cache_dir is None else ProgramCache(directory=args.cache_dir)
+    if args.batch is not None:
+        summary = batch.run_all(args.batch, args.workers, args.vm, limits, report=sys.stderr, prelude=args.prelude)
+        if summary.failures:
+            sys.exit(1)
+    elif args.file is None:
+        interactive(backend, cache, limits, profile)
+    else:
+        with open(args.file, 'r') as file:
+            if args.dis:
+                disassemble(file)
+            elif args.dump_optimized:
+                dump_optimized(file)
+            else:
+                from_file(file, backend, cache, limits, profile, args.mmap)
+    if args.profile:
+        print(profile.report(), file=sys.stderr)
+    if args.profile_collapsed is not None:
+        with open(args.profile_collapsed, 'w') as file:
+            profile.write_collapsed(file)
+    if args.include_report:
+        print(INCLUDES.report(), file=sys.stderr)
 
 if __name__ == '__main__':
     main()
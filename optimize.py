@@ -0,0 +1,269 @@
+'''
+Simplifies an abstract syntax tree before it runs
+'''
+
+from decimal import Decimal
+import math
+from symbol_table import BUILTINS
+import parser as ps
+import scanner as sc
+
+# builtins with no side effects, a call to one of these on constants can run ahead of time
+PURE_BUILTINS = frozenset({
+    'neg',
+    'add', '+',
+    'sub', '-',
+    'mul', '*',
+    'div', '/',
+    'mod', '%',
+    'eq', '==',
+    'lt', '<',
+    'gt', '>',
+    'le', '<=',
+    'ge', '>=',
+    'int', 'float', 'str', 'len',
+})
+
+# longest string a call may be folded into, a longer one is built when the call runs
+# so a function that is never called costs nothing
+MAX_FOLDED_LENGTH = 1024
+
+def folded_length(name: str, values: list[any]) -> int:
+    '''
+    work out how long the string built by adding or multiplying constants is without building it
+    :name: the builtin called
+    :values: the constant arguments
+    :returns: the length, 0 if no string is built
+    '''
+    strings = [value for value in values if isinstance(value, str)]
+    if not strings:
+        return 0
+    length = sum(map(len, strings))
+    if name in ('mul', '*'):
+        for value in values:
+            if isinstance(value, int):
+                length *= max(value, 0)
+                if length > MAX_FOLDED_LENGTH:
+                    break # the rest could only make it longer, or zero which the fold can skip
+    return length
+
+class Optimizer:
+    '''
+    Folds constant calls to pure builtins, removes if branches that can never
+    run and flattens nested nops
+    '''
+    def __init__(self, shadowed: set[str], complete: bool = True):
+        '''
+        :shadowed: names that may not refer to builtins when the tree runs
+        :complete: the tree is the whole program, if not the globals could be rebound
+        after it is optimized so function bodies are left alone
+        '''
+        self.shadowed = shadowed
+        self.complete = complete
+
+    def builtin(self, name: str) -> bool:
+        '''
+        check if a name will always refer to a builtin
+        :name: the name to check
+        '''
+        return name not in self.shadowed and name in BUILTINS
+
+    def visit(self, node: ps.Node) -> ps.Node:
+        '''
+        optimize a tree
+        :node: the tree to optimize
+        :returns: the optimized tree
+        '''
+        match node:
+            case ps.ExpressionsNode(body):
+                return ps.ExpressionsNode(tuple(self.visit(expr) for expr in body), pos=node.pos)
+            case ps.FunctionNode(name, args):
+                return self.call(name, [self.visit(arg) for arg in args], node.pos)
+            case ps._AssignNode(name, value):
+                return type(node)(name, self.visit(value), pos=node.pos)
+            case ps.IfNode(cond, block, else_block):
+                cond = self.visit(cond)
+                if isinstance(cond, ps.ValueNode):
+                    if cond.value:
+                        return self.visit(block)
+                    return ps.ValueNode(None, pos=node.pos) if else_block is None else self.visit(else_block)
+                return ps.IfNode(cond, self.visit(block), None if else_block is None else self.visit(else_block), pos=node.pos)
+            case ps.MemoDefNode(name, args, body, maxsize) if self.complete:
+                return ps.MemoDefNode(name, args, self.visit(body), maxsize, pos=node.pos)
+            case ps.DefNode(name, args, body) if self.complete:
+                return ps.DefNode(name, args, self.visit(body), pos=node.pos)
+            case ps.WhileNode(cond, block):
+                cond = self.visit(cond)
+                if isinstance(cond, ps.ValueNode) and not cond.value:
+                    return ps.ValueNode(None, pos=node.pos)
+                return ps.WhileNode(cond, self.visit(block), pos=node.pos)
+            case ps.ForNode(name, range_args, block):
+                return ps.ForNode(name, tuple(self.visit(arg) for arg in range_args), self.visit(block), pos=node.pos)
+            case ps.ForEachNode(name, items, block):
+                return ps.ForEachNode(name, self.visit(items), self.visit(block), pos=node.pos)
+        return node
+
+    def call(self, name: str, args: list[ps.Node], pos: int | None) -> ps.Node:
+        '''
+        optimize a call whose arguments are already optimized
+        :name: the function called
+        :args: the optimized arguments
+        :pos: where the call is
+        '''
+        if name in PURE_BUILTINS and self.builtin(name) and all(isinstance(arg, ps.ValueNode) for arg in args):
+            values = [arg.value for arg in args]
+            if folded_length(name, values) <= MAX_FOLDED_LENGTH:
+                try:
+                    value = BUILTINS[name](*values)
+                except Exception:
+                    pass # left for the program to raise when it runs
+                else:
+                    if self.writable(value):
+                        return ps.ValueNode(value, pos=pos)
+        elif name == 'nop' and self.builtin(name):
+            return self.nop(args, pos)
+        return ps.FunctionNode(name, tuple(args), pos=pos)
+
+    def writable(self, value: any) -> bool:
+        '''
+        check if a folded value can be dumped as source that reads back the same
+        :value: the folded value
+        '''
+        source = write_value(value)
+        return source is not None and all(self.builtin(name) for name in VALUE_BUILTINS if f'({name} ' in source)
+
+    def nop(self, args: list[ps.Node], pos: int | None) -> ps.Node:
+        '''
+        flatten the nops inside a nop and drop the constants that are not its result
+        :args: the optimized arguments of the nop
+        :pos: where the nop is
+        '''
+        body = []
+        for i, arg in enumerate(args):
+            last = i == len(args) - 1
+            if isinstance(arg, ps.FunctionNode) and arg.ident == 'nop' and (arg.arguments or not last):
+                body.extend(arg.arguments)
+            elif not last and isinstance(arg, ps.ValueNode):
+                continue
+            else:
+                body.append(arg)
+        if not body:
+            return ps.ValueNode(None, pos=pos)
+        if len(body) == 1:
+            return body[0]
+        return ps.FunctionNode('nop', tuple(body), pos=pos)
+
+def optimize(node: ps.Node, shadowed: set[str] = frozenset(), complete: bool = True) -> ps.Node:
+    '''
+    optimize a tree before it runs
+    :node: the tree to optimize
+    :shadowed: names that may not refer to builtins when the tree runs
+    :complete: the tree is the whole program so function bodies can be optimized too
+    '''
+    return Optimizer(shadowed, complete).visit(node)
+
+def dump(node: ps.Node) -> str:
+    '''
+    write a tree back out as source, one top level expression per line
+    :node: the tree to write out
+    '''
+    if isinstance(node, ps.ExpressionsNode):
+        return '\n'.join(map(dump, node.body))
+    match node:
+        case ps.ValueNode(None):
+            return '(nop)'
+        case ps.ValueNode(value) if (source := write_value(value)) is not None:
+            return source
+        case ps.IdentNode(name):
+            return name
+        case ps.FunctionNode(name, args):
+            return f'({" ".join([name, *map(dump, args)])})'
+        case ps._AssignNode(name, value):
+            return f'({ASSIGN_NAMES[type(node)]} {name} {dump(value)})'
+        case ps.IncrementNode(name):
+            return f'(++ {name})'
+        case ps.DecrementNode(name):
+            return f'(-- {name})'
+        case ps.IfNode(cond, block, None):
+            return f'(if {dump(cond)} {dump(block)})'
+        case ps.IfNode(cond, block, else_block):
+            return f'(if {dump(cond)} {dump(block)} {dump(else_block)})'
+        case ps.MemoDefNode(name, args, body, maxsize):
+            return f'(defmemo {name} {maxsize} ({" ".join(args)}) {dump(body)})'
+        case ps.DefNode(name, args, body):
+            return f'(def {name} ({" ".join(args)}) {dump(body)})'
+        case ps.WhileNode(cond, block):
+            return f'(while {dump(cond)} {dump(block)})'
+        case ps.ForNode(name, range_args, block):
+            return f'(for {name} ({" ".join(map(dump, range_args))}) {dump(block)})'
+        case ps.ForEachNode(name, items, block):
+            return f'(fore {name} {dump(items)} {dump(block)})'
+    raise TypeError(f'Cannot dump {node}')
+
+# builtins dump calls for numbers that have no literal
+VALUE_BUILTINS = ('neg', 'float')
+
+# characters written as an escape in a string literal
+STRING_ESCAPES = {value: '\\' + ch for ch, value in sc.ESCAPES.items()}
+
+def write_value(value: any) -> str | None:
+    '''
+    write a constant the way the scanner reads it back, negative numbers and
+    floats that are not finite are written as calls to neg and float
+    :value: the constant
+    :returns: the source, None if the language cannot write the value
+    '''
+    match value:
+        case bool():
+            return str(value)
+        case int() if value < 0:
+            return f'(neg {-value})'
+        case int():
+            return str(value)
+        case float() if math.isnan(value):
+            return "(float 'nan')"
+        case float() if math.copysign(1, value) < 0:
+            return f'(neg {write_value(-value)})'
+        case float() if math.isinf(value):
+            return "(float 'inf')"
+        case float():
+            text = format(Decimal(repr(value)), 'f')
+            return text if '.' in text else text + '.0'
+        case str():
+            return write_string(value)
+    return None
+
+def write_string(value: str) -> str | None:
+    '''
+    write a string as a literal
+    :value: the string
+    :returns: the literal, None if the string has // the preprocessor would take
+    for a comment or a backslash the scanner would read as part of an escape
+    '''
+    if '//' in value:
+        return None
+    parts = ["'"]
+    i = 0
+    while i < len(value):
+        ch = value[i]
+        if ch == '\\':
+            following = value[i + 1:i + 2]
+            # a backslash stays as it is before another backslash or a character with no escape
+            if following != '\\' and (not following or following in sc.ESCAPES or following in STRING_ESCAPES):
+                return None
+            parts.append(ch + following)
+            i += 2
+            continue
+        parts.append(STRING_ESCAPES.get(ch, ch))
+        i += 1
+    parts.append("'")
+    return ''.join(parts)
+
+ASSIGN_NAMES = {
+    ps.AssignNode: '=',
+    ps.AddAssignNode: '+=',
+    ps.SubAssignNode: '-=',
+    ps.MulAssignNode: '*=',
+    ps.DivAssignNode: '/=',
+    ps.ModAssignNode: '%=',
+}
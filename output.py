@@ -0,0 +1,124 @@
+'''
+Buffered output for the print builtin
+what a program prints is kept in memory and written to its file in large pieces,
+when that happens is set by the flush policy of the output
+'''
+
+from typing import TextIO
+import atexit
+import math
+import sys
+
+# write every line as soon as it is printed
+LINE = 'line'
+# write when the buffer is full
+SIZE = 'size'
+# write only when flushed, which happens at the end of every program
+EXIT = 'exit'
+POLICIES = (LINE, SIZE, EXIT)
+
+# characters buffered before the size and line policies write them
+BUFFER_SIZE = 256 * 1024
+
+class Output:
+    '''
+    A sink for the text printed by programs
+    the print and flush builtins are its methods, install it in a symbol table to
+    send what a program prints to a file or an in-memory buffer
+    '''
+    def __init__(self, file: TextIO | None = None, policy: str | None = None, size: int = BUFFER_SIZE):
+        '''
+        :file: where the text goes, whatever sys.stdout is when it is printed if None
+        :policy: when the text is written, line for a terminal and size for anything else if None
+        :size: characters kept before they are written, the exit policy ignores it
+        '''
+        if policy is not None and policy not in POLICIES:
+            raise ValueError(f'unknown flush policy {policy!r}, expected one of {", ".join(POLICIES)}')
+        self.file = file
+        self.policy = policy
+        self.size = size
+        self.parts: list[str] = []
+        self.buffered = 0
+        self.target: TextIO | None = None # file the buffered text is written to
+        self.limit = size
+        self.by_line = False
+
+    def print(self, *args: any, sep: str = ' ', end: str = '\n'):
+        '''
+        buffer the arguments separated by sep and followed by end, like print
+        '''
+        text = (str(args[0]) if len(args) == 1 else sep.join(map(str, args))) + end
+        target = sys.stdout if self.file is None else self.file
+        if target is not self.target:
+            self._retarget(target)
+        self.parts.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.limit or self.by_line and '\n' in text:
+            self.flush()
+
+    def flush(self):
+        '''write everything buffered to the file and flush it'''
+        if self.target is None:
+            return
+        if self.parts:
+            text = ''.join(self.parts)
+            self.parts.clear()
+            self.buffered = 0
+            self.target.write(text)
+        self.target.flush()
+
+    def set_policy(self, policy: str | None):
+        '''
+        change when the text is written, anything buffered is written first
+        :policy: one of POLICIES, or None to choose by the file
+        '''
+        if policy is not None and policy not in POLICIES:
+            raise ValueError(f'unknown flush policy {policy!r}, expected one of {", ".join(POLICIES)}')
+        self.flush()
+        self.policy = policy
+        self.target = None
+
+    def install(self, symbol_table: dict[str, any]) -> dict[str, any]:
+        '''
+        make print and flush in a frame of the symbol table use this output
+        functions only see it if they were defined in that frame or one of its children
+        :symbol_table: the frame
+        :returns: the frame
+        '''
+        symbol_table['print'] = self.print
+        symbol_table['flush'] = self.flush
+        return symbol_table
+
+    def uninstall(self, symbol_table: dict[str, any]):
+        '''
+        remove this output from a frame it was installed in
+        names the program assigned something else to are left alone
+        :symbol_table: the frame
+        '''
+        for name, method in (('print', self.print), ('flush', self.flush)):
+            if dict.get(symbol_table, name) == method:
+                del symbol_table[name]
+
+    def _retarget(self, target: TextIO):
+        '''
+        write what was buffered for the old file, like when sys.stdout was redirected, and start buffering for the new one
+        :target: the new file
+        '''
+        self.flush()
+        self.target = target
+        policy = self.policy
+        if policy is None:
+            isatty = getattr(target, 'isatty', None)
+            policy = LINE if isatty is not None and isatty() else SIZE
+        self.by_line = policy == LINE
+        self.limit = math.inf if policy == EXIT else self.size
+
+    def __enter__(self) -> 'Output':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+# the output of the print builtin
+STDOUT = Output()
+atexit.register(STDOUT.flush)
@@ -0,0 +1,232 @@
+'''
+Runs calls of user defined functions in a pool of worker processes
+functions are sent to the workers as the tree of their definition together with
+the globals they use, and compiled again there
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+from hashlib import sha256
+import multiprocessing
+import pickle
+import atexit
+import os
+import parser as ps
+from symbol_table import BUILTINS, VECTOR, new_symbol_table
+from interpret import InterpretException, compile_tree
+from output import STDOUT
+
+# number of chunks each worker gets from one call when no chunk size is given
+CHUNKS_PER_WORKER = 4
+
+_executor: ProcessPoolExecutor | None = None
+_max_workers: int | None = None
+# set in the worker processes of the pool, where calls run one after another instead
+_in_worker = False
+# key and function of the last definition a worker compiled
+_loaded: tuple[bytes, any] | None = None
+
+def set_max_workers(count: int | None):
+    '''
+    change how many processes run calls, the pool is made again on the next call
+    :count: number of processes, the number of cpus if None
+    '''
+    global _executor, _max_workers
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+    _max_workers = count
+
+def shutdown():
+    '''stop the pool without waiting for calls still running, it is made again on the next call'''
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+atexit.register(shutdown)
+
+def in_worker() -> bool:
+    '''
+    check if calls have to run one after another in this process
+    true in the workers of the pool and in any other process multiprocessing started,
+    like the workers of a batch, where a pool of its own would never be stopped
+    '''
+    return _in_worker or multiprocessing.parent_process() is not None
+
+def executor() -> ProcessPoolExecutor:
+    '''get the pool of workers, starting it if needed'''
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(_max_workers, initializer=mark_worker)
+    return _executor
+
+def used_names(node: ps.DefNode) -> set[str]:
+    '''
+    find every name the body of a function could read
+    :node: the function definition
+    '''
+    names = set()
+    for child in ps.walk(node.body):
+        match child:
+            case ps.IdentNode(name) | ps._AssignNode(name, _) | ps.IncrementNode(name) | ps.DecrementNode(name):
+                names.add(name)
+            case ps.FunctionNode(name, _):
+                names.add(name)
+    return names - set(node.args)
+
+def builtin_name(function: any) -> str | None:
+    '''
+    get the name a builtin is stored under
+    :function: the builtin to find
+    '''
+    for name, value in dict.items(BUILTINS):
+        if value is function:
+            return name
+    return None
+
+def serialize(function: any) -> bytes:
+    '''
+    turn a function into the definitions and globals needed to run it in another process
+    :function: a builtin or a user defined function
+    '''
+    name = builtin_name(function)
+    if name is not None:
+        return pickle.dumps((name, None, {}, {}))
+    definitions, values = {}, {}
+    todo = [(None, function)]
+    target = None
+    while todo:
+        var_name, value = todo.pop()
+        definition = getattr(value, 'definition', False)
+        if definition is False:
+            raise InterpretException(f'{value!r} is not a function that can be run in another process')
+        if definition is None:
+            raise InterpretException(f'{value.__name__} is defined inside a function and cannot be run in another process')
+        node, env = definition
+        if var_name is None:
+            target = node
+        else:
+            definitions[var_name] = node
+        for name in used_names(node):
+            if name in definitions or name in values or var_name is None and name == node.name:
+                continue
+            try:
+                value = env[name]
+            except KeyError:
+                continue # the worker reports the missing name when it is used
+            if dict.get(BUILTINS, name) is value:
+                continue
+            if hasattr(value, 'definition'):
+                definitions[name] = None # claimed until it is taken off todo
+                todo.append((name, value))
+                continue
+            try:
+                pickle.dumps(value)
+            except Exception:
+                raise InterpretException(f'{name} cannot be sent to another process') from None
+            values[name] = value
+    return pickle.dumps((None, target, definitions, values))
+
+def mark_worker():
+    '''make calls run one after another in this process, for the initializer of a pool of workers'''
+    global _in_worker
+    _in_worker = True
+
+def _load(key: bytes, payload: bytes) -> any:
+    '''
+    compile a serialized function, reusing the last one if it is the same
+    :key: hash of the payload
+    :payload: the serialized function
+    '''
+    global _loaded
+    if _loaded is not None and _loaded[0] == key:
+        return _loaded[1]
+    name, target, definitions, values = pickle.loads(payload)
+    if name is not None:
+        function = BUILTINS[name]
+    else:
+        symbol_table = new_symbol_table()
+        symbol_table.update(values)
+        for var_name, node in definitions.items():
+            symbol_table[var_name] = compile_tree(node, symbol_table)(symbol_table)
+        function = compile_tree(target, symbol_table)(symbol_table)
+    _loaded = (key, function)
+    return function
+
+def _call_all(function: any, items: list, start: int) -> tuple[list, tuple[int, str] | None]:
+    '''
+    call a function on each item, stopping at the first error
+    :function: function to call
+    :items: arguments of each call
+    :start: index of the first item in the whole list
+    :returns: the results and the index and message of the error if there was one
+    '''
+    results = []
+    for i, item in enumerate(items, start):
+        try:
+            results.append(function(item))
+        except RecursionError:
+            return results, (i, 'maximum recursion depth exceeded')
+        except Exception as e:
+            message = str(e) if type(e).__name__.endswith('Exception') else f'{type(e).__name__}: {e}'
+            return results, (i, message)
+    return results, None
+
+def _run_chunk(key: bytes, payload: bytes, items: list, start: int) -> tuple[list, tuple[int, str] | None]:
+    try:
+        return _call_all(_load(key, payload), items, start)
+    finally:
+        STDOUT.flush() # workers are stopped without running atexit
+
+def pmap(function: any, items: any, chunksize: int | None = None) -> list:
+    '''
+    call a function on each item in worker processes
+    the results are in the same order as the items, if calls fail the error of the
+    first failing item is raised
+    :function: a builtin or a user defined function taking one argument
+    :items: the arguments of each call
+    :chunksize: number of items sent to a worker at once
+    '''
+    items = items.tolist() if type(items) is VECTOR else list(items)
+    name = getattr(function, '__name__', repr(function))
+    if in_worker():
+        results, error = _call_all(function, items, 0)
+    else:
+        payload = serialize(function)
+        key = sha256(payload).digest()
+        STDOUT.flush() # what was printed before the call comes before what the workers print
+        if chunksize is None:
+            workers = _max_workers or os.cpu_count() or 1
+            chunksize = max(1, -(-len(items) // (workers * CHUNKS_PER_WORKER)))
+        elif not isinstance(chunksize, int) or chunksize < 1:
+            raise InterpretException(f'Expected a chunk size of 1 or more but found {chunksize!r}')
+        starts = range(0, len(items), chunksize)
+        chunks = [items[i:i + chunksize] for i in starts]
+        results, error = [], None
+        try:
+            for chunk_results, error in executor().map(_run_chunk, repeat(key), repeat(payload), chunks, starts):
+                results.extend(chunk_results)
+                if error is not None:
+                    break
+        except BrokenProcessPool:
+            set_max_workers(_max_workers)
+            raise InterpretException(f'a worker running {name} stopped unexpectedly') from None
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise InterpretException(f'{name} could not be run in another process: {e}') from None
+    if error is not None:
+        index, message = error
+        raise InterpretException(f'{name} failed on item {index}: {message}')
+    return results
+
+def pfore(function: any, items: any, chunksize: int | None = None) -> any:
+    '''
+    call a function on each item in worker processes for its side effects
+    :function: a builtin or a user defined function taking one argument
+    :items: the arguments of each call
+    :chunksize: number of items sent to a worker at once
+    :returns: the result of the last call like fore
+    '''
+    results = pmap(function, items, chunksize)
+    return results[-1] if results else None
@@ -2,76 +2,93 @@
 Handles converting token stream into abstract syntax tree
 '''
 
-from dataclasses import dataclass
-from typing import TypeVar
+from dataclasses import dataclass, field, fields
+from typing import TypeVar, Iterable, Iterator
 from enum import Enum
 import scanner as sc
+from source_map import SourceMap, MappedSourceMap, SourceError
 
 T = TypeVar('T')
 
-class ParserException(Exception): pass
+class ParserException(SourceError): pass
 
-@dataclass
-class Node: pass
+# default number of results kept by a memoized function
+MEMO_MAXSIZE = 128
 
-@dataclass
+@dataclass(slots=True)
+class Node:
+    # offset the node starts at in the preprocessed source, not part of what the node means
+    # constants are left without one since they cannot fail, which keeps an int object off most nodes
+    pos: int | None = field(default=None, kw_only=True, compare=False, repr=False)
+
+@dataclass(slots=True)
 class FunctionNode(Node):
     ident: str
-    arguments: list[Node]
+    arguments: tuple[Node, ...]
 
-@dataclass
+@dataclass(slots=True)
 class ValueNode(Node):
     value: T
 
-@dataclass
+@dataclass(slots=True)
 class _IdentNode(Node):
     name: str
-class IdentNode(_IdentNode): pass
+class IdentNode(_IdentNode):
+    __slots__ = ()
 
-# forward declaration
-class ExpressionsNode(Node): pass
-@dataclass
+@dataclass(slots=True)
 class ExpressionsNode(Node):
-    left: Node
-    right: ExpressionsNode | None = None
+    body: tuple[Node, ...]
 
-@dataclass
+@dataclass(slots=True)
 class _AssignNode(Node):
     name: str
     value: Node
-class AssignNode(_AssignNode): pass
-class AddAssignNode(_AssignNode): pass
-class SubAssignNode(_AssignNode): pass
-class MulAssignNode(_AssignNode): pass
-class DivAssignNode(_AssignNode): pass
-class ModAssignNode(_AssignNode): pass
-class IncrementNode(_IdentNode): pass
-class DecrementNode(_IdentNode): pass
-
-@dataclass
+class AssignNode(_AssignNode):
+    __slots__ = ()
+class AddAssignNode(_AssignNode):
+    __slots__ = ()
+class SubAssignNode(_AssignNode):
+    __slots__ = ()
+class MulAssignNode(_AssignNode):
+    __slots__ = ()
+class DivAssignNode(_AssignNode):
+    __slots__ = ()
+class ModAssignNode(_AssignNode):
+    __slots__ = ()
+class IncrementNode(_IdentNode):
+    __slots__ = ()
+class DecrementNode(_IdentNode):
+    __slots__ = ()
+
+@dataclass(slots=True)
 class IfNode(Node):
     condition: Node
     block: Node
     else_block: Node
 
-@dataclass
+@dataclass(slots=True)
 class DefNode(Node):
     name: str
-    args: list[int]
+    args: tuple[str, ...]
     body: Node
 
-@dataclass
+@dataclass(slots=True)
+class MemoDefNode(DefNode):
+    maxsize: int = MEMO_MAXSIZE
+
+@dataclass(slots=True)
 class WhileNode(Node):
     condition: Node
     block: Node
 
-@dataclass
+@dataclass(slots=True)
 class ForNode(Node):
     name: str
-    range_args: list[Node]
+    range_args: tuple[Node, ...]
     block: Node
 
-@dataclass
+@dataclass(slots=True)
 class ForEachNode(Node):
     name: str
     items: Node
@@ -86,7 +103,7 @@ def token(scan: sc.Scanner, tok) -> sc.Token:
     '''
     if isinstance(scan.next, tok):
         return next(scan)
-    raise ParserException(f'Expected {tok.__name__} but found {scan.next}')
+    raise ParserException(f'Expected {tok.__name__} but found {scan.next}', scan.position())
 
 def partial_assign(scan: sc.Scanner, assign_class) -> Node:
     '''
@@ -121,7 +138,7 @@ def partial_if(scan: sc.Scanner) -> Node:
     token(scan, sc.RParenToken)
     return ret
 
-def arguments(scan: sc.Scanner) -> list[str]:
+def arguments(scan: sc.Scanner) -> tuple[str, ...]:
     '''
     Get a list of arguments
     :scan: iterator over the token stream with 1 look ahead
@@ -132,7 +149,7 @@ def arguments(scan: sc.Scanner) -> list[str]:
     while not isinstance(scan.next, sc.RParenToken):
         result.append(token(scan, sc.IdentToken).name)
     token(scan, sc.RParenToken)
-    return result
+    return tuple(result)
 
 def partial_def(scan: sc.Scanner) -> Node:
     '''
@@ -145,6 +162,24 @@ def partial_def(scan: sc.Scanner) -> Node:
     token(scan, sc.RParenToken)
     return DefNode(name, args, body)
 
+def partial_def_memo(scan: sc.Scanner) -> Node:
+    '''
+    Get the rest of a memoized function declaration "fib 256 (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))"
+    the cache size is optional, 0 means the cache is unbounded
+    :scan: iterator over the token stream with 1 look ahead
+    '''
+    name = token(scan, sc.IdentToken).name
+    maxsize = MEMO_MAXSIZE
+    if isinstance(scan.next, sc.ValueToken):
+        pos = scan.position()
+        maxsize = next(scan).value
+        if not isinstance(maxsize, int) or isinstance(maxsize, bool) or maxsize < 0:
+            raise ParserException(f'Expected a cache size of 0 or more but found {maxsize!r}', pos)
+    args = arguments(scan)
+    body = expression(scan)
+    token(scan, sc.RParenToken)
+    return MemoDefNode(name, args, body, maxsize)
+
 def partial_while(scan: sc.Scanner) -> Node:
     '''
     Get the rest of a while loop "(< x 10) (print x))"
@@ -163,14 +198,16 @@ def partial_for(scan: sc.Scanner) -> Node:
     range_args = []
     token(scan, sc.LParenToken)
     while not isinstance(scan.next, sc.RParenToken):
+        if len(range_args) == 3:
+            extra = scan.position()
         range_args.append(expression(scan))
     count = len(range_args)
     if count < 1:
-        raise ParserException('Expected at least one range argument for the for loop')
+        raise ParserException('Expected at least one range argument for the for loop', scan.position())
     elif count > 3:
-        raise ParserException(f'Expected no more than three range arguments but {count} were given')
+        raise ParserException(f'Expected no more than three range arguments but {count} were given', extra)
     token(scan, sc.RParenToken)
-    result = ForNode(name, range_args, expression(scan))
+    result = ForNode(name, tuple(range_args), expression(scan))
     token(scan, sc.RParenToken)
     return result
 
@@ -214,6 +251,8 @@ def function(scan: sc.Scanner) -> Node:
         return partial_if(scan)
     elif ident.name == 'def':
         return partial_def(scan)
+    elif ident.name == 'defmemo':
+        return partial_def_memo(scan)
     elif ident.name == 'while':
         return partial_while(scan)
     elif ident.name == 'for':
@@ -227,40 +266,99 @@ def function(scan: sc.Scanner) -> Node:
             return expr
         arguments.append(expr)
     next(scan) # RParen
-    return FunctionNode(ident.name, arguments)
+    return FunctionNode(ident.name, tuple(arguments))
 
 def expression(scan: sc.Scanner) -> Node:
     '''
     Get an expression from the token stream
     :scan: iterator over token stream with 1 look ahead
     '''
+    pos = scan.position()
     if isinstance(scan.next, sc.LParenToken):
-        return function(scan)
+        node = function(scan)
+        node.pos = pos
+        return node
     elif isinstance(scan.next, sc.ValueToken):
-        token = next(scan)
-        return ValueNode(token.value)
+        return ValueNode(next(scan).value)
     elif isinstance(scan.next, sc.IdentToken):
         token = next(scan)
-        return IdentNode(token.name)
+        return IdentNode(token.name, pos=pos)
     else:
-        raise ParserException(f'Unexpected token {scan.next}')
+        raise ParserException(f'Unexpected token {scan.next}', pos)
 
 def expressions(scan: sc.Scanner) -> Node:
     '''
-    Get an expressions from the token stream
+    Get a sequence of expressions from the token stream
+    the sequence is read in a loop so its length does not affect the stack depth
     :scan: iterator over token stream with 1 look ahead
     '''
-    node = ExpressionsNode(expression(scan))
-    if isinstance(node.left, ParserException):
-        return node.left
-    elif not isinstance(scan.next, sc.EndToken | sc.RParenToken):
-        node.right = expressions(scan)
-        if isinstance(node.right, ParserException):
-            return node.right
-    return node
+    body = [expression(scan)]
+    while not isinstance(scan.next, sc.EndToken | sc.RParenToken):
+        body.append(expression(scan))
+    return ExpressionsNode(tuple(body), pos=body[0].pos)
 
-def program(string: str) -> Node:
-    scan = iter(sc.Scanner(string))
+def program(string: str, preprocessed: bool = False) -> Node:
+    '''
+    Parse a whole program
+    :string: source of the program
+    :preprocessed: string has already been preprocessed
+    '''
+    scan = iter(sc.Scanner(string, preprocessed=preprocessed))
     node = expressions(scan)
     token(scan, sc.EndToken)
     return node
+
+def program_stream(lines: Iterable[str], source_map: SourceMap | None = None) -> Iterator[Node]:
+    '''
+    Parse a program one top level expression at a time
+    each expression is yielded as soon as it is complete
+    :lines: the lines of the program
+    :source_map: map each line is added to as it is read
+    '''
+    return top_level(sc.StreamScanner(lines, source_map=source_map), source_map)
+
+def mapped_program_stream(data: bytes, path: str) -> tuple[Iterator[Node], SourceMap]:
+    '''
+    Parse a program in a mapped file one top level expression at a time
+    a file with no directives or comments is scanned as bytes without being decoded
+    or preprocessed, any other file is decoded and preprocessed a line at a time
+    :data: the bytes of the file
+    :path: the file
+    :returns: the expressions and the map of where their offsets came from
+    '''
+    if sc.needs_preprocessing(data):
+        source_map = SourceMap(path)
+        return program_stream(sc.mapped_lines(data), source_map), source_map
+    return top_level(sc.MappedScanner(data)), MappedSourceMap(path, data)
+
+def top_level(scan: sc.Scanner, source_map: SourceMap | None = None) -> Iterator[Node]:
+    '''
+    Parse a program one top level expression at a time
+    :scan: token stream that is only read as far as the expression being parsed
+    :source_map: map the scanner adds to, where the expressions before the one being
+    parsed came from is dropped from it so it does not grow with the program
+    '''
+    scan = iter(scan)
+    while not isinstance(scan.next, sc.EndToken):
+        if source_map is not None:
+            source_map.forget(scan.position())
+        yield expression(scan)
+
+def walk(node: Node, enter_defs: bool = True) -> Iterator[Node]:
+    '''
+    Iterate over a tree and every node inside it
+    :node: the root of the tree
+    :enter_defs: include the nodes inside nested function definitions, the definitions themselves are always included
+    '''
+    todo = [node]
+    while todo:
+        node = todo.pop()
+        yield node
+        if not enter_defs and isinstance(node, DefNode):
+            continue
+        for f in fields(node):
+            value = getattr(node, f.name)
+            if isinstance(value, Node):
+                todo.append(value)
+            elif isinstance(value, list | tuple):
+                todo.extend(item for item in value if isinstance(item, Node))
@@ -1,78 +1,408 @@
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Iterable, Iterator
+from collections import OrderedDict
+from source_map import SourceMap, SourceError, Origin, INPUT
+import threading
 import re
+import os
 
 DIRECTIVE_PREFIX = '#'
 COMMENT_PREFIX = '//'
 MULTILINE_COMMENT_START = '/*'
 MULTILINE_COMMENT_END = '*/'
 
-class PreprocesserException(Exception): pass
+class PreprocesserException(SourceError): pass
 
-def find_macro(macros: dict[str, str], line: str) -> tuple[str, int] | None:
+MAX_MACRO_DEPTH = 64
+
+# a quote that is not escaped closes a string
+CLOSE_QUOTE = re.compile(r"(?<!\\)'")
+
+class Macros(dict):
     '''
-    finds a macro if it exists on a line
-    :macros: a dictionary of macros and their expansions
-    :line: a line of code from the program
-    :returns: a tuple of the found macro and the index of it's first letter
+    A dictionary of macros and their expansions
+    keeps one pattern that finds the next quote or macro on a line
     '''
-    for macro in macros:
-        matches = re.finditer(fr'\b{macro}\b', line)
-        for mtch in matches:
-            index = mtch.start(0)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pattern = None
+
+    def __setitem__(self, name: str, expansion: str):
+        if name not in self:
+            self._pattern = None
+        super().__setitem__(name, expansion)
+
+    def __delitem__(self, name: str):
+        self._pattern = None
+        super().__delitem__(name)
+
+    def update(self, *args, **kwargs):
+        self._pattern = None
+        super().update(*args, **kwargs)
+
+    @property
+    def pattern(self) -> re.Pattern:
+        if self._pattern is None:
+            names = '|'.join(map(re.escape, sorted(self, key=len, reverse=True)))
+            self._pattern = re.compile(fr"(?P<quote>')|\b(?P<macro>{names})\b")
+        return self._pattern
+
+def expand_macros(macros: Macros, text: str, out: list[str], in_string: bool = False, depth: int = 0, uses: list | None = None, measured: list[int] | None = None) -> bool:
+    '''
+    expand every macro outside of a string in one left to right pass
+    expansions are expanded in turn so nested macros work
+    :macros: the macros to expand
+    :text: the text to expand
+    :out: list the expanded pieces are added to
+    :in_string: whether text starts inside a string
+    :depth: how many expansions text is nested inside
+    :uses: list the offset in the output and in text of the start and end of each
+    macro in text are added to
+    :measured: number of pieces of out already measured and their length, shared with nested expansions
+    :returns: whether text ends inside a string
+    '''
+    if uses is not None and measured is None:
+        measured = [0, 0]
+    pattern = macros.pattern
+    pos = 0
+    while True:
+        if in_string:
+            match = CLOSE_QUOTE.search(text, pos)
+            if match is None:
+                out.append(text[pos:])
+                return True
+            out.append(text[pos:match.end()])
+            pos = match.end()
             in_string = False
-            prev_bslash = False
-            for ch in line[:index]:
-                if ch == '\'':
-                    if in_string and not prev_bslash or not in_string:
-                        in_string = not in_string
-                prev_bslash = ch == '\\'
-            if in_string:
-                continue
-            return macro, index
-    return None
-
-def preprocess(string: str, macros: dict[str, str] | None = None) -> str:
+            continue
+        match = pattern.search(text, pos)
+        if match is None:
+            out.append(text[pos:])
+            return False
+        out.append(text[pos:match.start()])
+        pos = match.end()
+        if match.lastgroup == 'quote':
+            out.append('\'')
+            in_string = True
+            continue
+        macro = match.group('macro')
+        if depth >= MAX_MACRO_DEPTH:
+            raise PreprocesserException(f'Macro {macro} expanded more than {MAX_MACRO_DEPTH} levels deep, it may reference itself')
+        if uses is None:
+            in_string = expand_macros(macros, macros[macro], out, in_string, depth + 1)
+        else:
+            uses.append((_length(out, measured), match.start(), macro))
+            in_string = expand_macros(macros, macros[macro], out, in_string, depth + 1)
+            uses.append((_length(out, measured), pos, None))
+
+def _length(out: list[str], measured: list[int]) -> int:
+    '''
+    get the length of the output so far, only measuring the pieces added since it was last measured
+    :out: the expanded pieces
+    :measured: number of pieces already measured and their length, updated
+    '''
+    measured[1] += sum(map(len, out[measured[0]:]))
+    measured[0] = len(out)
+    return measured[1]
+
+Stamp = tuple[int, int]
+
+def stamp(path: str) -> Stamp:
+    '''
+    get the modification time and size of a file
+    :path: path of the file
+    '''
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+@dataclass
+class IncludedFile:
+    '''The preprocessed output of a file and what it depends on'''
+    macros_before: dict[str, str]
+    output: str = ''
+    defined: dict[str, str] = field(default_factory=dict)
+    # stamps of the file and every file it included
+    dependencies: dict[str, Stamp] = field(default_factory=dict)
+    # files marked with #once while preprocessing this file
+    once: set[str] = field(default_factory=set)
+    # files this file includes directly
+    includes: set[str] = field(default_factory=set)
+    source_map: SourceMap = field(default_factory=SourceMap)
+
+    def valid(self, macros: dict[str, str], included_once: set[str]) -> bool:
+        '''
+        check if the output can be reused
+        :macros: macros defined before the include
+        :included_once: files marked with #once that were already included
+        '''
+        if macros != self.macros_before or not self.once.isdisjoint(included_once):
+            return False
+        try:
+            return all(stamp(path) == old for path, old in self.dependencies.items())
+        except OSError:
+            return False
+
+@dataclass
+class IncludeStats:
+    loads: int = 0
+    hits: int = 0
+    seconds: float = 0.0
+
+# included files whose output is kept, the least recently used is dropped first
+MAX_INCLUDED_FILES = 256
+
+class IncludeManager:
+    '''
+    Memoizes the preprocessed output of included files by path, modification time and size
+    records which files include which and how long each took to preprocess
+    only the memo is kept here and it is shared by every input preprocessed with the
+    manager, on any thread, what one input is including is kept in its own Includes
+    '''
+    def __init__(self, max_files: int = MAX_INCLUDED_FILES):
+        '''
+        :max_files: number of files whose output is kept
+        '''
+        self.files: OrderedDict[str, IncludedFile] = OrderedDict()
+        self.stats: dict[str, IncludeStats] = {}
+        self.max_files = max_files
+        self.lock = threading.Lock()
+
+    def begin(self) -> 'Includes':
+        '''start preprocessing a new top level input'''
+        return Includes(self)
+
+    def lookup(self, path: str) -> IncludedFile | None:
+        '''
+        get the memoized output of a file, it may no longer be valid
+        :path: absolute path of the file
+        '''
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is not None:
+                self.files.move_to_end(path)
+            return entry
+
+    def hit(self, path: str):
+        '''
+        count a reuse of the memoized output of a file
+        :path: absolute path of the file
+        '''
+        with self.lock:
+            if path in self.files: # stats are only kept for memoized files
+                self.stats.setdefault(path, IncludeStats()).hits += 1
+
+    def store(self, path: str, entry: IncludedFile, seconds: float):
+        '''
+        memoize the output of a file, dropping the least recently used file if there are too many
+        :path: absolute path of the file
+        :entry: its output
+        :seconds: time it took to preprocess
+        '''
+        with self.lock:
+            self.files[path] = entry
+            self.files.move_to_end(path)
+            stats = self.stats.setdefault(path, IncludeStats())
+            stats.loads += 1
+            stats.seconds += seconds
+            while len(self.files) > self.max_files:
+                old, _ = self.files.popitem(last=False)
+                self.stats.pop(old, None)
+
+    @property
+    def graph(self) -> dict[str, set[str]]:
+        '''the files each memoized file includes directly'''
+        with self.lock:
+            return {path: set(entry.includes) for path, entry in self.files.items()}
+
+    def dependencies(self, path: str) -> set[str]:
+        '''
+        get every file a file includes directly or indirectly
+        :path: the including file
+        '''
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.files.get(path)
+            return set() if entry is None else set(entry.dependencies) - {path}
+
+    def report(self) -> str:
+        '''list the time spent preprocessing each included file, slowest first'''
+        lines = []
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda item: item[1].seconds, reverse=True)
+        for path, stats in stats:
+            lines.append(f'{stats.seconds * 1000:10.3f}ms {stats.loads:>6} loads {stats.hits:>6} hits  {path}')
+        return '\n'.join(lines)
+
+class Includes:
+    '''
+    The includes of one top level input while it is preprocessed
+    the files being included and the files marked with #once are kept here and not
+    in the manager, so inputs preprocessed at the same time do not see each other's
+    '''
+    def __init__(self, manager: IncludeManager):
+        '''
+        :manager: memo of included files shared between inputs
+        '''
+        self.manager = manager
+        self.included_once: set[str] = set()
+        # paths currently being preprocessed and the entries being built for them
+        self.stack: list[str] = []
+        self.building: list[IncludedFile] = []
+
+    def once(self, path: str | None):
+        '''
+        mark a file so later includes of it are skipped
+        :path: the file containing the #once directive
+        '''
+        if path is None:
+            return
+        self.included_once.add(path)
+        if self.building:
+            self.building[-1].once.add(path)
+
+    def include(self, name: str, macros: 'Macros', includer: str | None = None, source_map: SourceMap | None = None) -> str:
+        '''
+        preprocess an included file, reusing the output from an earlier include if nothing changed
+        :name: the file to include
+        :macros: macros defined so far, updated with the macros the file defines
+        :includer: the file containing the #inc directive
+        :source_map: map of the including input, the map of the file is added to it
+        :returns: the preprocessed file
+        '''
+        path = os.path.abspath(name)
+        if self.building:
+            self.building[-1].includes.add(path)
+        if path in self.included_once:
+            if source_map is not None:
+                source_map.end_line(0)
+            return ''
+        if path in self.stack:
+            cycle = self.stack[self.stack.index(path):] + [path]
+            raise PreprocesserException(f'Include cycle: {" -> ".join(cycle)}')
+        entry = self.manager.lookup(path)
+        if entry is not None and entry.valid(macros, self.included_once):
+            self.manager.hit(path)
+            macros.update(entry.defined)
+            self.included_once |= entry.once
+            self._merge(entry)
+            if source_map is not None:
+                source_map.merge(entry.source_map, len(entry.output))
+            return entry.output
+        start = perf_counter()
+        entry = IncludedFile(dict(macros))
+        try:
+            entry.dependencies[path] = stamp(path)
+            with open(path, 'r') as f:
+                text = f.read()
+        except OSError as e:
+            raise PreprocesserException(f'Could not include {name}: {e.strerror}')
+        self.stack.append(path)
+        self.building.append(entry)
+        try:
+            entry.output = preprocess(text, macros, self, path, entry.source_map)
+        finally:
+            self.stack.pop()
+            self.building.pop()
+        entry.defined = {key: value for key, value in macros.items() if entry.macros_before.get(key) != value}
+        self.manager.store(path, entry, perf_counter() - start)
+        self._merge(entry)
+        if source_map is not None:
+            source_map.merge(entry.source_map, len(entry.output))
+        return entry.output
+
+    def _merge(self, entry: IncludedFile):
+        '''add what an included file depends on to the file including it'''
+        if self.building:
+            parent = self.building[-1]
+            parent.dependencies.update(entry.dependencies)
+            parent.once |= entry.once
+
+INCLUDES = IncludeManager()
+
+def preprocess(string: str, macros: Macros | None = None, includes: IncludeManager | Includes | None = None, path: str | None = None, source_map: SourceMap | None = None) -> str:
     '''
     preprocess input
     this removes comments and expands macros
     :string: the input to preprocess
+    :macros: macros defined so far, shared with included files
+    :includes: manager that memoizes included files, a shared one is used if not given,
+    or the includes of the input that is including this one
+    :path: the file the input came from
+    :source_map: an empty map that is filled in with where each offset of the output came from
     :returns: processed input
     '''
-    if macros is None:
-        macros = {}
-    new_lines = []
-    for line in string.split('\n'):
+    output = '\n'.join(preprocess_lines(string.split('\n'), macros, includes, path, source_map))
+    stripped = output.strip()
+    if source_map is not None:
+        source_map.strip(len(output) - len(output.lstrip()))
+    return stripped + ' '
+
+def preprocess_lines(lines: Iterable[str], macros: Macros | None = None, includes: IncludeManager | Includes | None = None, path: str | None = None, source_map: SourceMap | None = None) -> Iterator[str]:
+    '''
+    preprocess input one line at a time
+    lines are read as they are needed so the input does not have to be in memory
+    :lines: the lines of the input, with or without their line endings
+    :macros: macros defined so far, shared with included files
+    :includes: manager that memoizes included files, a shared one is used if not given,
+    or the includes of the input that is including this one
+    :path: the file the input came from
+    :source_map: map that each processed line is added to as it is yielded
+    :returns: iterator over processed lines, an included file is one item
+    '''
+    if not isinstance(macros, Macros):
+        macros = Macros(macros or ())
+    if includes is None:
+        includes = INCLUDES
+    if isinstance(includes, IncludeManager):
+        includes = includes.begin()
+    name = path if path is not None else INPUT if source_map is None else source_map.path
+    for number, line in enumerate(lines, 1):
+        indent = len(line) - len(line.lstrip())
         line = line.strip()
-        if line.startswith(DIRECTIVE_PREFIX):
-            parts = line[1:].split(' ', 1)
-            if len(parts) == 1:
-                name, = parts
-                line = ''
-            else:
-                name, line = parts
-            match name:
-                case 'def':
-                    if not line or len((parts := line.split(' ', 1))) < 2:
-                        raise PreprocesserException(f'Expected 2 arguments for def directive')
-                    name, rest = parts
-                    macros[name] = rest
-                    line = ''
-                case 'inc':
-                    if not line:
-                        raise PreprocesserException(f'Expected 1 filename for inc directive')
-                    with open(line, 'r') as f:
-                        new_lines.append(preprocess(f.read(), macros))
+        uses = None
+        try:
+            if line.startswith(DIRECTIVE_PREFIX):
+                parts = line[1:].split(' ', 1)
+                if len(parts) == 1:
+                    directive, = parts
                     line = ''
-                case _:
-                    raise PreprocesserException(f'Unknown preprocessor directive: {name}')
-        elif COMMENT_PREFIX in line:
-            index = line.index(COMMENT_PREFIX)
-            line = line[:index]
-        # substitute macros
-        while 1:
-            found_tup = find_macro(macros, line)
-            if found_tup is None:
-                break
-            macro, index = found_tup
-            line = line[:index] + macros[macro] + line[index + len(macro):]
-        new_lines.append(line)
-    return '\n'.join(new_lines).strip() + ' '
+                else:
+                    directive, line = parts
+                match directive:
+                    case 'def':
+                        if not line or len((parts := line.split(' ', 1))) < 2:
+                            raise PreprocesserException(f'Expected 2 arguments for def directive')
+                        macro, rest = parts
+                        macros[macro] = rest
+                        line = ''
+                    case 'inc':
+                        if not line:
+                            raise PreprocesserException(f'Expected 1 filename for inc directive')
+                        yield includes.include(line, macros, path, source_map)
+                        line = ''
+                    case 'once':
+                        includes.once(path)
+                    case _:
+                        raise PreprocesserException(f'Unknown preprocessor directive: {directive}')
+            elif COMMENT_PREFIX in line:
+                index = line.index(COMMENT_PREFIX)
+                line = line[:index]
+            # substitute macros
+            if macros and line:
+                pieces = []
+                if source_map is not None:
+                    uses = []
+                expand_macros(macros, line, pieces, uses=uses)
+                line = ''.join(pieces)
+        except PreprocesserException as e:
+            if e.origin is None:
+                e.origin = Origin(name, number, indent + 1)
+            raise
+        if source_map is not None:
+            source_map.add(0, name, number, indent + 1)
+            if uses:
+                for column, source_column, macro in uses:
+                    source_map.add(column, name, number, indent + source_column + 1, macro)
+            source_map.end_line(len(line))
+        yield line
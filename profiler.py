@@ -0,0 +1,184 @@
+'''
+Records where a compiled program spends its time
+user defined functions get call counts with inclusive and exclusive time, loops
+get hit counts for each place they are in the source
+'''
+
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Callable, IO
+from source_map import SourceMap
+import parser as ps
+
+# name of the bottom of every stack, the code outside any function
+PROGRAM = '<program>'
+
+@dataclass(slots=True)
+class FunctionStats:
+    calls: int = 0
+    inclusive: float = 0.0 # seconds in the function and what it called, recursive calls count once
+    exclusive: float = 0.0 # seconds in the function itself
+
+@dataclass(slots=True)
+class LoopStats:
+    runs: int = 0
+    hits: int = 0          # iterations of every run together
+    seconds: float = 0.0
+
+def location(name: str, node: ps.Node, source: SourceMap | None) -> str:
+    '''
+    name something by where it is in the source
+    :name: what it is
+    :node: the node it starts at
+    :source: map of the program the node was parsed from
+    '''
+    origin = None if node.pos is None or source is None else source.locate(node.pos)
+    return name if origin is None else f'{name} {origin}'
+
+class Profiler:
+    '''
+    Collects the times and counts of one or more runs
+    compile_tree wraps functions and loops with the hooks below when given a profiler,
+    without one nothing is wrapped
+    '''
+    def __init__(self):
+        self.functions: dict[str, FunctionStats] = {}
+        self.loops: dict[str, LoopStats] = {}
+        # every stack of function names seen is a node in a tree stored in these lists
+        # with the exclusive seconds spent in it, the program is node 0
+        self.stack_names = [PROGRAM]
+        self.stack_parents = [-1]
+        self.stack_seconds = [0.0]
+        self.stack_children: dict[tuple[int, str], int] = {}
+        # nodes of the running functions and the seconds spent in their callees
+        self.running = [0]
+        self.child_times = [0.0]
+        # how many calls of each function are running
+        self.active: dict[str, int] = {}
+
+    def run(self, run: Callable[[], any]) -> any:
+        '''
+        call a function that runs a program, timing the code outside user functions
+        :run: runs the program
+        '''
+        self.child_times[0] = 0.0
+        start = perf_counter()
+        try:
+            return run()
+        finally:
+            self.stack_seconds[0] += perf_counter() - start - self.child_times[0]
+
+    def stack(self, parent: int, name: str) -> int:
+        '''
+        get the node of a function called from a stack
+        :parent: node of the stack it was called from
+        :name: the function
+        '''
+        node = self.stack_children.get((parent, name))
+        if node is None:
+            node = self.stack_children[parent, name] = len(self.stack_names)
+            self.stack_names.append(name)
+            self.stack_parents.append(parent)
+            self.stack_seconds.append(0.0)
+        return node
+
+    def function(self, function: Callable, node: ps.DefNode, source: SourceMap | None = None) -> Callable:
+        '''
+        time every call of a user defined function
+        :function: the function
+        :node: its definition
+        :source: map of the program it was parsed from
+        '''
+        key = location(node.name, node, source)
+        stats = self.functions.setdefault(key, FunctionStats())
+        running, child_times, active, seconds = self.running, self.child_times, self.active, self.stack_seconds
+        def profiled(*args):
+            stack = self.stack(running[-1], key)
+            running.append(stack)
+            child_times.append(0.0)
+            active[key] = active.get(key, 0) + 1
+            start = perf_counter()
+            try:
+                return function(*args)
+            finally:
+                elapsed = perf_counter() - start
+                running.pop()
+                exclusive = elapsed - child_times.pop()
+                child_times[-1] += elapsed
+                active[key] -= 1
+                stats.calls += 1
+                stats.exclusive += exclusive
+                if not active[key]:
+                    stats.inclusive += elapsed
+                seconds[stack] += exclusive
+        profiled.__name__ = function.__name__
+        for attribute in ('memo', 'definition'):
+            if hasattr(function, attribute):
+                setattr(profiled, attribute, getattr(function, attribute))
+        return profiled
+
+    def count(self, block: Callable, node: ps.Node, kind: str, source: SourceMap | None = None) -> Callable:
+        '''
+        count the iterations of a loop
+        :block: the compiled body of the loop, called once an iteration
+        :node: the loop
+        :kind: the name of the loop
+        :source: map of the program it was parsed from
+        '''
+        stats = self.loops.setdefault(location(kind, node, source), LoopStats())
+        def counted(env):
+            stats.hits += 1
+            return block(env)
+        return counted
+
+    def time(self, loop: Callable, node: ps.Node, kind: str, source: SourceMap | None = None) -> Callable:
+        '''
+        time every run of a loop
+        :loop: the compiled loop
+        :node: the loop
+        :kind: the name of the loop
+        :source: map of the program it was parsed from
+        '''
+        stats = self.loops.setdefault(location(kind, node, source), LoopStats())
+        def timed(env):
+            stats.runs += 1
+            start = perf_counter()
+            try:
+                return loop(env)
+            finally:
+                stats.seconds += perf_counter() - start
+        return timed
+
+    def report(self, limit: int | None = None) -> str:
+        '''
+        describe the functions by exclusive time and the loops by hits
+        :limit: most rows of each table
+        '''
+        lines = [f'{"function":<32} {"calls":>10} {"inclusive":>12} {"exclusive":>12}']
+        functions = sorted(self.functions.items(), key=lambda item: item[1].exclusive, reverse=True)
+        for key, stats in functions[:limit]:
+            lines.append(f'{key:<32} {stats.calls:>10} {stats.inclusive:>11.6f}s {stats.exclusive:>11.6f}s')
+        lines.append('')
+        lines.append(f'{"loop":<32} {"runs":>10} {"hits":>12} {"seconds":>12}')
+        loops = sorted(self.loops.items(), key=lambda item: item[1].hits, reverse=True)
+        for key, stats in loops[:limit]:
+            lines.append(f'{key:<32} {stats.runs:>10} {stats.hits:>12} {stats.seconds:>11.6f}s')
+        return '\n'.join(lines)
+
+    def write_collapsed(self, file: IO[str]):
+        '''
+        write the stacks in the collapsed format read by flame graph tools
+        each line is the names of a stack joined by ; and its exclusive microseconds
+        :file: where to write
+        '''
+        lines = []
+        for node, seconds in enumerate(self.stack_seconds):
+            microseconds = round(seconds * 1e6)
+            if microseconds <= 0:
+                continue
+            names = []
+            while node != -1:
+                names.append(self.stack_names[node].replace(';', ':'))
+                node = self.stack_parents[node]
+            lines.append(f'{";".join(reversed(names))} {microseconds}\n')
+        file.writelines(sorted(lines))
@@ -2,14 +2,19 @@
 Handles scanning the character stream and converting it into a character stream
 '''
 
-from preprocess import preprocess
+from preprocess import preprocess, preprocess_lines
+from source_map import SourceMap, SourceError
+import re
+from sys import intern
 from dataclasses import dataclass
-from typing import TypeVar, Iterator
+from typing import TypeVar, Iterable, Iterator, BinaryIO
 from enum import Enum
+import mmap
+import os
 
 T = TypeVar('T')
 
-class ScannerException(Exception): pass
+class ScannerException(SourceError): pass
 
 class ScanningState(Enum):
     GENERAL = 0
@@ -19,31 +24,55 @@ class ScanningState(Enum):
     STRING = 4
     STRING_ESCAPE = 5
 
-@dataclass
+@dataclass(slots=True)
 class Token: pass
-class EndToken(Token): pass
-class LParenToken(Token): pass
-class RParenToken(Token): pass
+class EndToken(Token):
+    __slots__ = ()
+class LParenToken(Token):
+    __slots__ = ()
+class RParenToken(Token):
+    __slots__ = ()
 
-@dataclass
+
+@dataclass(slots=True)
 class IdentToken(Token):
     name: str
 
-@dataclass
+@dataclass(slots=True)
 class ValueToken(Token):
     value: T
 
-def scanner_gen(string: str) -> Iterator[Token]:
+# tokens that are always the same are shared
+END = EndToken()
+LPAREN = LParenToken()
+RPAREN = RParenToken()
+TRUE = ValueToken(True)
+FALSE = ValueToken(False)
+
+def scanner_gen(string: str, preprocessed: bool = False) -> Iterator[Token]:
     '''
     use a generator to convert character stream to tokens stream
     :string: the character stream to convert
+    :preprocessed: string has already been preprocessed
+    '''
+    if not preprocessed:
+        string = preprocess(string)
+    for token, _ in scan_characters(string):
+        yield token
+
+def scan_characters(string: str) -> Iterator[tuple[Token, int]]:
+    '''
+    convert a preprocessed character stream to tokens one character at a time
+    :string: the character stream to convert
+    :returns: each token with the offset it starts at
     '''
-    string = preprocess(string)
     state = ScanningState.GENERAL
     partial = ''
-    for ch in string:
+    start = 0
+    for i, ch in enumerate(string):
         match state:
             case ScanningState.GENERAL:
+                start = i
                 if ch.isspace():
                     continue
                 elif ch.isnumeric():
@@ -52,27 +81,24 @@ def scanner_gen(string: str) -> Iterator[Token]:
                 elif ch == "'":
                     state = ScanningState.STRING
                 elif ch == ')':
-                    yield RParenToken()
+                    yield RPAREN, i
                 elif ch == '(':
-                    yield LParenToken()
+                    yield LPAREN, i
                 else:
                     partial += ch
                     state = ScanningState.IDENT
             case ScanningState.IDENT:
                 if ch.isspace() or ch in '()':
-                    if partial in ('True', 'False'):
-                        if partial == 'True':
-                            yield ValueToken(True)
-                        else:
-                            yield ValueToken(False)
-                        state = ScanningState.GENERAL
-                        partial = ''
-                        continue
-                    yield IdentToken(partial)
+                    if partial == 'True':
+                        yield TRUE, start
+                    elif partial == 'False':
+                        yield FALSE, start
+                    else:
+                        yield IdentToken(intern(partial)), start
                     if ch == ')':
-                        yield RParenToken()
+                        yield RPAREN, i
                     elif ch == '(':
-                        yield LParenToken()
+                        yield LPAREN, i
                     state = ScanningState.GENERAL
                     partial = ''
                 else:
@@ -80,11 +106,11 @@ def scanner_gen(string: str) -> Iterator[Token]:
             case ScanningState.INT:
                 paren = ch in '()'
                 if ch.isspace() or paren:
-                    yield ValueToken(int(partial))
+                    yield ValueToken(int(partial)), start
                     if ch == ')':
-                        yield RParenToken()
+                        yield RPAREN, i
                     elif ch == '(':
-                        yield LParenToken()
+                        yield LPAREN, i
                     state = ScanningState.GENERAL
                     partial = ''
                 elif ch.isnumeric():
@@ -93,11 +119,11 @@ def scanner_gen(string: str) -> Iterator[Token]:
                     partial += ch
                     state = ScanningState.FLOAT
                 else:
-                    raise ScannerException(f'Unexpected character inside int: {ch}')
+                    raise ScannerException(f'Unexpected character inside int: {ch}', i)
             case ScanningState.STRING:
                 match ch:
                     case '\'':
-                        yield ValueToken(partial)
+                        yield ValueToken(partial), start
                         state = ScanningState.GENERAL
                         partial = ''
                     case '\\':
@@ -122,34 +148,341 @@ def scanner_gen(string: str) -> Iterator[Token]:
             case ScanningState.FLOAT:
                 paren = ch in '()'
                 if ch.isspace() or paren:
-                    yield ValueToken(float(partial))
+                    yield ValueToken(float(partial)), start
                     if ch == ')':
-                        yield RParenToken()
+                        yield RPAREN, i
                     elif ch == '(':
-                        yield LParenToken()
+                        yield LPAREN, i
                     state = ScanningState.GENERAL
                     partial = ''
                 elif ch.isnumeric():
                     partial += ch
                 else:
-                    raise ScannerException(f'Unexpected character inside int: {ch}')
-    yield EndToken()
+                    raise ScannerException(f'Unexpected character inside int: {ch}', i)
+    yield END, len(string)
+
+TOKEN_PATTERN = re.compile(r'''\s*(?:
+    (?P<lparen>\()
+    |(?P<rparen>\))
+    |(?P<number>\d+(?:\.\d*)?)(?P<bad_number>[^\s()])?
+    |'(?P<string>[^'\\]*(?:\\.[^'\\]*)*)'
+    |(?P<unterminated>'.*)
+    |(?P<ident>[^\s()'\d][^\s()]*)
+)''', re.VERBOSE | re.DOTALL)
+
+ESCAPE_PATTERN = re.compile(r'\\(.)', re.DOTALL)
+
+ESCAPES = {
+    'n': '\n',
+    't': '\t',
+    'b': '\b',
+    'v': '\v',
+    '\'': '\'',
+}
+
+def unescape(match: re.Match) -> str:
+    ch = match.group(1)
+    return ESCAPES.get(ch, '\\' + ch)
+
+def fast_scanner_gen(string: str, preprocessed: bool = False) -> Iterator[Token]:
+    '''
+    convert character stream to token stream with one compiled pattern
+    produces the same tokens as scanner_gen
+    :string: the character stream to convert
+    :preprocessed: string has already been preprocessed
+    '''
+    if not preprocessed:
+        string = preprocess(string)
+    return scan_chunks((string,))
+
+# tokens that could continue into the next chunk if they end a chunk
+INCOMPLETE = ('ident', 'number', 'unterminated')
+
+def scan_chunks(chunks: Iterable[str]) -> Iterator[Token]:
+    '''
+    convert a character stream that arrives in pieces to a token stream
+    a token at the end of a piece is held back until the next piece shows where it ends
+    :chunks: the preprocessed character stream
+    '''
+    for token, _ in scan_offsets(chunks):
+        yield token
+
+def scan_offsets(chunks: Iterable[str]) -> Iterator[tuple[Token, int]]:
+    '''
+    convert a character stream that arrives in pieces to tokens
+    :chunks: the preprocessed character stream
+    :returns: each token with the offset it starts at in the whole stream
+    '''
+    rest = ''
+    base = 0 # offset of the start of string in the whole stream
+    try:
+        for chunk in chunks:
+            string = rest + chunk if rest else chunk
+            rest = ''
+            end = len(string)
+            for match in TOKEN_PATTERN.finditer(string):
+                kind = match.lastgroup
+                if kind in INCOMPLETE and match.end() == end:
+                    rest = string[match.start():]
+                    break
+                # the opening quote of a string is outside its group
+                yield _token(match, kind), base + match.start(kind) - (kind == 'string')
+            base += end - len(rest)
+        for match in TOKEN_PATTERN.finditer(rest):
+            kind = match.lastgroup
+            if kind == 'unterminated':
+                # the character scanner drops an unterminated string
+                break
+            yield _token(match, kind), base + match.start(kind) - (kind == 'string')
+    except ScannerException as e:
+        raise e.at(base + match.start(kind), None)
+    yield END, base + len(rest)
+
+def _token(match: re.Match, kind: str) -> Token:
+    if kind == 'ident':
+        name = match.group(kind)
+        if name == 'True':
+            return TRUE
+        elif name == 'False':
+            return FALSE
+        return IdentToken(intern(name))
+    elif kind == 'lparen':
+        return LPAREN
+    elif kind == 'rparen':
+        return RPAREN
+    elif kind == 'number':
+        number = match.group(kind)
+        return ValueToken(float(number) if '.' in number else int(number))
+    elif kind == 'string':
+        value = match.group(kind)
+        if '\\' in value:
+            value = ESCAPE_PATTERN.sub(unescape, value)
+        return ValueToken(value)
+    raise ScannerException(f'Unexpected character inside int: {match.group(kind)}')
 
 class Scanner:
     '''
     A token stream iterator with 1 look ahead
+    the shared paren tokens cannot hold where they are, so the scanner keeps the
+    offset of the look ahead in the preprocessed source
     '''
-    def __init__(self, string: str):
+    def __init__(self, string: str, fast: bool = True, preprocessed: bool = False):
+        '''
+        :string: the character stream to scan
+        :fast: use the pattern based scanner instead of the character scanner
+        :preprocessed: string has already been preprocessed
+        '''
         self.string = string
+        self.fast = fast
+        self.preprocessed = preprocessed
 
     def __iter__(self):
-        self.iter = scanner_gen(self.string)
-        self.next = next(self.iter, None)
+        string = self.string if self.preprocessed else preprocess(self.string)
+        self.iter = scan_offsets((string,)) if self.fast else scan_characters(string)
+        self.next, self.offset = next(self.iter, (None, len(string)))
         return self
 
     def __next__(self) -> Token:
         if self.next is None:
             raise StopIteration
         ret = self.next
-        self.next = next(self.iter, None)
+        self.next, self.offset = next(self.iter, (None, self.offset))
+        return ret
+
+    def position(self) -> int:
+        '''get the offset of the look ahead in the preprocessed source'''
+        return self.offset
+
+UNREAD = object()
+
+class StreamScanner(Scanner):
+    '''
+    A token stream iterator with 1 look ahead over lines that are
+    preprocessed and scanned as they are read
+    the look ahead is only read when asked for so finishing an expression
+    does not read the line after it
+    '''
+    def __init__(self, lines: Iterable[str], preprocessed: bool = False, source_map: SourceMap | None = None):
+        '''
+        :lines: the lines of the character stream
+        :preprocessed: lines have already been preprocessed
+        :source_map: map each preprocessed line is added to as it is read
+        '''
+        self.lines = lines
+        self.preprocessed = preprocessed
+        self.source_map = source_map
+
+    def __iter__(self):
+        lines = self.lines if self.preprocessed else preprocess_lines(self.lines, source_map=self.source_map)
+        self.iter = scan_offsets(line + '\n' for line in lines)
+        self.offset = 0
+        self._next = UNREAD
+        return self
+
+    @property
+    def next(self) -> Token | None:
+        if self._next is UNREAD:
+            self._next, self.offset = next(self.iter, (None, self.offset))
+        return self._next
+
+    def __next__(self) -> Token:
+        ret = self.next
+        if ret is None:
+            raise StopIteration
+        self._next = UNREAD
         return ret
+
+    def position(self) -> int:
+        '''get the offset of the look ahead in the preprocessed source'''
+        self.next
+        return self.offset
+
+# the token pattern matched against the bytes of a file, whitespace and digits are only ascii
+BYTES_TOKEN_PATTERN = re.compile(TOKEN_PATTERN.pattern.encode(), re.VERBOSE | re.DOTALL)
+
+# a line that starts with a directive or a comment anywhere means a file has to be preprocessed
+PREPROCESSED_PATTERN = re.compile(rb'^[ \t\r\f\v]*#|//', re.MULTILINE)
+
+# bytes of a mapped file scanned between handing the pages behind them back to the system
+RELEASE_BYTES = 1024 * 1024
+
+def map_file(file: BinaryIO) -> mmap.mmap | bytes:
+    '''
+    map a file into memory read only
+    an empty file cannot be mapped so its empty contents are returned instead
+    :file: the file opened in binary mode
+    '''
+    if os.fstat(file.fileno()).st_size == 0:
+        return b''
+    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        data.madvise(mmap.MADV_SEQUENTIAL)
+    return data
+
+def needs_preprocessing(data: mmap.mmap | bytes) -> bool:
+    '''
+    check if the bytes of a file have any directives or comments for the preprocessor
+    the file is searched a window of whole lines at a time so its pages can be released
+    :data: the file
+    '''
+    releaser = _Releaser(data)
+    start, size = 0, len(data)
+    while start < size:
+        end = data.find(b'\n', start + RELEASE_BYTES)
+        end = size if end == -1 else end + 1
+        if PREPROCESSED_PATTERN.search(data, start, end) is not None:
+            return True
+        start = end
+        releaser.release(start)
+    return False
+
+class _Releaser:
+    '''
+    Drops the pages of a mapped file that have been read from the memory of the
+    process, so scanning a file larger than memory does not keep all of it resident
+    the pages stay in the page cache and are read again if they are used again
+    '''
+    def __init__(self, data: mmap.mmap | bytes):
+        self.data = data if isinstance(data, mmap.mmap) and hasattr(mmap, 'MADV_DONTNEED') else None
+        self.released = 0 # every page before this offset has been released
+        self.next = RELEASE_BYTES
+
+    def release(self, offset: int):
+        '''
+        release the pages before an offset that will not be read again
+        :offset: where reading has got to
+        '''
+        if offset < self.next or self.data is None:
+            return
+        end = offset - offset % mmap.PAGESIZE
+        self.data.madvise(mmap.MADV_DONTNEED, self.released, end - self.released)
+        self.released = end
+        self.next = end + RELEASE_BYTES
+
+def mapped_lines(data: mmap.mmap | bytes) -> Iterator[str]:
+    '''
+    decode the lines of a mapped file one at a time
+    :data: the file
+    '''
+    releaser = _Releaser(data)
+    start, size = 0, len(data)
+    while start < size:
+        end = data.find(b'\n', start)
+        if end == -1:
+            end = size
+        yield data[start:end].decode()
+        start = end + 1
+        releaser.release(start)
+
+def scan_bytes(data: mmap.mmap | bytes) -> Iterator[tuple[Token, int]]:
+    '''
+    convert the bytes of a file that needs no preprocessing to tokens
+    only the names and strings of tokens are decoded
+    :data: the file
+    :returns: each token with the offset in bytes it starts at
+    '''
+    releaser = _Releaser(data)
+    match = None
+    try:
+        for match in BYTES_TOKEN_PATTERN.finditer(data):
+            kind = match.lastgroup
+            if kind == 'unterminated':
+                break
+            start = match.start(kind)
+            yield _byte_token(match, kind), start - (kind == 'string')
+            releaser.release(start)
+    except ScannerException as e:
+        raise e.at(match.start(kind), None)
+    except UnicodeDecodeError as e:
+        raise ScannerException(f'Invalid utf-8: {e.reason}', match.start(kind) + e.start)
+    yield END, len(data)
+
+def _byte_token(match: re.Match, kind: str) -> Token:
+    if kind == 'ident':
+        name = match.group(kind)
+        if name == b'True':
+            return TRUE
+        elif name == b'False':
+            return FALSE
+        return IdentToken(intern(name.decode()))
+    elif kind == 'lparen':
+        return LPAREN
+    elif kind == 'rparen':
+        return RPAREN
+    elif kind == 'number':
+        number = match.group(kind)
+        return ValueToken(float(number) if b'.' in number else int(number))
+    elif kind == 'string':
+        value = match.group(kind).decode()
+        if '\n' in value:
+            value = _strip_lines(value)
+        if '\\' in value:
+            value = ESCAPE_PATTERN.sub(unescape, value)
+        return ValueToken(value)
+    raise ScannerException(f'Unexpected character inside int: {match.group(kind).decode(errors="replace")}')
+
+def _strip_lines(value: str) -> str:
+    '''
+    strip the whitespace around the line breaks of a string that spans lines, the
+    preprocessor strips every line so a string scanned without it has to match
+    :value: the string
+    '''
+    lines = value.split('\n')
+    return '\n'.join([lines[0].rstrip(), *(line.strip() for line in lines[1:-1]), lines[-1].lstrip()])
+
+class MappedScanner(StreamScanner):
+    '''
+    A token stream iterator with 1 look ahead over the bytes of a mapped file that
+    needs no preprocessing, offsets are in bytes
+    '''
+    def __init__(self, data: mmap.mmap | bytes):
+        '''
+        :data: the file
+        '''
+        self.data = data
+
+    def __iter__(self):
+        self.iter = scan_bytes(self.data)
+        self.offset = 0
+        self._next = UNREAD
+        return self
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+'''
+Long running interpreter that takes programs over a unix domain socket
+every request and response is one line of json
+request: {"id": any, "program": str, "session": str | null, "timeout": float | null}
+response: {"id": any, "result": str | null, "output": str, "error": str | null}
+'''
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from symbol_table import Env, new_symbol_table
+from output import Output, EXIT
+import asyncio
+import signal
+import io
+import tempfile
+import json
+import os
+import interpret
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'simple_s_exprs.sock')
+# longest request line accepted, in bytes
+MAX_REQUEST = 16 * 1024 * 1024
+# seconds a program may run if the request does not say
+DEFAULT_TIMEOUT = 10.0
+# seconds to wait past the time limit for a program to stop itself
+TIMEOUT_GRACE = 1.0
+
+class Session:
+    '''A symbol table kept between requests, one request runs in it at a time'''
+    def __init__(self):
+        self.symbol_table = new_symbol_table()
+        self.lock = asyncio.Lock()
+        # a program that timed out but is still running in the symbol table, requests are
+        # turned away until it finishes
+        self.stuck: asyncio.Future | None = None
+
+    def _finished(self, job: asyncio.Future):
+        if self.stuck is job:
+            self.stuck = None
+
+def run_program(program: str, symbol_table: Env, timeout: float) -> dict[str, any]:
+    '''
+    run a program, capturing what it prints
+    :program: source of the program
+    :symbol_table: global frame to run in
+    :timeout: seconds the program may run
+    :returns: the result, output and error parts of the response
+    '''
+    output = Output(io.StringIO(), EXIT)
+    # print and flush are shadowed for this request only, so requests on other threads are not captured
+    output.install(symbol_table)
+    result, error = None, None
+    try:
+        value = interpret.evaluate(program, symbol_table, limits=interpret.Limits(seconds=timeout))
+        if value is not None:
+            result = repr(value)
+    except interpret.ERRORS as e:
+        error = str(e)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    finally:
+        output.uninstall(symbol_table)
+    output.flush()
+    return {'result': result, 'output': output.file.getvalue(), 'error': error}
+
+class Server:
+    '''
+    Runs programs for many clients at once
+    programs run on a pool of threads so a long program does not hold up the others
+    '''
+    def __init__(self, path: str = DEFAULT_SOCKET, workers: int | None = None, timeout: float = DEFAULT_TIMEOUT):
+        '''
+        :path: file of the unix domain socket
+        :workers: number of threads running programs
+        :timeout: seconds a program may run if the request does not say
+        '''
+        self.path = path
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(workers)
+        self.sessions: dict[str, Session] = {}
+
+    async def serve(self, ready: asyncio.Event | None = None):
+        '''
+        listen on the socket until cancelled
+        :ready: set once the socket accepts connections
+        '''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self.connection, self.path, limit=MAX_REQUEST)
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    async def connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        '''
+        answer every request of one client, requests on a connection may run at the same time
+        :reader: requests from the client
+        :writer: responses to the client
+        '''
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self.respond(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        except (ConnectionError, ValueError):
+            pass # the client went away or sent a line that is too long
+        finally:
+            writer.close()
+
+    async def respond(self, line: bytes, writer: asyncio.StreamWriter):
+        '''
+        run one request and write its response
+        :line: the json request
+        :writer: where the response goes
+        '''
+        try:
+            request = json.loads(line)
+            response = {'id': request.get('id')}
+            response.update(await self.run(request))
+        except (json.JSONDecodeError, AttributeError, TypeError, KeyError) as e:
+            response = {'id': None, 'result': None, 'output': '', 'error': f'bad request: {e}'}
+        writer.write(json.dumps(response).encode() + b'\n')
+        await writer.drain()
+
+    async def run(self, request: dict[str, any]) -> dict[str, any]:
+        '''
+        run the program of a request in its session or a new symbol table
+        :request: the decoded request
+        '''
+        program = request['program']
+        if not isinstance(program, str):
+            raise TypeError('program must be a string')
+        timeout = request.get('timeout') or self.timeout
+        name = request.get('session')
+        loop = asyncio.get_running_loop()
+        if name is None:
+            job = loop.run_in_executor(self.executor, run_program, program, new_symbol_table(), timeout)
+            return await self.wait(job, timeout)
+        session = self.sessions.setdefault(name, Session())
+        async with session.lock:
+            if session.stuck is not None:
+                return {'result': None, 'output': '', 'error': f'session {name} is still running a program that timed out'}
+            job = loop.run_in_executor(self.executor, run_program, program, session.symbol_table, timeout)
+            response = await self.wait(job, timeout)
+            if not job.done():
+                session.stuck = job
+                job.add_done_callback(session._finished)
+            return response
+
+    async def wait(self, job: asyncio.Future, timeout: float) -> dict[str, any]:
+        '''
+        wait for a program to finish
+        the program stops itself at its time limit, a builtin that does not return in
+        time, like input, is reported as timed out and its thread is left to finish
+        :job: the running program, still running if it timed out
+        :timeout: seconds the program may run
+        '''
+        try:
+            # cancelling the job would not stop its thread, only hide when it finishes
+            return await asyncio.wait_for(asyncio.shield(job), timeout + TIMEOUT_GRACE)
+        except asyncio.TimeoutError:
+            return {'result': None, 'output': '', 'error': f'timed out after {timeout}s'}
+
+def main():
+    '''Driver Code'''
+    arg_parser = ArgumentParser(description='Run programs sent over a unix domain socket')
+    arg_parser.add_argument('--socket', default=DEFAULT_SOCKET, help='file of the socket to listen on')
+    arg_parser.add_argument('--workers', type=int, help='number of threads running programs')
+    arg_parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='seconds a program may run if the request does not say')
+    args = arg_parser.parse_args()
+    async def serve():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        await Server(args.socket, args.workers, args.timeout).serve()
+    try:
+        asyncio.run(serve())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+'''
+Maps offsets in preprocessed source back to the file, line and column they came from
+'''
+
+from bisect import bisect_right
+from dataclasses import dataclass
+import linecache
+
+# name of a program that was not read from a file
+INPUT = '<input>'
+
+@dataclass(slots=True, frozen=True)
+class Origin:
+    path: str
+    line: int               # counted from 1
+    column: int             # counted from 1
+    macro: str | None = None # macro whose expansion the offset is in
+
+    def __str__(self) -> str:
+        return f'{self.path}:{self.line}:{self.column}'
+
+class SourceMap:
+    '''
+    Where each piece of a preprocessed program came from
+    the output is split into segments that each start at an offset, a segment is
+    a line or the text before, inside or after a macro on a line, and is stored as
+    the file, line and column its first character came from
+    a map made with the text of a program is only built when it is first used
+    '''
+    def __init__(self, path: str | None = None, text: str | None = None):
+        '''
+        :path: file the program came from
+        :text: source of the program, kept to show the lines errors are on
+        '''
+        self.path = INPUT if path is None else path
+        self.text = text
+        self.lines = None if text is None else text.split('\n')
+        self.built = text is None
+        self.starts: list[int] = []
+        self.origins: list[tuple[str, int, int, str | None]] = []
+        # offset the line being added starts at
+        self.end = 0
+        # segments before the first one kept were dropped by forget
+        self.forgotten = False
+
+    def add(self, column: int, path: str, line: int, source_column: int, macro: str | None = None):
+        '''
+        note where a piece of the line being added came from
+        :column: where the piece starts in the output line, counted from 0
+        :path: file the piece came from
+        :line: line the piece came from
+        :source_column: column the piece came from, counted from 1
+        :macro: macro the piece is the expansion of
+        '''
+        self.starts.append(self.end + column)
+        self.origins.append((path, line, source_column, macro))
+
+    def end_line(self, length: int):
+        '''
+        finish the line being added
+        :length: length of the output line without its newline
+        '''
+        self.end += length + 1
+
+    def merge(self, other: 'SourceMap', length: int):
+        '''
+        add the map of an included file as the line being added
+        :other: map of the output of the included file
+        :length: length of the output of the included file
+        '''
+        base = self.end
+        self.starts.extend(start + base for start in other.starts)
+        self.origins.extend(other.origins)
+        self.end_line(length)
+
+    def strip(self, count: int):
+        '''
+        remove characters from the front of the output
+        :count: number of characters removed
+        '''
+        if not count:
+            return
+        first = max(bisect_right(self.starts, count) - 1, 0)
+        starts, origins = self.starts[first:], self.origins[first:]
+        if starts and starts[0] < count:
+            path, line, column, macro = origins[0]
+            if macro is None:
+                column += count - starts[0]
+            starts[0], origins[0] = count, (path, line, column, macro)
+        self.starts = [start - count for start in starts]
+        self.origins = origins
+        self.end -= count
+
+    def forget(self, offset: int):
+        '''
+        drop the segments before the one an offset is in
+        a streamed program calls this before parsing each top level expression, so the
+        map only keeps the expression being run, offsets in the segments dropped are
+        found again from the file if an error needs them
+        :offset: where the expression starts
+        '''
+        index = bisect_right(self.starts, offset) - 1
+        if index > 0:
+            del self.starts[:index]
+            del self.origins[:index]
+            self.forgotten = True
+
+    def relocate(self, offset: int) -> Origin | None:
+        '''
+        find where an offset in a dropped segment came from by preprocessing the file
+        again, keeping only the segments of the line being preprocessed
+        :offset: offset in the preprocessed program
+        :returns: its origin, or None if the program was not read from a file that can be read again
+        '''
+        from preprocess import preprocess_lines, IncludeManager
+        source_map = SourceMap(self.path)
+        try:
+            with open(self.path, 'r') as file:
+                for _ in preprocess_lines(file, includes=IncludeManager(), path=self.path, source_map=source_map):
+                    if source_map.end > offset:
+                        return source_map.locate(offset)
+                    source_map.forget(source_map.end)
+        except Exception:
+            pass # the file is gone or no longer preprocesses the same way
+        return None
+
+    def build(self):
+        '''preprocess the text again to fill in the map'''
+        from preprocess import preprocess, IncludeManager
+        self.built = True
+        try:
+            preprocess(self.text, includes=IncludeManager(), source_map=self)
+        except Exception:
+            pass # what was mapped before the error is still useful
+
+    def locate(self, offset: int) -> Origin | None:
+        '''
+        find where an offset in the preprocessed program came from
+        :offset: offset in the preprocessed program
+        '''
+        if not self.built:
+            self.build()
+        index = bisect_right(self.starts, offset) - 1
+        if index < 0:
+            return self.relocate(offset) if self.forgotten else None
+        path, line, column, macro = self.origins[index]
+        if macro is None:
+            column += offset - self.starts[index]
+        return Origin(path, line, column, macro)
+
+    def source_line(self, origin: Origin) -> str | None:
+        '''
+        get the line of source an origin is on
+        :origin: where in the source
+        '''
+        if origin.path == self.path and self.lines is not None:
+            if origin.line <= len(self.lines):
+                return self.lines[origin.line - 1]
+            return None
+        linecache.checkcache(origin.path)
+        return linecache.getline(origin.path, origin.line).rstrip('\n') or None
+
+    def excerpt(self, origin: Origin) -> str | None:
+        '''
+        show the line of source an origin is on with a caret under its column
+        :origin: where in the source
+        '''
+        line = self.source_line(origin)
+        if line is None:
+            return None
+        # tabs are kept so the caret lines up however wide they are shown
+        indent = ''.join(ch if ch == '\t' else ' ' for ch in line[:origin.column - 1])
+        indent = indent.ljust(origin.column - 1)
+        return f'{line}\n{indent}^'
+
+class MappedSourceMap(SourceMap):
+    '''
+    Where offsets in the bytes of a mapped file that was not preprocessed came from
+    the line of an offset is only counted when an error needs it, a chunk at a time
+    so the file is not copied whole
+    '''
+    CHUNK = 1024 * 1024
+
+    def __init__(self, path: str, data: bytes):
+        '''
+        :path: the file
+        :data: its mapped bytes
+        '''
+        super().__init__(path)
+        self.data = data
+        self.line_starts: dict[int, int] = {}
+
+    def locate(self, offset: int) -> Origin | None:
+        data = self.data
+        offset = min(offset, len(data))
+        line = 1 + sum(data[start:min(start + self.CHUNK, offset)].count(b'\n') for start in range(0, offset, self.CHUNK))
+        start = data.rfind(b'\n', 0, offset) + 1
+        self.line_starts[line] = start
+        return Origin(self.path, line, len(data[start:offset].decode(errors='replace')) + 1)
+
+    def source_line(self, origin: Origin) -> str | None:
+        start = self.line_starts.get(origin.line)
+        if origin.path != self.path or start is None:
+            return None
+        end = self.data.find(b'\n', start)
+        return self.data[start:len(self.data) if end == -1 else end].decode(errors='replace').rstrip('\r')
+
+class SourceError(Exception):
+    '''
+    An error that can say where in the source it happened
+    it is raised with the offset in the preprocessed program and the map of that
+    program, or with its origin when that is already known
+    '''
+    def __init__(self, message: str = '', pos: int | None = None, source: SourceMap | None = None, origin: Origin | None = None):
+        '''
+        :message: what went wrong
+        :pos: offset in the preprocessed program
+        :source: map of the program
+        :origin: where in the source, found from pos and source if not given
+        '''
+        super().__init__(message)
+        self.message = message
+        self.pos = pos
+        self.source = source
+        self._origin = origin
+
+    def at(self, pos: int | None, source: SourceMap | None) -> 'SourceError':
+        '''
+        fill in where the error happened if it is not known yet
+        :pos: offset in the preprocessed program
+        :source: map of the program
+        :returns: the error
+        '''
+        if self.pos is None and self._origin is None:
+            self.pos = pos
+        if self.source is None:
+            self.source = source
+        return self
+
+    @property
+    def origin(self) -> Origin | None:
+        if self._origin is None and self.pos is not None and self.source is not None:
+            self._origin = self.source.locate(self.pos)
+        return self._origin
+
+    @origin.setter
+    def origin(self, origin: Origin | None):
+        self._origin = origin
+
+    def __str__(self) -> str:
+        origin = self.origin
+        if origin is None:
+            return self.message
+        if origin.macro is not None:
+            return f'{origin}: {self.message} (in macro {origin.macro})'
+        return f'{origin}: {self.message}'
+
+    def report(self) -> str:
+        '''describe the error with the line it happened on and a caret under where'''
+        origin = self.origin
+        if origin is None or self.source is None:
+            return str(self)
+        excerpt = self.source.excerpt(origin)
+        return str(self) if excerpt is None else f'{self}\n{excerpt}'
@@ -1,7 +1,16 @@
 from typing import TypeVar
+from output import STDOUT
+
+try:
+    import numpy as np
+except ImportError: # vectors are only available with numpy installed
+    np = None
 
 T = TypeVar('T')
 
+# type of the values made by vec and range_vec
+VECTOR = None if np is None else np.ndarray
+
 KEYWORDS = [
     'assign', '=',
     'add_assign', '+=',
@@ -13,32 +22,106 @@ KEYWORDS = [
     'dec', '--',
     'if',
     'def',
+    'defmemo',
     'while',
     'for',
     'fore',
 ]
 
-def copy_table(src: dict[str, any], dst: dict[str, any]):
+class Env(dict):
     '''
-    copy contents of one symbol table into another
-    :src: the table to copy from
-    :dst: the table to copy to
+    A frame of the symbol table linked to the frame it was created in
+    lookups that miss in this frame walk up the chain of parents
+    assignments always go to this frame
     '''
-    # delete all keys
-    for key in list(dst.keys()):
-        del dst[key]
-    # add keys back
-    for key, value in src.items():
-        dst[key] = value
-
-def new_symbol_table() -> dict[str, any]:
-    '''Create a symbol table'''
+    __slots__ = ('parent',)
+
+    def __init__(self, symbols: dict[str, any] | None = None, parent: 'Env | None' = None):
+        super().__init__(symbols or ())
+        self.parent = parent
+
+    def __missing__(self, name: str) -> any:
+        if self.parent is None:
+            raise KeyError(name)
+        return self.parent[name]
+
+    def __contains__(self, name: str) -> bool:
+        env = self
+        while env is not None:
+            if dict.__contains__(env, name):
+                return True
+            env = env.parent
+        return False
+
+    def get(self, name: str, default: any = None) -> any:
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def child(self, symbols: dict[str, any] | None = None) -> 'Env':
+        '''
+        create a new frame whose parent is this frame
+        :symbols: initial contents of the new frame
+        '''
+        return Env(symbols, self)
+
+    def snapshot(self) -> 'Snapshot':
+        '''
+        freeze this frame so any number of frames can be forked from it
+        the frame is changed in place rather than copied so the functions defined in it
+        still find its names, and assigning to it raises from now on so a fork never
+        sees a change made after it was created
+        values are shared and not copied, a list changed in place changes in every fork
+        :returns: this frame, which can no longer be assigned to
+        '''
+        self.__class__ = Snapshot
+        return self
+
+class Snapshot(Env):
+    '''
+    A frame frozen by Env.snapshot
+    forks of it are empty frames whose lookups fall through to it, so making one costs
+    the same however many names the snapshot has
+    '''
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        from interpret import InterpretException # imported here since the interpreter needs the builtins
+        raise InterpretException('a snapshot of the symbol table is read only, assign in a fork of it')
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    update = setdefault = pop = popitem = clear = _read_only
+
+    def fork(self, symbols: dict[str, any] | None = None) -> Env:
+        '''
+        create a frame that reads from the snapshot and keeps its own assignments
+        :symbols: initial contents of the fork
+        '''
+        return Env(symbols, self)
+
+class ReadOnlyEnv(Env):
+    '''A frame that cannot be assigned to, used for the builtins'''
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        from interpret import InterpretException # imported here since the interpreter needs the builtins
+        raise InterpretException('the builtin symbol table is read only')
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    update = setdefault = pop = popitem = clear = _read_only
+
+def builtins() -> dict[str, any]:
+    '''Create the builtin functions'''
     def neg(a: T) -> T:
         return -a
 
     def add(first: T, *rest: T) -> T:
         for i in rest:
-            first += i
+            if type(first) is VECTOR:
+                first = first + i # never change a vector in place
+            else:
+                first += i
         return first
 
     def sub(a: T, b: T) -> T:
@@ -46,7 +129,10 @@ def new_symbol_table() -> dict[str, any]:
 
     def mul(first: T, *rest: T) -> T:
         for i in rest:
-            first *= i
+            if type(first) is VECTOR:
+                first = first * i
+            else:
+                first *= i
         return first
 
     def div(a: T, b: T) -> T:
@@ -83,8 +169,68 @@ def new_symbol_table() -> dict[str, any]:
         list_.append(item)
         return list_
 
+    def vector(items) -> 'np.ndarray':
+        if np is None:
+            raise TypeError('vectors need numpy to be installed')
+        return items if type(items) is VECTOR else np.asarray(items)
+
+    def scalar(value: T) -> T:
+        return value.item() if isinstance(value, np.generic) else value
+
+    def vec(*items: T) -> 'np.ndarray':
+        if len(items) == 1 and isinstance(items[0], list | VECTOR):
+            return vector(items[0]).copy()
+        return vector(items)
+
+    def range_vec(*args: T) -> 'np.ndarray':
+        if np is None:
+            raise TypeError('vectors need numpy to be installed')
+        return np.arange(*args)
+
+    def sum_(items: T) -> T:
+        if type(items) is VECTOR:
+            return scalar(items.sum())
+        return sum(items)
+
+    def dot(a: T, b: T) -> T:
+        a, b = vector(a), vector(b)
+        return scalar(np.dot(a, b))
+
+    def map_vec(function: T, items: T) -> 'np.ndarray':
+        items = vector(items)
+        return np.array([function(i) for i in items.tolist()])
+
+    def filter_vec(function: T, items: T) -> 'np.ndarray':
+        items = vector(items)
+        if type(function) is VECTOR:
+            return items[function.astype(bool)]
+        return items[np.array([bool(function(i)) for i in items.tolist()], dtype=bool)]
+
+    def pmap(function: T, items: T, chunksize: int | None = None) -> list[T]:
+        import parallel # imported here since parallel needs the interpreter, which needs the builtins
+        return parallel.pmap(function, items, chunksize)
+
+    def pfore(function: T, items: T, chunksize: int | None = None) -> T:
+        import parallel
+        return parallel.pfore(function, items, chunksize)
+
+    def input_(*prompt: str) -> str:
+        STDOUT.flush() # the prompt comes after what was printed before it
+        return input(*prompt)
+
+    def memo_info(function: T) -> dict[str, int]:
+        if getattr(function, 'memo', None) is None:
+            raise TypeError(f'{function!r} is not memoized')
+        return function.memo.info()
+
+    def memo_clear(function: T):
+        if getattr(function, 'memo', None) is None:
+            raise TypeError(f'{function!r} is not memoized')
+        function.memo.clear()
+
     return {
-        'print': print,
+        'print': STDOUT.print,
+        'flush': STDOUT.flush,
         'neg': neg,
         'add': add,
         '+': add,
@@ -110,10 +256,26 @@ def new_symbol_table() -> dict[str, any]:
         'lst': lst,
         'append': append,
         'app': append,
-        'input': input,
+        'input': input_,
         'int': int,
         'float': float,
         'str': str,
         'len': len,
+        'vec': vec,
+        'range_vec': range_vec,
+        'sum': sum_,
+        'dot': dot,
+        'map_vec': map_vec,
+        'filter_vec': filter_vec,
+        'pmap': pmap,
+        'pfore': pfore,
+        'memo_info': memo_info,
+        'memo_clear': memo_clear,
     }
 
+
+BUILTINS = ReadOnlyEnv(builtins())
+
+def new_symbol_table() -> Env:
+    '''Create a symbol table whose parent is the shared builtin frame'''
+    return Env(parent=BUILTINS)
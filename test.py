@@ -4,9 +4,36 @@
 Test cases
 '''
 
-from preprocess import preprocess
-from interpret import interpret
+from preprocess import preprocess, preprocess_lines, PreprocesserException, IncludeManager
+from interpret import ERRORS, interpret, interpret_stream, interpret_mapped, evaluate, eval_tree, compile_tree, shadowed_names, InterpretException, LimitExceeded, Limits
+from symbol_table import new_symbol_table, Env, Snapshot, BUILTINS, np
+from cache import ProgramCache
+from source_map import SourceMap, Origin
+from profiler import Profiler
+from output import Output, LINE, SIZE, EXIT
+import parser as ps
+import scanner as sc
+import optimize as opt
+import vm
+import batch
+import parallel
+import server
+import client
 import unittest
+import io
+import contextlib
+import tempfile
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import socket
+import json
+import time
+import tracemalloc
+import subprocess
+import sys
+from typing import Callable, Iterator
 
 class TestPreprocess(unittest.TestCase):
     def test_comments(self):
@@ -18,137 +45,1065 @@ class TestPreprocess(unittest.TestCase):
         self.assertEqual(preprocess('#def p (print \'test\')\n (print \'just p\')'), '(print \'just p\') ')
         self.assertEqual(preprocess('#def p (print \'test\')\n (print \'just \\\' p\')'), '(print \'just \\\' p\') ')
 
+    def test_nested_macro(self):
+        self.assertEqual(preprocess('#def one 1\n#def two (+ one one)\n(print two \'two\')'), "(print (+ 1 1) 'two') ")
+        self.assertEqual(preprocess("#def q 'x\n(print q q)"), "(print 'x q) ")
+
+    def test_recursive_macro(self):
+        with self.assertRaises(PreprocesserException):
+            preprocess('#def a (a)\na')
+        with self.assertRaises(PreprocesserException):
+            preprocess('#def a b\n#def b a\na')
+
+    def test_many_macros(self):
+        macros = ''.join(f'#def m{i} {i}\n' for i in range(500))
+        self.assertEqual(preprocess(macros + '(+ m1 m499 m20)'), '(+ 1 499 20) ')
+
     def test_include(self):
         self.assertEqual(preprocess('#inc test.txt\n(f)'), '(def f () 1) \n\n(f) ')
         self.assertEqual(preprocess('#inc test.txt\n(+ (f) 10)'), '(def f () 1) \n\n(+ (f) 10) ')
 
+SCANNER_INPUTS = [
+    '(print \'Hello World!\' 100)',
+    '(add (mul 2.5 8) 20) (print (< 1 2))',
+    '(print \'That\\\'s\\nescaping! \\q \\t\')',
+    '(if True (print True) False)',
+    '(= slashes/too \'multi\nline\') slashes/too',
+    '(+= x 1.)(-- y)(print x\'y)',
+    '\'unterminated (string',
+]
+
+class TestIncludes(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.includes = IncludeManager()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name: str, text: str) -> str:
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_memoized(self):
+        header = self.write('header.txt', '#def two 2\n(= one 1)')
+        for _ in range(3):
+            self.assertEqual(preprocess(f'#inc {header}\ntwo', includes=self.includes), '(= one 1) \n\n2 ')
+        self.assertEqual(self.includes.stats[header].loads, 1)
+        self.assertEqual(self.includes.stats[header].hits, 2)
+        self.assertIn(header, self.includes.report())
+
+    def test_changed_dependency(self):
+        inner = self.write('inner.txt', '(= x 1)')
+        outer = self.write('outer.txt', f'#inc {inner}')
+        self.assertEqual(preprocess(f'#inc {outer}', includes=self.includes), '(= x 1) ')
+        self.write('inner.txt', '(= x 10)')
+        self.assertEqual(preprocess(f'#inc {outer}', includes=self.includes), '(= x 10) ')
+        self.assertEqual(self.includes.dependencies(outer), {inner})
+
+    def test_macros_before_include(self):
+        header = self.write('header.txt', '(print m)')
+        self.assertEqual(preprocess(f'#def m 1\n#inc {header}', includes=self.includes), '(print 1) ')
+        self.assertEqual(preprocess(f'#def m 2\n#inc {header}', includes=self.includes), '(print 2) ')
+
+    def test_cycle(self):
+        a = os.path.join(self.directory.name, 'a.txt')
+        b = self.write('b.txt', f'#inc {a}')
+        self.write('a.txt', f'#inc {b}')
+        with self.assertRaises(PreprocesserException):
+            preprocess(f'#inc {a}', includes=self.includes)
+
+    def test_once(self):
+        a = os.path.join(self.directory.name, 'a.txt')
+        b = self.write('b.txt', f'#inc {a}\n(= b 1)')
+        self.write('a.txt', f'#once\n#inc {b}\n(= a 1)')
+        self.assertEqual(preprocess(f'#inc {a}\n#inc {a}', includes=self.includes).split(), ['(=', 'b', '1)', '(=', 'a', '1)'])
+        self.assertEqual(preprocess(f'#inc {a}', includes=self.includes).split(), ['(=', 'b', '1)', '(=', 'a', '1)'])
+
+    def test_inputs_do_not_share_state(self):
+        a = self.write('a.txt', '#once\n(= a 1)')
+        first = preprocess_lines([f'#inc {a}', f'#inc {a}'], includes=self.includes)
+        self.assertEqual(next(first).split(), ['(=', 'a', '1)'])
+        self.assertEqual(list(preprocess_lines(['(+ 1 2)'], includes=self.includes)), ['(+ 1 2)'])
+        self.assertEqual(list(first), ['', '', ''])
+
+    def test_bounded(self):
+        includes = IncludeManager(max_files=2)
+        paths = [self.write(f'{i}.txt', f'(= x {i})') for i in range(4)]
+        for path in paths:
+            preprocess(f'#inc {path}', includes=includes)
+        self.assertEqual(list(includes.files), paths[2:])
+        self.assertEqual(set(includes.stats), set(paths[2:]))
+
+class TestScanner(unittest.TestCase):
+    def test_fast_matches_character_scanner(self):
+        inputs = SCANNER_INPUTS[:]
+        for name in os.listdir('examples'):
+            if name not in ('inc.txt',):
+                with open(os.path.join('examples', name)) as f:
+                    inputs.append(f.read())
+        for string in inputs:
+            with self.subTest(string=string):
+                self.assertEqual(list(sc.fast_scanner_gen(string)), list(sc.scanner_gen(string)))
+
+    def test_bad_number(self):
+        for string in ('12a', '1.2.3', '4\'x\''):
+            with self.subTest(string=string):
+                with self.assertRaises(sc.ScannerException):
+                    list(sc.fast_scanner_gen(string))
+                with self.assertRaises(sc.ScannerException):
+                    list(sc.scanner_gen(string))
+
+class TestParser(unittest.TestCase):
+    def test_compact_nodes(self):
+        for node in ps.walk(ps.program('(def f (x) (if (< x 1) (+= x 1) x)) (for i (3) (f i)) (fore i (lst 1) (++ i))')):
+            with self.subTest(node=node):
+                self.assertFalse(hasattr(node, '__dict__'))
+
+    def test_shared_tokens(self):
+        tokens = list(sc.fast_scanner_gen('(f x) (f x)'))
+        self.assertIs(tokens[0], tokens[4])
+        self.assertIs(tokens[1].name, tokens[5].name)
+
+    def test_positions(self):
+        source = '(def f (x)\n(+ x 1))\n(print  (f 2))'
+        for tree in (ps.program(source), *ps.program_stream(io.StringIO(source))):
+            for node in ps.walk(tree):
+                with self.subTest(node=node):
+                    # constants cannot fail so they keep no position
+                    self.assertEqual(node.pos is None, isinstance(node, ps.ValueNode))
+        define, call = ps.program(source).body
+        self.assertEqual(define.pos, 0)
+        self.assertEqual(define.body.pos, 11)
+        self.assertEqual(define.body.arguments[0].pos, 14)
+        self.assertEqual(call.arguments[0].pos, 28)
+        self.assertEqual(ps.program('(f)'), ps.program('\n\n(f)'))
+
+class TestSourceMap(unittest.TestCase):
+    def error(self, program: str, run: Callable = evaluate, **kwargs) -> InterpretException:
+        with self.assertRaises(ERRORS) as caught:
+            run(program, **kwargs)
+        return caught.exception
+
+    def test_runtime_errors(self):
+        self.assertEqual(str(self.error('(print x)')), '<input>:1:8: x not in symbol table')
+        error = self.error('(def f (x) (g x))\n  (def g (y) (h y))\n(f 1)', path='prog')
+        self.assertEqual(str(error), 'prog:2:14: h not in symbol table')
+        self.assertEqual(error.report(), 'prog:2:14: h not in symbol table\n  (def g (y) (h y))\n             ^')
+        # errors without a place of their own are put at the call they came out of
+        self.assertEqual(str(self.error('(def f (x) x)\n(f 1 2)')), '<input>:2:1: f expected 1 arguments but got 2')
+
+    def test_vm_runtime_errors(self):
+        self.assertEqual(str(self.error('(def k (x) x)\n(k)', vm.evaluate)), '<input>:2:1: k expected 1 arguments but got 0')
+        self.assertEqual(str(self.error('(def f (x) (g x))\n  (def g (y) (h y))\n(f 1)', vm.evaluate, path='prog')), 'prog:2:14: h not in symbol table')
+        self.assertEqual(str(self.error('(+ 1\n  (len 5))', vm.evaluate)), "<input>:2:3: object of type 'int' has no len()")
+        # a tail call is put at the call, not at the call of the function it is in
+        self.assertEqual(str(self.error('(def f () (g))\n(def g (x) x)\n(f)', vm.evaluate)), '<input>:1:11: g expected 1 arguments but got 0')
+        self.assertEqual(str(self.error('  (= a 1)\n#def Y (+ a q)\n\n   (print Y a)', vm.evaluate)), '<input>:4:11: q not in symbol table (in macro Y)')
+
+    def test_parse_errors(self):
+        self.assertEqual(self.error('(+ 1 2').report(), '<input>:1:8: Unexpected token EndToken()\n(+ 1 2\n       ^')
+        self.assertEqual(str(self.error('\t(+ 12a)')), '<input>:1:7: Unexpected character inside int: a')
+        self.assertEqual(self.error('\t(+ 12a)').report().split('\n')[-1], '\t     ^')
+        self.assertEqual(str(self.error('\n#foo')), '<input>:2:1: Unknown preprocessor directive: foo')
+        self.assertEqual(str(self.error('(for i () i)')), '<input>:1:9: Expected at least one range argument for the for loop')
+
+    def test_macros(self):
+        source = '  (= a 1)\n#def Y (+ a q)\n\n   (print Y a)'
+        preprocessed = preprocess(source)
+        source_map = SourceMap(text=source)
+        self.assertEqual(source_map.locate(preprocessed.index('(= a')), Origin('<input>', 1, 3))
+        self.assertEqual(source_map.locate(preprocessed.index('(+ a')), Origin('<input>', 4, 11, 'Y'))
+        self.assertEqual(source_map.locate(preprocessed.rindex('a)')), Origin('<input>', 4, 13))
+        self.assertEqual(str(self.error(source)), '<input>:4:11: q not in symbol table (in macro Y)')
+
+    def test_many_macro_uses(self):
+        source = '#def m (+ 1 2)\n' + ' '.join(['m'] * 1000) + ' (q)'
+        preprocessed = preprocess(source)
+        source_map = SourceMap(text=source)
+        self.assertEqual(source_map.locate(preprocessed.rindex('(+')), Origin('<input>', 2, 1999, 'm'))
+        self.assertEqual(source_map.locate(preprocessed.index('(q')), Origin('<input>', 2, 2001))
+
+    def test_includes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'lib.txt')
+            with open(path, 'w') as file:
+                file.write('\n(def f (x)\n    (g x))')
+            error = self.error(f'(= a 1)\n#inc {path}\n(f a)')
+            self.assertEqual(str(error), f'{path}:3:5: g not in symbol table')
+            self.assertEqual(error.report().split('\n')[1:], ['    (g x))', '    ^'])
+            self.assertEqual(str(self.error(f'#inc {path}\n(f a)')), '<input>:2:4: a not in symbol table')
+            self.assertTrue(str(self.error(f'(f 1)\n#inc {directory}/missing')).startswith(f'<input>:2:1: Could not include {directory}/missing'))
+
+    def test_stream(self):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            interpret_stream(io.StringIO('(= a 1)\n  (print b)'))
+        self.assertEqual(stdout.getvalue(), '<input>:2:10: b not in symbol table\n')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'prog.txt')
+            with open(path, 'w') as file:
+                file.write('(= a 1)\n(print (+ a\n  b))')
+            stdout = io.StringIO()
+            with open(path) as file, contextlib.redirect_stdout(stdout):
+                interpret_stream(file, path=path)
+            self.assertEqual(stdout.getvalue(), f'{path}:3:3: b not in symbol table\n  b))\n  ^\n')
+
+    def test_stream_forgets_earlier_expressions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'prog.txt')
+            with open(path, 'w') as file:
+                file.write('#def G g\n(def f (x)\n  (G x))\n' + '(= y 1)\n' * 1000 + '(f y)')
+            stdout = io.StringIO()
+            with open(path) as file, contextlib.redirect_stdout(stdout):
+                interpret_stream(file, path=path)
+            self.assertEqual(stdout.getvalue(), f'{path}:3:3: g not in symbol table\n  (G x))\n  ^\n')
+        # a stream that cannot be read again has no place for an error in an expression it dropped
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            interpret_stream(io.StringIO('(def f (x) (g x))\n(= y 1)\n(f y)'))
+        self.assertEqual(stdout.getvalue(), 'g not in symbol table\n')
+
+class TestCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = ProgramCache(maxsize=2)
+        self.assertEqual(interpret('(+ 1 2)', cache=cache), 3)
+        self.assertEqual(interpret('(+ 1 2)   // same once preprocessed', cache=cache), 3)
+        self.assertEqual(cache.info()['hits'], 1)
+        self.assertEqual(cache.info()['misses'], 1)
+        interpret('(+ 1 3)', cache=cache)
+        interpret('(+ 1 4)', cache=cache)
+        self.assertEqual(cache.info()['size'], 2)
+        interpret('(+ 1 2)', cache=cache)
+        self.assertEqual(cache.info()['misses'], 4)
+
+    def test_include_changes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'lib.txt')
+            cache = ProgramCache()
+            with open(path, 'w') as f:
+                f.write('(= x 1)')
+            self.assertEqual(interpret(f'#inc {path}\nx', cache=cache), 1)
+            with open(path, 'w') as f:
+                f.write('(= x 22)')
+            self.assertEqual(interpret(f'#inc {path}\nx', cache=cache), 22)
+            self.assertEqual(cache.info()['misses'], 2)
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ProgramCache(directory=directory).program('(def f (x) (* x x)) (f 3)')
+            cache = ProgramCache(directory=directory)
+            self.assertEqual(interpret('(def f (x) (* x x)) (f 3)', cache=cache), 9)
+            self.assertEqual(cache.info()['disk_hits'], 1)
+            self.assertEqual(cache.info()['misses'], 0)
+
 class TestInterpret(unittest.TestCase):
+    interpret = staticmethod(interpret)
+
     def test_assign(self):
-        self.assertEqual(interpret('(assign x 10) x'), 10)
-        self.assertEqual(interpret('(assign longer_name 6) longer_name'), 6)
-        self.assertEqual(interpret('(assign slashes/too \'And strings!\') slashes/too'), 'And strings!')
+        self.assertEqual(self.interpret('(assign x 10) x'), 10)
+        self.assertEqual(self.interpret('(assign longer_name 6) longer_name'), 6)
+        self.assertEqual(self.interpret('(assign slashes/too \'And strings!\') slashes/too'), 'And strings!')
 
     def test_add_assign(self):
-        self.assertEqual(interpret('(assign x 10) (add_assign x 10) x'), 20)
-        self.assertEqual(interpret('(assign y 2) (add_assign y 5) y'), 7)
+        self.assertEqual(self.interpret('(assign x 10) (add_assign x 10) x'), 20)
+        self.assertEqual(self.interpret('(assign y 2) (add_assign y 5) y'), 7)
 
     def test_sub_assign(self):
-        self.assertEqual(interpret('(assign x 10) (add_assign x 10) x'), 20)
-        self.assertEqual(interpret('(assign y 2) (add_assign y 5) y'), 7)
+        self.assertEqual(self.interpret('(assign x 10) (add_assign x 10) x'), 20)
+        self.assertEqual(self.interpret('(assign y 2) (add_assign y 5) y'), 7)
 
     def test_mul_assign(self):
-        self.assertEqual(interpret('(assign x 10) (mul_assign x 10) x'), 100)
-        self.assertEqual(interpret('(assign y 2) (mul_assign y 5) y'), 10)
+        self.assertEqual(self.interpret('(assign x 10) (mul_assign x 10) x'), 100)
+        self.assertEqual(self.interpret('(assign y 2) (mul_assign y 5) y'), 10)
 
     def test_div_assign(self):
-        self.assertEqual(interpret('(assign x 10) (div_assign x 10) x'), 1)
-        self.assertAlmostEqual(interpret('(assign y 2) (div_assign y 5) y'), 2 / 5)
+        self.assertEqual(self.interpret('(assign x 10) (div_assign x 10) x'), 1)
+        self.assertAlmostEqual(self.interpret('(assign y 2) (div_assign y 5) y'), 2 / 5)
 
     def test_mod_assign(self):
-        self.assertEqual(interpret('(assign x 10) (mod_assign x 10) x'), 0)
-        self.assertAlmostEqual(interpret('(assign y 2) (mod_assign y 5) y'), 2)
+        self.assertEqual(self.interpret('(assign x 10) (mod_assign x 10) x'), 0)
+        self.assertAlmostEqual(self.interpret('(assign y 2) (mod_assign y 5) y'), 2)
 
     def test_inc(self):
-        self.assertEqual(interpret('(assign x 10) (inc x) x'), 11)
-        self.assertEqual(interpret('(assign y 2) (inc y) y'), 3)
+        self.assertEqual(self.interpret('(assign x 10) (inc x) x'), 11)
+        self.assertEqual(self.interpret('(assign y 2) (inc y) y'), 3)
 
     def test_dec(self):
-        self.assertEqual(interpret('(assign x 10) (dec x) x'), 9)
-        self.assertEqual(interpret('(assign y 2) (dec y) y'), 1)
+        self.assertEqual(self.interpret('(assign x 10) (dec x) x'), 9)
+        self.assertEqual(self.interpret('(assign y 2) (dec y) y'), 1)
 
     def test_neg(self):
-        self.assertEqual(interpret('(neg 3.5)'), -3.5)
-        self.assertEqual(interpret('(neg 5)'), -5)
+        self.assertEqual(self.interpret('(neg 3.5)'), -3.5)
+        self.assertEqual(self.interpret('(neg 5)'), -5)
 
     def test_add(self):
-        self.assertAlmostEqual(interpret('(add 2.1 2)'), 4.1)
-        self.assertEqual(interpret('(add 1 (add 2 3))'), 6)
-        self.assertEqual(interpret('(add (add 1 2) 3)'), 6)
-        self.assertEqual(interpret('(add 1 2 3 4 5 6 7 8 9 10)'), 55)
+        self.assertAlmostEqual(self.interpret('(add 2.1 2)'), 4.1)
+        self.assertEqual(self.interpret('(add 1 (add 2 3))'), 6)
+        self.assertEqual(self.interpret('(add (add 1 2) 3)'), 6)
+        self.assertEqual(self.interpret('(add 1 2 3 4 5 6 7 8 9 10)'), 55)
 
     def test_sub(self):
-        self.assertAlmostEqual(interpret('(sub 2.9 2)'), 0.9)
-        self.assertEqual(interpret('(sub (sub 3 2) 1)'), 0)
-        self.assertEqual(interpret('(sub 3 (sub 2 1))'), 2)
+        self.assertAlmostEqual(self.interpret('(sub 2.9 2)'), 0.9)
+        self.assertEqual(self.interpret('(sub (sub 3 2) 1)'), 0)
+        self.assertEqual(self.interpret('(sub 3 (sub 2 1))'), 2)
 
     def test_mul(self):
-        self.assertAlmostEqual(interpret('(mul 2.9 2)'), 5.8)
-        self.assertEqual(interpret('(mul (mul 3 2) 1)'), 6)
-        self.assertEqual(interpret('(mul 3 (mul 2 1))'), 6)
-        self.assertEqual(interpret('(mul 1 2 3 4 5 6 7 8 9 10)'), 3628800)
+        self.assertAlmostEqual(self.interpret('(mul 2.9 2)'), 5.8)
+        self.assertEqual(self.interpret('(mul (mul 3 2) 1)'), 6)
+        self.assertEqual(self.interpret('(mul 3 (mul 2 1))'), 6)
+        self.assertEqual(self.interpret('(mul 1 2 3 4 5 6 7 8 9 10)'), 3628800)
 
     def test_div(self):
-        self.assertAlmostEqual(interpret('(div 2.9 2)'), 1.45)
-        self.assertEqual(interpret('(div (div 3 2) 1)'), 1.5)
-        self.assertEqual(interpret('(div 3 (div 2 1))'), 1.5)
+        self.assertAlmostEqual(self.interpret('(div 2.9 2)'), 1.45)
+        self.assertEqual(self.interpret('(div (div 3 2) 1)'), 1.5)
+        self.assertEqual(self.interpret('(div 3 (div 2 1))'), 1.5)
 
     def test_mod(self):
-        self.assertAlmostEqual(interpret('(mod 2.9 2)'), 0.9)
-        self.assertEqual(interpret('(mod (mod 3 2) 2)'), 1)
-        self.assertEqual(interpret('(mod 3 (mod 5 3))'), 1)
+        self.assertAlmostEqual(self.interpret('(mod 2.9 2)'), 0.9)
+        self.assertEqual(self.interpret('(mod (mod 3 2) 2)'), 1)
+        self.assertEqual(self.interpret('(mod 3 (mod 5 3))'), 1)
 
     def test_eq(self):
-        self.assertTrue(interpret('(eq 0 0)'))
-        self.assertTrue(interpret('(eq 1 1)'))
-        self.assertTrue(interpret('(eq 10 10)'))
-        self.assertFalse(interpret('(eq 0 1)'))
+        self.assertTrue(self.interpret('(eq 0 0)'))
+        self.assertTrue(self.interpret('(eq 1 1)'))
+        self.assertTrue(self.interpret('(eq 10 10)'))
+        self.assertFalse(self.interpret('(eq 0 1)'))
 
     def test_lt(self):
-        self.assertFalse(interpret('(lt 0 0)'))
-        self.assertFalse(interpret('(lt 2 1)'))
-        self.assertTrue(interpret('(lt 9 10)'))
-        self.assertTrue(interpret('(lt 0 1)'))
+        self.assertFalse(self.interpret('(lt 0 0)'))
+        self.assertFalse(self.interpret('(lt 2 1)'))
+        self.assertTrue(self.interpret('(lt 9 10)'))
+        self.assertTrue(self.interpret('(lt 0 1)'))
 
     def test_gt(self):
-        self.assertFalse(interpret('(gt 0 0)'))
-        self.assertTrue(interpret('(gt 2 1)'))
-        self.assertFalse(interpret('(gt 9 10)'))
-        self.assertFalse(interpret('(gt 0 1)'))
+        self.assertFalse(self.interpret('(gt 0 0)'))
+        self.assertTrue(self.interpret('(gt 2 1)'))
+        self.assertFalse(self.interpret('(gt 9 10)'))
+        self.assertFalse(self.interpret('(gt 0 1)'))
 
     def test_le(self):
-        self.assertTrue(interpret('(le 0 0)'))
-        self.assertFalse(interpret('(le 2 1)'))
-        self.assertTrue(interpret('(le 9 10)'))
-        self.assertTrue(interpret('(le 0 1)'))
+        self.assertTrue(self.interpret('(le 0 0)'))
+        self.assertFalse(self.interpret('(le 2 1)'))
+        self.assertTrue(self.interpret('(le 9 10)'))
+        self.assertTrue(self.interpret('(le 0 1)'))
 
     def test_ge(self):
-        self.assertTrue(interpret('(ge 0 0)'))
-        self.assertTrue(interpret('(ge 2 1)'))
-        self.assertFalse(interpret('(ge 9 10)'))
-        self.assertFalse(interpret('(ge 0 1)'))
+        self.assertTrue(self.interpret('(ge 0 0)'))
+        self.assertTrue(self.interpret('(ge 2 1)'))
+        self.assertFalse(self.interpret('(ge 9 10)'))
+        self.assertFalse(self.interpret('(ge 0 1)'))
 
     def test_def(self):
-        self.assertEqual(interpret('(def square (x) (* x x)) (square 4)'), 16)
-        self.assertEqual(interpret('(def f () (= x 10)) (f) x'), None)
+        self.assertEqual(self.interpret('(def square (x) (* x x)) (square 4)'), 16)
+        self.assertEqual(self.interpret('(def f () (= x 10)) (f) x'), None)
+        self.assertEqual(self.interpret('(= x 1) (def f () (= x 10)) (f) x'), 1)
+        self.assertEqual(self.interpret('(= x 1) (def f (x) (+= x 10)) (f 5)'), 15)
+
+    def test_def_scope(self):
+        self.assertEqual(self.interpret('(def fact (n) (if (<= n 1) 1 (* n (fact (- n 1))))) (fact 10)'), 3628800)
+        self.assertEqual(self.interpret('(= y 3) (def f (x) (+ x y)) (= y 4) (f 1)'), 5)
+        self.assertEqual(self.interpret('(def g () n) (def f (n) (g)) (f 5)'), None)
+        self.assertEqual(self.interpret('(def f (x) (nop (def g () x) (g))) (f 7)'), 7)
+
+    def test_defmemo(self):
+        fib = '(defmemo fib (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))'
+        self.assertEqual(self.interpret(fib + ' (fib 90)'), 2880067194370816120)
+        self.assertEqual(self.interpret(fib + ' (fib 30) (fib 30) (memo_info fib)'), {'hits': 29, 'misses': 31, 'size': 31, 'maxsize': 128})
+        self.assertEqual(self.interpret('(defmemo f 2 (n) (* n n)) (f 1) (f 2) (f 3) (memo_info f)')['size'], 2)
+        self.assertEqual(self.interpret('(defmemo f (l) (len l)) (f (lst 1 2))'), 2)
+        self.assertEqual(self.interpret('(defmemo f (n) (* n n)) (f 3) (memo_clear f) (memo_info f)')['misses'], 0)
+
+    def test_defmemo_impure(self):
+        self.assertEqual(self.interpret('(= t 0) (defmemo f (n) (+= t n)) (f 1)'), None)
+        self.assertEqual(self.interpret('(= t 0) (defmemo f (n) (= t n)) 1'), None)
+        self.assertEqual(self.interpret('(defmemo f (n) (nop (= acc 0) (for i (n) (+= acc i)) acc)) (f 4)'), 6)
+        # what a nested function assigns stays in its frame, the name it is bound to does not
+        self.assertEqual(self.interpret('(defmemo f (n) (nop (def g (x) (nop (+= x 1) x)) (g n))) (f 5)'), 6)
+        self.assertEqual(self.interpret('(def g () 1) (defmemo f (n) (nop (def g (x) x) (g n))) (f 5)'), None)
 
     def test_while(self):
-        self.assertEqual(interpret('(= x 0)(while (< x 10) (++ x)) x'), 10)
+        self.assertEqual(self.interpret('(= x 0)(while (< x 10) (++ x)) x'), 10)
 
     def test_for(self):
-        self.assertEqual(interpret('(for i (10) i)'), 9)
-        self.assertEqual(interpret('(for i (6 10 2) i)'), 8)
+        self.assertEqual(self.interpret('(for i (10) i)'), 9)
+        self.assertEqual(self.interpret('(for i (6 10 2) i)'), 8)
 
     def test_fore_each(self):
-        self.assertEqual(interpret('(fore i (lst 1 3 2) i)'), 2)
-        self.assertEqual(interpret('(fore i (lst 9 3 1) i)'), 1)
+        self.assertEqual(self.interpret('(fore i (lst 1 3 2) i)'), 2)
+        self.assertEqual(self.interpret('(fore i (lst 9 3 1) i)'), 1)
 
     def test_append(self):
-        self.assertEqual(interpret('(= x (lst 1 2 3)) (+= x (lst 4 5)) (app x 6) x'), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(self.interpret('(= x (lst 1 2 3)) (+= x (lst 4 5)) (app x 6) x'), [1, 2, 3, 4, 5, 6])
 
     def test_int(self):
-        self.assertEqual(interpret('(int \'123\')'), 123)
-        self.assertEqual(interpret('(int \'32\')'), 32)
+        self.assertEqual(self.interpret('(int \'123\')'), 123)
+        self.assertEqual(self.interpret('(int \'32\')'), 32)
 
     def test_float(self):
-        self.assertEqual(interpret('(float \'123\')'), 123.0)
-        self.assertEqual(interpret('(float \'32.1\')'), 32.1)
+        self.assertEqual(self.interpret('(float \'123\')'), 123.0)
+        self.assertEqual(self.interpret('(float \'32.1\')'), 32.1)
 
     def test_str(self):
-        self.assertEqual(interpret('(str 123)'), '123')
-        self.assertEqual(interpret('(str 32.1)'), '32.1')
+        self.assertEqual(self.interpret('(str 123)'), '123')
+        self.assertEqual(self.interpret('(str 32.1)'), '32.1')
 
     def test_len(self):
-        self.assertEqual(interpret('(len (lst 1 2 3))'), 3)
+        self.assertEqual(self.interpret('(len (lst 1 2 3))'), 3)
+
+    def test_many_expressions(self):
+        self.assertEqual(self.interpret('(= x 0)' + ' (++ x)' * 5000 + ' x'), 5000)
+
+PROGRAMS = [
+    '(assign x 10) (add_assign x 10) (sub_assign x 3) (mul_assign x 2) (div_assign x 4) (mod_assign x 5) x',
+    '(= x 1) (inc x) (inc x) (dec x) x',
+    '(def fact (n) (if (<= n 1) 1 (* n (fact (- n 1))))) (fact 12)',
+    '(= result 1) (for i (1 10) (*= result i)) result',
+    '(= l (lst)) (fore i (lst 3 1 2) (app l (* i i))) l',
+    '(= x 0) (while (< x 100) (+= x 7)) x',
+    '(if (> 1 2) 1)',
+    '(= add sub) (add 5 3)',
+    '(def f (a b c d) (+ a b c d)) (f 1 2 3 4)',
+    '(nop 1 2 (lst 1 2 3))',
+    '(defmemo fib (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2))))) (fib 50)',
+]
+
+class TestCompile(unittest.TestCase):
+    def test_matches_eval_tree(self):
+        for program in PROGRAMS:
+            with self.subTest(program=program):
+                node = ps.program(program)
+                symbol_table = new_symbol_table()
+                expected = eval_tree(node, new_symbol_table())
+                self.assertEqual(compile_tree(node, symbol_table)(symbol_table), expected)
+
+    def test_locals_fall_back_to_outer_scope(self):
+        program = '''
+        (= x 1)
+        (def f (a) (nop (= y (+ x a)) (= x y) x))
+        (def g () (nop (= z 10) (def h () (+= z 1)) (h)))
+        (lst (f 5) x (g))
+        '''
+        symbol_table = new_symbol_table()
+        self.assertEqual(compile_tree(ps.program(program), symbol_table)(symbol_table), [6, 1, 11])
+
+    def test_keyword_is_compile_error(self):
+        with self.assertRaises(InterpretException):
+            compile_tree(ps.program('(def f () (print assign))'))
+
+class TestSnapshot(unittest.TestCase):
+    PRELUDE = '(def square (x) (* x x)) (= base 10) (= items (lst 1 2)) (def add (a b) (- a b))'
+
+    def prelude(self, run) -> Snapshot:
+        symbol_table = new_symbol_table()
+        run(self.PRELUDE, symbol_table)
+        return symbol_table.snapshot()
+
+    def test_forks_keep_their_assignments(self):
+        for run in (evaluate, vm.evaluate):
+            with self.subTest(run=run.__module__):
+                snapshot = self.prelude(run)
+                first, second = snapshot.fork(), snapshot.fork()
+                self.assertEqual(run('(= base 3) (square base)', first), 9)
+                self.assertEqual(run('(square base)', second), 100)
+                self.assertEqual(snapshot['base'], 10)
+                self.assertNotIn('base', dict.keys(second))
+
+    def test_snapshot_is_read_only(self):
+        snapshot = self.prelude(evaluate)
+        self.assertIsInstance(snapshot, Env)
+        with self.assertRaisesRegex(InterpretException, 'read only'):
+            snapshot['base'] = 1
+        with self.assertRaisesRegex(InterpretException, 'read only'):
+            snapshot.update(base=1)
+        with self.assertRaisesRegex(InterpretException, 'read only'):
+            snapshot |= {'base': 1}
+        with self.assertRaisesRegex(InterpretException, 'read only'):
+            snapshot.pop('base')
+        self.assertEqual(snapshot['base'], 10)
+        for run in (evaluate, vm.evaluate):
+            with self.subTest(run=run.__module__):
+                with self.assertRaisesRegex(ERRORS, 'read only'):
+                    run('(= base 1)', snapshot)
+        with self.assertRaisesRegex(InterpretException, 'read only'):
+            BUILTINS['add'] = 1
+
+    def test_shadowed_builtins(self):
+        for run in (evaluate, vm.evaluate):
+            with self.subTest(run=run.__module__):
+                fork = self.prelude(run).fork()
+                self.assertEqual(run('(add 5 3)', fork), 2)
+                self.assertEqual(run('(def square (x) 0) (square 4)', fork), 0)
+                self.assertEqual(shadowed_names(ps.program('1'), fork), {'add'})
+
+    def test_values_are_shared(self):
+        snapshot = self.prelude(evaluate)
+        evaluate('(append items 3)', snapshot.fork())
+        self.assertEqual(evaluate('items', snapshot.fork()), [1, 2, 3])
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestVectors(unittest.TestCase):
+    def test_element_wise(self):
+        self.assertEqual(interpret('(add (vec 1 2 3) 1)').tolist(), [2, 3, 4])
+        self.assertEqual(interpret('(mul (range_vec 3) 2.5)').tolist(), [0, 2.5, 5])
+        self.assertEqual(interpret('(sub (vec 1 2) (vec 1 1))').tolist(), [0, 1])
+        self.assertEqual(interpret('(div (vec 2 4) 2)').tolist(), [1, 2])
+        self.assertEqual(interpret('(add 1 (vec 1 2) 0.5)').tolist(), [2.5, 3.5])
+
+    def test_not_changed_in_place(self):
+        self.assertEqual(interpret('(= v (vec 1 2)) (add v 1) (mul v 3) v').tolist(), [1, 2])
+        self.assertEqual(interpret('(= l (lst 1 2)) (= v (vec l)) (append l 3) v').tolist(), [1, 2])
+
+    def test_reductions(self):
+        self.assertEqual(interpret('(sum (range_vec 5))'), 10)
+        self.assertIs(type(interpret('(sum (range_vec 5))')), int)
+        self.assertEqual(interpret('(sum (lst 1 2 3))'), 6)
+        self.assertEqual(interpret('(dot (vec 1 2 3) (vec 4 5 6))'), 32)
+
+    def test_map_filter(self):
+        self.assertEqual(interpret('(map_vec (def sq (x) (* x x)) (range_vec 4))').tolist(), [0, 1, 4, 9])
+        self.assertEqual(interpret('(map_vec neg (vec 1 2))').tolist(), [-1, -2])
+        self.assertEqual(interpret('(= v (range_vec 6)) (filter_vec (> v 3) v)').tolist(), [4, 5])
+        self.assertEqual(interpret('(filter_vec (def odd (x) (% x 2)) (range_vec 6))').tolist(), [1, 3, 5])
+
+    def test_scalars_unchanged(self):
+        self.assertEqual(interpret('(add 1 2 3)'), 6)
+        self.assertEqual(interpret('(add (lst 1) (lst 2))'), [1, 2])
+        self.assertEqual(interpret("(mul 'ab' 2)"), 'abab')
+
+class TestParallel(unittest.TestCase):
+    def test_pmap(self):
+        program = '''
+        (= k 10)
+        (def sq (x) (* x x))
+        (def f (x) (+ (sq x) k))
+        (pmap f (lst 1 2 3 4 5) 2)
+        '''
+        self.assertEqual(interpret(program), [11, 14, 19, 26, 35])
+        self.assertEqual(vm.interpret(program), [11, 14, 19, 26, 35])
+        symbol_table = new_symbol_table()
+        self.assertEqual(eval_tree(ps.program(program), symbol_table), [11, 14, 19, 26, 35])
+        self.assertEqual(interpret('(pmap neg (lst 1 2))'), [-1, -2])
+        self.assertEqual(interpret('(pfore neg (lst 1 2))'), -2)
+        self.assertEqual(interpret('(pmap neg (lst))'), [])
+
+    def test_renamed_and_recursive(self):
+        program = '''
+        (def fact (n) (if (< n 2) 1 (* n (fact (- n 1)))))
+        (= g fact)
+        (def f (x) (g x))
+        (pmap f (lst 1 2 3 4 5))
+        '''
+        self.assertEqual(interpret(program), [1, 2, 6, 24, 120])
+
+    def test_first_error_is_raised(self):
+        program = '''
+        (def f (x) (if (> x 2) (undefined x) x))
+        (pmap f (lst 1 2 3 4 5 6) 1)
+        '''
+        with self.assertRaisesRegex(InterpretException, 'f failed on item 2: undefined not in symbol table'):
+            compile_tree(ps.program(program))(new_symbol_table())
+
+    def test_cannot_send(self):
+        with self.assertRaisesRegex(InterpretException, 'inside a function'):
+            compile_tree(ps.program('(def f () (nop (def g (x) x) (pmap g (lst 1)))) (f)'))(new_symbol_table())
+        with self.assertRaisesRegex(InterpretException, 'not a function'):
+            compile_tree(ps.program('(pmap 1 (lst 1))'))(new_symbol_table())
+
+    def test_serial_in_other_processes(self):
+        self.assertFalse(parallel.in_worker())
+        # a process started by another pool would never stop a pool of its own
+        with ProcessPoolExecutor(1) as executor:
+            self.assertTrue(executor.submit(parallel.in_worker).result())
+
+class TestBatch(unittest.TestCase):
+    def test_run_all(self):
+        with tempfile.TemporaryDirectory() as directory:
+            programs = {'a.txt': '(print 1) (= x 2)', 'b.txt': '(print x)', 'c.txt': "(print 'c') (/ 1 0)"}
+            for name, program in programs.items():
+                with open(os.path.join(directory, name), 'w') as file:
+                    file.write(program)
+            out, report = io.StringIO(), io.StringIO()
+            summary = batch.run_all([directory], workers=2, out=out, report=report)
+            self.assertEqual((summary.scripts, summary.failures), (3, 2))
+            self.assertEqual(out.getvalue().split('\n')[:5], [
+                f'==> {os.path.join(directory, "a.txt")} <==', '1',
+                f'==> {os.path.join(directory, "b.txt")} <==', f'{os.path.join(directory, "b.txt")}:1:8: x not in symbol table',
+                f'==> {os.path.join(directory, "c.txt")} <==',
+            ])
+            self.assertIn('ZeroDivisionError', report.getvalue())
+            self.assertIn('3 scripts, 2 failed', report.getvalue())
+
+    def test_run_script(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file:
+            file.write("(for i (3) (print i))")
+        try:
+            result = batch.run_script(file.name, use_vm=True)
+        finally:
+            os.remove(file.name)
+        self.assertEqual((result.output, result.error), ('0\n1\n2\n', None))
+
+    def test_prelude(self):
+        with tempfile.TemporaryDirectory() as directory:
+            programs = {'prelude': '(def square (x) (* x x)) (= base 10)', 'a.txt': '(print (square base)) (= base 1)', 'b.txt': '(print base)'}
+            for name, program in programs.items():
+                with open(os.path.join(directory, name), 'w') as file:
+                    file.write(program)
+            out = io.StringIO()
+            paths = [os.path.join(directory, 'a.txt'), os.path.join(directory, 'b.txt')]
+            summary = batch.run_all(paths, workers=1, out=out, report=io.StringIO(), prelude=os.path.join(directory, 'prelude'))
+            self.assertEqual(summary.failures, 0)
+            self.assertEqual(out.getvalue().split('\n')[1:4:2], ['100', '10'])
+            summary = batch.run_all(paths, workers=1, out=io.StringIO(), report=io.StringIO(), prelude=os.path.join(directory, 'missing'))
+            self.assertEqual(summary.failures, 2)
+
+    def test_pmap_in_script(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'pm.txt')
+            with open(path, 'w') as file:
+                file.write('(def sq (x) (* x x)) (print (pmap sq (lst 1 2 3 4)))')
+            main = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+            for flags in ([], ['--workers', '1'], ['--vm']):
+                with self.subTest(flags=flags):
+                    # a pool started inside a worker kept the batch from exiting
+                    done = subprocess.run([sys.executable, main, '--batch', path, *flags], capture_output=True, text=True, timeout=60)
+                    self.assertEqual(done.returncode, 0)
+                    self.assertEqual(done.stdout.split('\n')[1], '[1, 4, 9, 16]')
+
+class TestServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.path = os.path.join(tempfile.mkdtemp(), 'test.sock')
+        cls.loop = asyncio.new_event_loop()
+        cls.thread = threading.Thread(target=cls.loop.run_forever)
+        cls.thread.start()
+        cls.server = server.Server(cls.path)
+        cls.serving = asyncio.run_coroutine_threadsafe(cls.server.serve(), cls.loop)
+        while not os.path.exists(cls.path):
+            time.sleep(0.01)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.serving.cancel()
+        while os.path.exists(cls.path):
+            time.sleep(0.01)
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.loop.close()
+
+    def test_output_and_result(self):
+        response = client.send("(print 'hi' 1) (+ 1 2)", self.path)
+        self.assertEqual((response['output'], response['result'], response['error']), ('hi 1\n', '3', None))
+        self.assertEqual(client.send('(undefined)', self.path)['error'], '<input>:1:1: undefined not in symbol table')
+
+    def test_sessions(self):
+        client.send('(= x 5)', self.path, session='a')
+        self.assertEqual(client.send('(+ x 1)', self.path, session='a')['result'], '6')
+        self.assertEqual(client.send('x', self.path)['error'], '<input>:1:1: x not in symbol table')
+        self.assertEqual(client.send('x', self.path, session='b')['error'], '<input>:1:1: x not in symbol table')
+
+    def test_timeout(self):
+        response = client.send('(while True 1)', self.path, timeout=0.01)
+        self.assertTrue(response['error'].startswith('<input>:1:1: time limit of 0.01s exceeded'))
+
+    def test_timed_out_session(self):
+        client.send('(= x 1)', self.path, session='stuck')
+        release = threading.Event()
+        # a builtin that does not return in time, so the thread keeps running in the session
+        self.server.sessions['stuck'].symbol_table['block'] = release.wait
+        self.assertEqual(client.send('(block)', self.path, session='stuck', timeout=0.01)['error'], 'timed out after 0.01s')
+        self.assertEqual(client.send('x', self.path, session='stuck')['error'], 'session stuck is still running a program that timed out')
+        self.assertEqual(client.send('x', self.path, session='other')['error'], '<input>:1:1: x not in symbol table')
+        release.set()
+        while self.server.sessions['stuck'].stuck is not None:
+            time.sleep(0.01)
+        self.assertEqual(client.send('x', self.path, session='stuck')['result'], '1')
+
+    def test_concurrent_includes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            big = os.path.join(directory, 'big.txt')
+            top = os.path.join(directory, 'top.txt')
+            with open(big, 'w') as file:
+                file.write('\n'.join(f'(= x{i} {i})' for i in range(10000)) + '\n(def f (x) (+ x x9999))')
+            with open(top, 'w') as file:
+                file.write(f'#inc {big}')
+            # a different macro before each include means top.txt is preprocessed again every time
+            programs = [f'#def m{i} {i}\n#inc {top}\n(f m{i})' for i in range(16)]
+            with ThreadPoolExecutor(4) as executor:
+                responses = list(executor.map(lambda program: client.send(program, self.path), programs))
+        for i, response in enumerate(responses):
+            with self.subTest(i=i):
+                self.assertEqual((response['result'], response['error']), (str(i + 9999), None))
+
+    def test_bad_request(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.path)
+            connection.sendall(b'{"program": 1}\nnot json\n')
+            with connection.makefile('rb') as responses:
+                for _ in range(2):
+                    self.assertTrue(json.loads(responses.readline())['error'].startswith('bad request'))
+
+class TestLimits(unittest.TestCase):
+    def test_steps(self):
+        with self.assertRaises(LimitExceeded) as caught:
+            evaluate('(while True 1)', limits=Limits(steps=1000))
+        self.assertEqual(caught.exception.steps, 1001)
+        self.assertEqual(evaluate('(= x 0) (for i (10) (++ x)) x', limits=Limits(steps=10)), 10)
+        with self.assertRaises(LimitExceeded):
+            evaluate('(fore i (lst 1 2 3) i)', limits=Limits(steps=2))
+
+    def test_depth(self):
+        with self.assertRaises(LimitExceeded) as caught:
+            evaluate('(def f (n) (+ 1 (f (+ n 1)))) (f 0)', limits=Limits(depth=50))
+        self.assertEqual(caught.exception.depth, 51)
+        self.assertEqual(evaluate('(def f (n) (if (< n 50) (f (+ n 1)) n)) (f 1)', limits=Limits(depth=50)), 50)
+        with self.assertRaisesRegex(LimitExceeded, 'recursion'):
+            evaluate('(def f (n) (+ 1 (f (+ n 1)))) (f 0)', limits=Limits())
+
+    def test_depth_past_python_limit(self):
+        deep = '(def f (n) (if (< n 1) 0 (+ 1 (f (- n 1))))) (f {})'
+        depth = sys.getrecursionlimit()
+        self.assertEqual(evaluate(deep.format(depth), limits=Limits(depth=depth + 1)), depth)
+        with self.assertRaisesRegex(LimitExceeded, f'^<input>:1:31: call depth of {depth} exceeded'):
+            evaluate(deep.format(depth * 2), limits=Limits(depth=depth))
+        with self.assertRaisesRegex(InterpretException, 'Expected a call depth limit'):
+            evaluate('1', limits=Limits(depth=-1))
+
+    def test_seconds(self):
+        with self.assertRaises(LimitExceeded) as caught:
+            evaluate('(def f () (while True 1)) (f)', limits=Limits(seconds=0.05))
+        self.assertGreaterEqual(caught.exception.seconds, 0.05)
+        self.assertEqual(caught.exception.depth, 1)
+        with self.assertRaisesRegex(LimitExceeded, '^<input>:2:3: time limit'):
+            evaluate('(= i 0)\n  (while True (++ i))', limits=Limits(seconds=0.05))
+
+    def test_functions_outlive_their_budget(self):
+        symbol_table = new_symbol_table()
+        evaluate('(def f (n) (for i (n) i))', symbol_table, limits=Limits(steps=5))
+        self.assertEqual(evaluate('(f 100)', symbol_table), 99)
+
+    def test_stream(self):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            interpret_stream(io.StringIO('(for i (5) i)\n(for i (5) i)'), limits=Limits(steps=8))
+        self.assertTrue(stdout.getvalue().startswith('<input>:2:1: step budget of 8 exceeded after 9 steps'))
+
+class TestProfiler(unittest.TestCase):
+    SOURCE = '''(def fib (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+(def work (k) (nop (= total 0) (for i (k) (+= total (fib 5))) total))
+(work 3)
+(fore x (lst 1 2) (work x))'''
+
+    def test_functions(self):
+        profile = Profiler()
+        self.assertEqual(evaluate(self.SOURCE, profile=profile), 10)
+        fib, work = profile.functions['fib <input>:1:1'], profile.functions['work <input>:2:1']
+        self.assertEqual(work.calls, 2 + 1)
+        self.assertEqual(fib.calls, 6 * 15)
+        self.assertLessEqual(work.exclusive, work.inclusive)
+        self.assertGreaterEqual(work.inclusive, fib.inclusive)
+        # recursive calls are not counted again in the inclusive time
+        self.assertLessEqual(fib.inclusive, work.inclusive)
+
+    def test_loops(self):
+        profile = Profiler()
+        evaluate(self.SOURCE, profile=profile)
+        self.assertEqual((profile.loops['for <input>:2:32'].runs, profile.loops['for <input>:2:32'].hits), (3, 6))
+        self.assertEqual((profile.loops['fore <input>:4:1'].runs, profile.loops['fore <input>:4:1'].hits), (1, 2))
+        report = profile.report()
+        self.assertLess(report.index('for <input>:2:32'), report.index('fore <input>:4:1'))
+        self.assertIn('fib <input>:1:1', report)
+
+    def test_collapsed(self):
+        profile = Profiler()
+        evaluate(self.SOURCE, profile=profile)
+        file = io.StringIO()
+        profile.write_collapsed(file)
+        stacks = {}
+        for line in file.getvalue().splitlines():
+            stack, microseconds = line.rsplit(' ', 1)
+            stacks[stack] = int(microseconds)
+        self.assertIn('<program>;work <input>:2:1;fib <input>:1:1', stacks)
+        self.assertTrue(all(stack.startswith('<program>') for stack in stacks))
+
+    def test_memo_and_errors(self):
+        profile = Profiler()
+        symbol_table = new_symbol_table()
+        evaluate('(defmemo f 8 (n) (if (< n 2) n (+ (f (- n 1)) (f (- n 2))))) (f 20)', symbol_table, profile=profile)
+        self.assertEqual(symbol_table['f'].memo.info()['hits'], 18)
+        with self.assertRaises(InterpretException):
+            evaluate('(def g () (h)) (g)', profile=profile)
+        self.assertEqual(profile.functions['g <input>:1:1'].calls, 1)
+        self.assertEqual(profile.running, [0])
+
+    def test_stream_and_vm(self):
+        profile = Profiler()
+        interpret_stream(io.StringIO('(def f () 1)\n(f)\n(f)'), profile=profile)
+        self.assertEqual(profile.functions['f <input>:1:1'].calls, 2)
+        with self.assertRaises(InterpretException):
+            vm.evaluate('1', profile=profile)
+
+class TestOptimize(unittest.TestCase):
+    def optimized(self, program: str) -> str:
+        node = ps.program(program)
+        return opt.dump(opt.optimize(node, shadowed_names(node)))
+
+    def test_fold(self):
+        self.assertEqual(self.optimized('(print (add 1 2) (mul 2.5 8) (< 1 2))'), '(print 3 20.0 True)')
+        self.assertEqual(self.optimized('(def f (a) (+ a (* 2 3)))'), '(def f (a) (+ a 6))')
+        self.assertEqual(self.optimized('(/ 1 0)'), '(/ 1 0)')
+
+    def test_long_strings_are_not_folded(self):
+        self.assertEqual(self.optimized("(mul 'ab' 3)"), "'ababab'")
+        # folding this would build a 10GB string for a function that is never called
+        self.assertEqual(self.optimized("(def f () (mul 'x' 10000000000))"), "(def f () (mul 'x' 10000000000))")
+        self.assertEqual(self.optimized("(len (* 'x' 2 512))"), '1024')
+        self.assertEqual(self.optimized("(len (* 'x' 2 513))"), "(len (* 'x' 2 513))")
+        self.assertEqual(self.optimized("(* 'x' (neg 5))"), "''")
+
+    def test_rebound_builtin_is_not_folded(self):
+        self.assertEqual(self.optimized('(= x (add 1 2)) (def add (a b) a)'), '(= x (add 1 2))\n(def add (a b) a)')
+        self.assertEqual(self.optimized('(def f (mul) (mul 2 3))'), '(def f (mul) (mul 2 3))')
+        node = ps.program('(add 1 2)')
+        self.assertEqual(opt.dump(opt.optimize(node, shadowed_names(node, Env({'add': 1}, BUILTINS)))), '(add 1 2)')
+
+    def test_if(self):
+        self.assertEqual(self.optimized("(if (eq 1 1) (print 'a') (print 'b'))"), "(print 'a')")
+        self.assertEqual(self.optimized("(if False (print 'a') (print 'b'))"), "(print 'b')")
+        self.assertEqual(self.optimized("(if 0 (print 'a'))"), '(nop)')
+        self.assertEqual(self.optimized("(if x (print 'a'))"), "(if x (print 'a'))")
+
+    def test_dump_round_trips(self):
+        self.assertEqual(self.optimized('(- 1 5)'), '(neg 4)')
+        self.assertEqual(self.optimized('(* 100000000000. 1000000000000.)'), '100000000000000000000000.0')
+        self.assertEqual(self.optimized("(add 'it\\'s' '\\n\\t\\q')"), "'it\\'s\\n\\t\\q'")
+        self.assertEqual(self.optimized("(float '-inf')"), "(neg (float 'inf'))")
+        self.assertEqual(self.optimized("(add 'a/' '/b')"), "(add 'a/' '/b')")
+        self.assertEqual(self.optimized('(def f (neg) 1) (- 1 5)'), '(def f (neg) 1)\n(- 1 5)')
+        for program in ['(- 1 5)', '(/ 1. 3)', '(* 0.0000001 0.0001)', '(neg 0.)', "(float '-inf')", "(add 'it\\'s' '\\n\\t|')", "(add 'a\\\\' 'n')", "(str (* 100000000000. 1000000000000.))"]:
+            with self.subTest(program=program):
+                value = eval_tree(ps.program(program), new_symbol_table())
+                dumped = self.optimized(program)
+                self.assertEqual(repr(eval_tree(ps.program(dumped), new_symbol_table())), repr(value))
+
+    def test_nop(self):
+        self.assertEqual(self.optimized('(nop 1 (nop (print 2) 3) (nop (print 4)))'), '(nop (print 2) 3 (print 4))')
+        self.assertEqual(self.optimized('(nop 1 (nop))'), '(nop)')
+        self.assertEqual(self.optimized('(nop (nop 5))'), '5')
+
+    def test_not_complete(self):
+        node = ps.program('(def f () (add 1 2)) (add 1 2)')
+        self.assertEqual(opt.dump(opt.optimize(node, shadowed_names(node), complete=False)), '(def f () (add 1 2))\n3')
+
+    def test_same_result(self):
+        for program in PROGRAMS:
+            with self.subTest(program=program):
+                self.assertEqual(interpret(program), interpret(program, optimize=False))
+
+class TestStream(unittest.TestCase):
+    def test_matches_interpret(self):
+        for program in PROGRAMS + ["(= s 'multi\nline\nstring') s", '(print\n1\n2)\n(+\n1 2\n)']:
+            with self.subTest(program=program):
+                lines = io.StringIO(program)
+                self.assertEqual(interpret_stream(lines), interpret(program))
+                self.assertEqual(vm.interpret_stream(io.StringIO(program)), vm.interpret(program))
+
+    def test_runs_before_reading_everything(self):
+        symbol_table = new_symbol_table()
+        def lines():
+            yield '(= x 1)'
+            self.assertEqual(symbol_table['x'], 1)
+            yield '(= y (+ x 1))'
+            yield 'y'
+        self.assertEqual(interpret_stream(lines(), symbol_table), 2)
+
+    def test_memory_does_not_grow(self):
+        def lines(count: int, first: str = '') -> Iterator[str]:
+            yield first
+            for i in range(count):
+                yield f'(= x{i % 10} {i})\n'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'prog.txt')
+            def mapped(lines: Iterator[str]):
+                with open(path, 'w') as file:
+                    file.writelines(lines)
+                interpret_mapped(path)
+            runs = {
+                'interpret': lambda count: interpret_stream(lines(count)),
+                'vm': lambda count: vm.interpret_stream(lines(count)),
+                # a comment makes the mapped file go through the preprocessor
+                'mapped': lambda count: mapped(lines(count, '// comment\n')),
+            }
+            for name, run in runs.items():
+                with self.subTest(run=name):
+                    run(100)
+                    peaks = []
+                    for count in (2000, 8000):
+                        tracemalloc.start()
+                        run(count)
+                        peaks.append(tracemalloc.get_traced_memory()[1])
+                        tracemalloc.stop()
+                    self.assertLess(peaks[1] - peaks[0], 64 * 1024)
+
+    def test_scan_chunks(self):
+        chunks = ['(pri', 'nt 12', '.5 \'a ', 'b\') Tr', 'ue']
+        self.assertEqual(list(sc.scan_chunks(chunks)), list(sc.scan_chunks([''.join(chunks)])))
+
+    def run_mapped(self, source: str, run) -> tuple[any, str]:
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', encoding='utf-8', delete=False) as file:
+            file.write(source)
+        try:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                result = run(file.name)
+            return result, output.getvalue().replace(file.name, 'prog.txt')
+        finally:
+            os.remove(file.name)
+
+    def test_mapped(self):
+        for run, expected in ((interpret_mapped, interpret), (vm.interpret_mapped, vm.interpret)):
+            for program in PROGRAMS + ["(= s 'näive\nline') s", "(= s 'a \t\n    b  \r\n\n  c') s", '(print\n1\n2)\n(+\n1 2\n)', '#def x 5\n(+ x 1) // six', '']:
+                with self.subTest(program=program, run=run.__module__):
+                    self.assertEqual(self.run_mapped(program, run)[0], expected(program))
+
+    def test_mapped_error(self):
+        result, output = self.run_mapped("(= s 'é')\n(+ 'é' s (undefined 1))", interpret_mapped)
+        self.assertIsNone(result)
+        self.assertIn('prog.txt:2:10: undefined not in symbol table', output)
+        self.assertIn("(+ 'é' s (undefined 1))\n         ^", output)
+
+    def test_scan_bytes(self):
+        for program in PROGRAMS + ["(print 'näive \\'q\\'' 1.5 True)"]:
+            with self.subTest(program=program):
+                expected = [token for token, _ in sc.scan_offsets((program,))]
+                self.assertEqual([token for token, _ in sc.scan_bytes(program.encode())], expected)
+        with self.assertRaises(sc.ScannerException):
+            list(sc.scan_bytes(b"(print 'a\xff')"))
+
+    def test_needs_preprocessing(self):
+        self.assertFalse(sc.needs_preprocessing(b"(print 'a # b')\n(+ 1 2)"))
+        self.assertTrue(sc.needs_preprocessing(b'(+ 1 2)\n  #def x 5'))
+        self.assertTrue(sc.needs_preprocessing(b'(+ 1 2) // comment'))
+
+class TestOutput(unittest.TestCase):
+    def test_policies(self):
+        file = io.StringIO()
+        output = Output(file, SIZE, size=8)
+        output.print('abc')
+        self.assertEqual(file.getvalue(), '')
+        output.print(1, 2.5, True)
+        self.assertEqual(file.getvalue(), 'abc\n1 2.5 True\n')
+        file = io.StringIO()
+        output = Output(file, LINE)
+        output.print('a', end='')
+        self.assertEqual(file.getvalue(), '')
+        output.print('b')
+        self.assertEqual(file.getvalue(), 'ab\n')
+        file = io.StringIO()
+        output = Output(file, EXIT, size=1)
+        for i in range(100):
+            output.print(i)
+        self.assertEqual(file.getvalue(), '')
+        output.flush()
+        self.assertEqual(file.getvalue().split(), [str(i) for i in range(100)])
+        with self.assertRaises(ValueError):
+            Output(file, 'never')
+
+    def test_install(self):
+        for evaluate_ in (evaluate, vm.evaluate):
+            with self.subTest(evaluate=evaluate_.__module__):
+                file = io.StringIO()
+                symbol_table = new_symbol_table()
+                with Output(file, EXIT) as output:
+                    output.install(symbol_table)
+                    evaluate_("(def f (x) (print 'f' x)) (f 1) (flush) (= n (len 'abc'))", symbol_table)
+                    self.assertEqual(file.getvalue(), 'f 1\n')
+                    evaluate_('(f n)', symbol_table)
+                self.assertEqual(file.getvalue(), 'f 1\nf 3\n')
+                output.uninstall(symbol_table)
+                self.assertNotIn('print', dict.keys(symbol_table))
+                self.assertIs(symbol_table['print'], BUILTINS['print'])
+
+    def test_follows_stdout(self):
+        output = Output(policy=EXIT)
+        first, second = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(first):
+            output.print('first')
+        with contextlib.redirect_stdout(second):
+            output.print('second')
+            output.flush()
+        self.assertEqual((first.getvalue(), second.getvalue()), ('first\n', 'second\n'))
+
+    def test_flushed_after_program(self):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            interpret("(for i (3) (print i)) (print 'x' (undefined))")
+        self.assertTrue(stdout.getvalue().startswith('0\n1\n2\n<input>:1:34: undefined not in symbol table'))
+
+class TestVM(TestInterpret):
+    interpret = staticmethod(vm.interpret)
+
+    def test_matches_eval_tree(self):
+        for program in PROGRAMS:
+            with self.subTest(program=program):
+                node = ps.program(program)
+                symbol_table = new_symbol_table()
+                expected = eval_tree(node, new_symbol_table())
+                self.assertEqual(vm.run(vm.compile_program(node, symbol_table), symbol_table), expected)
+
+    def test_deep_recursion(self):
+        self.assertEqual(self.interpret('(def count (n) (if (<= n 0) 0 (+ 1 (count (- n 1))))) (count 20000)'), 20000)
+
+    def test_disassemble(self):
+        listing = vm.disassemble(vm.compile_program(ps.program('(def f (x) (+ x 1)) (f 2)')))
+        self.assertIn('MAKE_FUNCTION', listing)
+        self.assertIn('LOAD_LOCAL     0 (x)', listing)
+
+class TestTailCalls(unittest.TestCase):
+    evaluate = staticmethod(evaluate)
+
+    def test_self_recursion(self):
+        self.assertEqual(self.evaluate('(def count (n acc) (if (== n 0) acc (count (- n 1) (+ acc 1)))) (count 1000000 0)'), 1000000)
+
+    def test_mutual_recursion(self):
+        source = '(def even (n) (if (== n 0) True (odd (- n 1)))) (def odd (n) (if (== n 0) False (even (- n 1))))'
+        self.assertTrue(self.evaluate(f'{source} (even 100000)'))
+        self.assertTrue(self.evaluate(f'{source} (odd 100001)'))
+
+    def test_nop(self):
+        self.assertEqual(self.evaluate('(def f (n acc) (if (> n 0) (nop (= x (+ acc 2)) (f (- n 1) x)) acc)) (f 100000 0)'), 200000)
+        symbol_table = new_symbol_table()
+        self.evaluate('(def f (n) (if (> n 0) (nop 1 (f (- n 1))) n))', symbol_table)
+        self.evaluate('(def nop (a b) 7)', symbol_table)
+        self.assertEqual(self.evaluate('(f 3)', symbol_table), 7)
+
+    def test_not_in_tail_position(self):
+        self.assertEqual(self.evaluate('(def f (n) (if (> n 0) (+ 1 (f (- n 1))) 0)) (f 100)'), 100)
+        with self.assertRaises(InterpretException):
+            self.evaluate('(def f (n) (g n)) (def g (a b) a) (f 1)')
+
+    def test_memo(self):
+        symbol_table = new_symbol_table()
+        self.assertEqual(self.evaluate('(defmemo f 0 (n acc) (if (> n 0) (f (- n 1) (+ acc 1)) acc)) (f 100 0)', symbol_table), 100)
+        self.assertEqual(self.evaluate('(f 100 0)', symbol_table), 100)
+        self.assertEqual(symbol_table['f'].memo.info()['hits'], 1)
+
+    def test_eval_tree(self):
+        node = ps.program('(def count (n acc) (if (== n 0) acc (count (- n 1) (+ acc 1)))) (count 20000 0)')
+        self.assertEqual(eval_tree(node, new_symbol_table()), 20000)
+
+    def test_limits_and_profile(self):
+        with self.assertRaises(LimitExceeded) as caught:
+            evaluate('(def f (n) (f n)) (f 0)', limits=Limits(steps=1000))
+        self.assertEqual(caught.exception.depth, 1)
+        profile = Profiler()
+        self.assertEqual(evaluate('(def f (n) (if (> n 0) (f (- n 1)) n)) (f 100)', profile=profile), 0)
+        self.assertEqual(profile.functions['f <input>:1:1'].calls, 101)
+
+class TestVMTailCalls(TestTailCalls):
+    evaluate = staticmethod(vm.evaluate)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,575 @@
+'''
+Compile an abstract syntax program to bytecode and execute it on a stack machine
+'''
+
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Iterable
+import operator as op
+import mmap
+from cache import ProgramCache
+import parser as ps
+import scanner as sc
+import optimize as opt
+from interpret import InterpretException, ERRORS, Limits, Profiler, COMPOUND_ASSIGN_OPERATORS, MemoCache, bound_names, shadowed_names, check_memo_purity
+from symbol_table import Env, BUILTINS, KEYWORDS, new_symbol_table
+from output import STDOUT
+from source_map import SourceMap, SourceError
+
+class Op(IntEnum):
+    CONST = 0         # push arg
+    LOAD_LOCAL = 1    # push the local in slot arg
+    LOAD_NAME = 2     # push the value of the name arg from enclosing frames or the globals
+    STORE_LOCAL = 3   # store the top of the stack in slot arg without popping it
+    STORE_NAME = 4    # store the top of the stack in the globals as arg without popping it
+    POP = 5           # discard the top of the stack
+    JUMP = 6          # jump to arg
+    JUMP_IF_FALSE = 7 # pop the top of the stack and jump to arg if it is falsy
+    CALL = 8          # call the function under arg arguments
+    RETURN = 9        # return the top of the stack to the calling frame
+    MAKE_FUNCTION = 10 # push a function running the code arg
+    GET_RANGE = 11    # replace the top arg values with an iterator over their range
+    GET_ITER = 12     # replace the top of the stack with an iterator over it
+    FOR_ITER = 13     # push the next item from the iterator under the top of the stack or remove it and jump to arg
+    BINARY = 14       # replace the top two values with the result of the function arg
+    RAISE = 15        # raise an InterpretException with the message arg
+    LOAD_BUILTIN = 16 # push the builtin in arg unless its name has been assigned in the globals
+    TAIL_CALL = 17    # call the function under arg arguments in place of the current frame if it is not memoized
+    JUMP_IF_BOUND = 18 # jump to the second item of arg if the builtin named by the first has been assigned in the globals
+
+class _Unset:
+    def __repr__(self):
+        return 'UNSET'
+UNSET = _Unset()
+
+@dataclass
+class Code:
+    name: str
+    params: list[str]
+    local_names: list[str] | None
+    ops: list[Op] = field(default_factory=list)
+    args: list[any] = field(default_factory=list)
+    # offset in the program of the tree each instruction was compiled from
+    positions: list[int | None] = field(default_factory=list)
+    memo: ps.MemoDefNode | None = None
+    node: ps.DefNode | None = None
+
+    def __post_init__(self):
+        self.slots = None if self.local_names is None else {name: i for i, name in enumerate(self.local_names)}
+        # offset of the tree being compiled
+        self.pos = None
+
+    def emit(self, opcode: Op, arg: any = None) -> int:
+        '''
+        add an instruction
+        :opcode: the operation
+        :arg: the argument of the operation
+        :returns: the index of the instruction
+        '''
+        self.ops.append(opcode)
+        self.args.append(arg)
+        self.positions.append(self.pos)
+        return len(self.ops) - 1
+
+    def patch(self, index: int):
+        '''
+        point the jump at index to the next instruction
+        :index: index of the jump
+        '''
+        self.args[index] = len(self.ops)
+
+class Frame:
+    '''
+    The state of one function call
+    locals are stored in a list indexed by the slots of the code
+    '''
+    __slots__ = ('code', 'locals', 'closure', 'env', 'memo')
+
+    def __init__(self, code: Code, locals_: list[any] | None, closure: 'Frame | None', env: Env):
+        self.code = code
+        self.locals = locals_
+        self.closure = closure
+        self.env = env
+        # the cache and key to store the result in when a memoized function returns
+        self.memo = None
+
+class Function:
+    '''A user defined function compiled to bytecode'''
+    __slots__ = ('code', 'closure', 'env', 'memo', '__name__')
+
+    def __init__(self, code: Code, closure: Frame | None, env: Env):
+        self.code = code
+        self.closure = closure
+        self.env = env
+        self.memo = None if code.memo is None else MemoCache(code.memo.maxsize)
+        self.__name__ = code.name
+
+    @property
+    def definition(self) -> tuple[ps.DefNode, Env] | None:
+        '''the tree and globals of the function, None if it closes over the locals of another function'''
+        return None if self.closure is not None else (self.code.node, self.env)
+
+    def frame(self, args: list[any]) -> Frame:
+        '''
+        create the frame for a call
+        :args: the arguments of the call
+        '''
+        code = self.code
+        if len(args) != len(code.params):
+            raise InterpretException(f'{code.name} expected {len(code.params)} arguments but got {len(args)}')
+        return Frame(code, args + [UNSET] * (len(code.local_names) - len(args)), self.closure, self.env)
+
+    def __call__(self, *args: any) -> any:
+        if self.memo is None:
+            return execute(self.frame(list(args)))
+        try:
+            return self.memo.lookup(args)
+        except KeyError:
+            pass
+        except TypeError:
+            return execute(self.frame(list(args)))
+        result = execute(self.frame(list(args)))
+        self.memo.store(args, result)
+        return result
+
+    def __repr__(self):
+        return f'<function {self.__name__}>'
+
+def compile_program(node: ps.Node, symbol_table: Env | None = None) -> Code:
+    '''
+    compile a tree into bytecode
+    :node: tree to compile
+    :symbol_table: global frame the code will run in
+    '''
+    code = Code('<program>', [], None)
+    _emit(node, code, shadowed_names(node, symbol_table))
+    code.emit(Op.RETURN)
+    return code
+
+def _emit_load(name: str, code: Code, shadowed: set[str]):
+    if code.slots is not None and name in code.slots:
+        code.emit(Op.LOAD_LOCAL, code.slots[name])
+    elif name not in shadowed and name in BUILTINS:
+        code.emit(Op.LOAD_BUILTIN, (name, BUILTINS[name]))
+    else:
+        code.emit(Op.LOAD_NAME, name)
+
+def _emit_store(name: str, code: Code):
+    if code.slots is not None:
+        code.emit(Op.STORE_LOCAL, code.slots[name])
+    else:
+        code.emit(Op.STORE_NAME, name)
+
+def _emit_loop(name: str, block: ps.Node, code: Code, shadowed: set[str]):
+    '''
+    emit the body of a for loop once the iterator is on the stack
+    the result of the last iteration is kept on top of the iterator
+    '''
+    code.emit(Op.CONST, None)
+    start = code.emit(Op.FOR_ITER)
+    _emit_store(name, code)
+    code.emit(Op.POP)
+    code.emit(Op.POP)
+    _emit(block, code, shadowed)
+    code.emit(Op.JUMP, start)
+    code.patch(start)
+
+def _emit_tail_nop(node: ps.FunctionNode, code: Code, shadowed: set[str]):
+    '''
+    emit a nop in tail position of a function body inline so its last argument is in tail position too
+    the call is emitted as well for when nop has been assigned in the globals
+    '''
+    args = node.arguments
+    jump_call = code.emit(Op.JUMP_IF_BOUND)
+    for arg in args[:-1]:
+        _emit(arg, code, shadowed)
+        code.emit(Op.POP)
+    _emit(args[-1], code, shadowed, True)
+    jump_end = code.emit(Op.JUMP)
+    code.args[jump_call] = ('nop', len(code.ops))
+    _emit(node, code, shadowed)
+    code.patch(jump_end)
+
+def _emit(node: ps.Node, code: Code, shadowed: set[str], tail: bool = False):
+    '''
+    emit the bytecode that leaves the value of a tree on the stack
+    the instructions are marked with the offset of the innermost tree that has one
+    :node: tree to compile
+    :code: code to add instructions to
+    :shadowed: names that may not be resolved to builtins ahead of time
+    :tail: the tree is in tail position of a function body
+    '''
+    outer = code.pos
+    if node.pos is not None:
+        code.pos = node.pos
+    try:
+        _emit_node(node, code, shadowed, tail)
+    finally:
+        code.pos = outer
+
+def _emit_node(node: ps.Node, code: Code, shadowed: set[str], tail: bool):
+    match node:
+        case ps.ExpressionsNode(body):
+            first, *rest = body
+            _emit(first, code, shadowed)
+            for expr in rest:
+                code.emit(Op.POP)
+                _emit(expr, code, shadowed)
+        case ps.ValueNode(value=value):
+            code.emit(Op.CONST, value)
+        case ps.FunctionNode(name, args):
+            if name in KEYWORDS:
+                code.emit(Op.RAISE, f'{name} is a keyword and cannot be assigned to')
+                return
+            builtin = name not in shadowed and name in BUILTINS
+            if tail and builtin and name == 'nop' and args:
+                _emit_tail_nop(node, code, shadowed)
+                return
+            _emit_load(name, code, shadowed)
+            for arg in args:
+                _emit(arg, code, shadowed)
+            code.emit(Op.TAIL_CALL if tail and not builtin else Op.CALL, len(args))
+        case ps._AssignNode(name, _) | ps.IncrementNode(name) | ps.DecrementNode(name) | ps.IdentNode(name) if name in KEYWORDS:
+            code.emit(Op.RAISE, f'{name} is a keyword and cannot be assigned to')
+        case ps.AssignNode(name, value):
+            _emit(value, code, shadowed)
+            _emit_store(name, code)
+        case ps._AssignNode(name, value):
+            _emit_load(name, code, shadowed)
+            _emit(value, code, shadowed)
+            code.emit(Op.BINARY, COMPOUND_ASSIGN_OPERATORS[type(node)])
+            _emit_store(name, code)
+        case ps.IncrementNode(name) | ps.DecrementNode(name):
+            _emit_load(name, code, shadowed)
+            code.emit(Op.CONST, 1)
+            code.emit(Op.BINARY, op.iadd if isinstance(node, ps.IncrementNode) else op.isub)
+            _emit_store(name, code)
+        case ps.IdentNode(name):
+            _emit_load(name, code, shadowed)
+        case ps.IfNode(cond, block, else_block):
+            _emit(cond, code, shadowed)
+            jump_else = code.emit(Op.JUMP_IF_FALSE)
+            _emit(block, code, shadowed, tail)
+            jump_end = code.emit(Op.JUMP)
+            code.patch(jump_else)
+            if else_block is None:
+                code.emit(Op.CONST, None)
+            else:
+                _emit(else_block, code, shadowed, tail)
+            code.patch(jump_end)
+        case ps.DefNode(name, names, body):
+            local_names = list(names)
+            for local in sorted(bound_names(body, enter_defs=False) - set(names)):
+                local_names.append(local)
+            function = Code(name, names, local_names, memo=node if isinstance(node, ps.MemoDefNode) else None, node=node)
+            _emit(body, function, shadowed, True)
+            function.emit(Op.RETURN)
+            code.emit(Op.MAKE_FUNCTION, function)
+            _emit_store(name, code)
+        case ps.WhileNode(cond, block):
+            code.emit(Op.CONST, None)
+            start = len(code.ops)
+            _emit(cond, code, shadowed)
+            jump_end = code.emit(Op.JUMP_IF_FALSE)
+            code.emit(Op.POP)
+            _emit(block, code, shadowed)
+            code.emit(Op.JUMP, start)
+            code.patch(jump_end)
+        case ps.ForNode(name, range_args, block):
+            for arg in range_args:
+                _emit(arg, code, shadowed)
+            code.emit(Op.GET_RANGE, len(range_args))
+            _emit_loop(name, block, code, shadowed)
+        case ps.ForEachNode(name, items, block):
+            _emit(items, code, shadowed)
+            code.emit(Op.GET_ITER)
+            _emit_loop(name, block, code, shadowed)
+        case _:
+            raise InterpretException(f'Cannot compile {node}')
+
+def _load_name(frame: Frame, name: str) -> any:
+    '''
+    look up a name that is not a local of the current frame
+    :frame: frame the closure chain starts at
+    :name: name to look up
+    '''
+    closure = frame.closure
+    while closure is not None:
+        slot = closure.code.slots.get(name)
+        if slot is not None and (value := closure.locals[slot]) is not UNSET:
+            return value
+        closure = closure.closure
+    try:
+        return frame.env[name]
+    except KeyError:
+        raise InterpretException(f'{name} not in symbol table') from None
+
+def _visible(frame: Frame, name: str) -> bool:
+    try:
+        _load_name(frame, name)
+    except InterpretException:
+        return False
+    return True
+
+def execute(frame: Frame) -> any:
+    '''
+    run bytecode until the starting frame returns
+    calls to bytecode functions push a frame instead of recursing
+    :frame: frame to start in
+    :returns: the value returned by the starting frame
+    '''
+    CONST, LOAD_LOCAL, LOAD_NAME, STORE_LOCAL, STORE_NAME = Op.CONST, Op.LOAD_LOCAL, Op.LOAD_NAME, Op.STORE_LOCAL, Op.STORE_NAME
+    POP, JUMP, JUMP_IF_FALSE, CALL, RETURN = Op.POP, Op.JUMP, Op.JUMP_IF_FALSE, Op.CALL, Op.RETURN
+    MAKE_FUNCTION, GET_RANGE, GET_ITER, FOR_ITER, BINARY = Op.MAKE_FUNCTION, Op.GET_RANGE, Op.GET_ITER, Op.FOR_ITER, Op.BINARY
+    LOAD_BUILTIN, TAIL_CALL, JUMP_IF_BOUND = Op.LOAD_BUILTIN, Op.TAIL_CALL, Op.JUMP_IF_BOUND
+    in_globals = dict.__contains__
+    stack = []
+    push, pop = stack.append, stack.pop
+    calls = []
+    ops, args, locals_ = frame.code.ops, frame.code.args, frame.locals
+    pc = 0
+    try:
+        while True:
+            opcode = ops[pc]
+            arg = args[pc]
+            pc += 1
+            if opcode is LOAD_LOCAL:
+                value = locals_[arg]
+                if value is UNSET:
+                    value = _load_name(frame, frame.code.local_names[arg])
+                push(value)
+            elif opcode is CONST:
+                push(arg)
+            elif opcode is LOAD_BUILTIN:
+                name, builtin = arg
+                push(_load_name(frame, name) if in_globals(frame.env, name) else builtin)
+            elif opcode is LOAD_NAME:
+                push(_load_name(frame, arg))
+            elif opcode is CALL or opcode is TAIL_CALL:
+                if arg:
+                    call_args = stack[-arg:]
+                    del stack[-arg:]
+                else:
+                    call_args = []
+                func = pop()
+                if type(func) is Function:
+                    memo = func.memo
+                    if memo is not None:
+                        key = tuple(call_args)
+                        try:
+                            push(memo.lookup(key))
+                            continue
+                        except KeyError:
+                            pass
+                        except TypeError:
+                            memo = None
+                    # a tail call replaces the frame unless a result has to be cached when it returns
+                    if opcode is CALL or memo is not None or frame.memo is not None:
+                        calls.append((frame, pc))
+                    frame = func.frame(call_args)
+                    if memo is not None:
+                        frame.memo = (memo, key)
+                    ops, args, locals_ = frame.code.ops, frame.code.args, frame.locals
+                    pc = 0
+                else:
+                    try:
+                        push(func(*call_args))
+                    except TypeError as t:
+                        raise InterpretException(str(t))
+            elif opcode is STORE_LOCAL:
+                locals_[arg] = stack[-1]
+            elif opcode is POP:
+                pop()
+            elif opcode is JUMP_IF_FALSE:
+                if not pop():
+                    pc = arg
+            elif opcode is JUMP:
+                pc = arg
+            elif opcode is FOR_ITER:
+                try:
+                    push(next(stack[-2]))
+                except StopIteration:
+                    del stack[-2]
+                    pc = arg
+            elif opcode is BINARY:
+                right = pop()
+                stack[-1] = arg(stack[-1], right)
+            elif opcode is STORE_NAME:
+                frame.env[arg] = stack[-1]
+            elif opcode is RETURN:
+                if frame.memo is not None:
+                    memo, key = frame.memo
+                    memo.store(key, stack[-1])
+                if not calls:
+                    return pop()
+                frame, pc = calls.pop()
+                ops, args, locals_ = frame.code.ops, frame.code.args, frame.locals
+            elif opcode is MAKE_FUNCTION:
+                if arg.memo is not None:
+                    check_memo_purity(arg.memo, lambda name: _visible(frame, name))
+                push(Function(arg, frame if locals_ is not None else None, frame.env))
+            elif opcode is GET_RANGE:
+                range_args = stack[-arg:]
+                del stack[-arg:]
+                push(iter(range(*range_args)))
+            elif opcode is GET_ITER:
+                stack[-1] = iter(stack[-1])
+            elif opcode is JUMP_IF_BOUND:
+                if in_globals(frame.env, arg[0]):
+                    pc = arg[1]
+            else:
+                raise InterpretException(arg)
+    except SourceError as e:
+        # the instruction that failed is the one before pc
+        e.at(frame.code.positions[pc - 1], None)
+        raise
+
+def run(code: Code, symbol_table: Env) -> any:
+    '''
+    run compiled program
+    :code: the compiled program
+    :symbol_table: global frame to run in
+    '''
+    return execute(Frame(code, None, None, symbol_table))
+
+def _format_arg(code: Code, opcode: Op, arg: any) -> str:
+    match opcode:
+        case Op.LOAD_LOCAL | Op.STORE_LOCAL:
+            return f'{arg} ({code.local_names[arg]})'
+        case Op.LOAD_BUILTIN:
+            return arg[0]
+        case Op.JUMP_IF_BOUND:
+            return f'{arg[0]} {arg[1]}'
+        case Op.MAKE_FUNCTION:
+            return f'<code {arg.name}>'
+        case Op.BINARY:
+            return arg.__name__
+        case Op.POP | Op.RETURN | Op.GET_ITER:
+            return ''
+    return repr(arg)
+
+def disassemble(code: Code) -> str:
+    '''
+    produce a readable listing of compiled code and every function inside it
+    :code: the compiled code
+    '''
+    lines = [f'{code.name} ({" ".join(code.params)})']
+    if code.local_names:
+        lines[0] += f' locals: {" ".join(code.local_names)}'
+    functions = []
+    for index, (opcode, arg) in enumerate(zip(code.ops, code.args)):
+        lines.append(f'{index:>6} {opcode.name:<14} {_format_arg(code, opcode, arg)}'.rstrip())
+        if opcode is Op.MAKE_FUNCTION:
+            functions.append(arg)
+    for function in functions:
+        lines.append('')
+        lines.append(disassemble(function))
+    return '\n'.join(lines)
+
+def check_no_limits(limits: Limits | None, profile: Profiler | None = None):
+    if limits is not None:
+        raise InterpretException('the bytecode machine cannot limit steps, call depth or time')
+    if profile is not None:
+        raise InterpretException('the bytecode machine cannot be profiled')
+
+def interpret(string: str, symbol_table: Env | None = None, cache: ProgramCache | None = None, optimize: bool = True, limits: Limits | None = None, profile: Profiler | None = None, path: str | None = None) -> any:
+    '''
+    interpret and execute a string on the bytecode machine, printing any error
+    :string: str to execute
+    :symbol_table: global frame to execute in, a new one is made if not given
+    :cache: cache to get the parsed program from
+    :optimize: simplify the tree before running it
+    :limits: not supported by the bytecode machine, must be None
+    :profile: not supported by the bytecode machine, must be None
+    :path: file the program came from, used to say where errors happened
+    '''
+    try:
+        return evaluate(string, symbol_table, cache, optimize, limits, profile, path)
+    except ERRORS as e:
+        print(e.report())
+
+def evaluate(string: str, symbol_table: Env | None = None, cache: ProgramCache | None = None, optimize: bool = True, limits: Limits | None = None, profile: Profiler | None = None, path: str | None = None) -> any:
+    '''
+    interpret and execute a string on the bytecode machine, raising any error
+    :string: str to execute
+    :symbol_table: global frame to execute in, a new one is made if not given
+    :cache: cache to get the parsed program from
+    :optimize: simplify the tree before running it
+    :limits: not supported by the bytecode machine, must be None
+    :profile: not supported by the bytecode machine, must be None
+    :path: file the program came from, used to say where errors happened
+    '''
+    check_no_limits(limits, profile)
+    complete = symbol_table is None
+    if symbol_table is None:
+        symbol_table = new_symbol_table()
+    elif not isinstance(symbol_table, Env):
+        symbol_table = Env(symbol_table, BUILTINS)
+    source = SourceMap(path, string)
+    try:
+        node = ps.program(string) if cache is None else cache.program(string)
+        if optimize:
+            node = opt.optimize(node, shadowed_names(node, symbol_table), complete)
+        return run(compile_program(node, symbol_table), symbol_table)
+    except SourceError as e:
+        e.at(None, source)
+        raise
+    finally:
+        STDOUT.flush()
+
+def interpret_stream(lines: Iterable[str], symbol_table: Env | None = None, optimize: bool = True, limits: Limits | None = None, profile: Profiler | None = None, path: str | None = None) -> any:
+    '''
+    interpret and execute a program as it is read
+    each top level expression runs as soon as it is parsed
+    :lines: the lines of the program
+    :symbol_table: global frame to execute in, a new one is made if not given
+    :optimize: simplify each expression before running it
+    :limits: not supported by the bytecode machine, must be None
+    :profile: not supported by the bytecode machine, must be None
+    :path: file the program came from, used to say where errors happened
+    '''
+    source = SourceMap(path)
+    return run_stream(ps.program_stream(lines, source), source, symbol_table, optimize, limits, profile)
+
+def interpret_mapped(path: str, symbol_table: Env | None = None, optimize: bool = True, limits: Limits | None = None, profile: Profiler | None = None) -> any:
+    '''
+    interpret and execute a file on the bytecode machine as it is read through a memory map
+    :path: the file
+    :symbol_table: global frame to execute in, a new one is made if not given
+    :optimize: simplify each expression before running it
+    :limits: not supported by the bytecode machine, must be None
+    :profile: not supported by the bytecode machine, must be None
+    '''
+    with open(path, 'rb') as file:
+        data = sc.map_file(file)
+    try:
+        return run_stream(*ps.mapped_program_stream(data, path), symbol_table, optimize, limits, profile)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+def run_stream(nodes: Iterable[ps.Node], source: SourceMap, symbol_table: Env | None = None, optimize: bool = True, limits: Limits | None = None, profile: Profiler | None = None) -> any:
+    '''
+    run each top level expression of a program on the bytecode machine as soon as it is parsed, printing any error
+    :nodes: the expressions
+    :source: map the offsets of the expressions are in
+    :symbol_table: global frame to execute in, a new one is made if not given
+    :optimize: simplify each expression before running it
+    :limits: not supported by the bytecode machine, must be None
+    :profile: not supported by the bytecode machine, must be None
+    '''
+    if symbol_table is None:
+        symbol_table = new_symbol_table()
+    result = None
+    try:
+        check_no_limits(limits, profile)
+        try:
+            for node in nodes:
+                if optimize:
+                    node = opt.optimize(node, shadowed_names(node, symbol_table), complete=False)
+                result = run(compile_program(node, symbol_table), symbol_table)
+        finally:
+            STDOUT.flush()
+        return result
+    except ERRORS as e:
+        print(e.at(None, source).report())